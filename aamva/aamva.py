@@ -42,13 +42,28 @@
 # keyboard support: http://blog.flip-edesign.com/_rst/MagTek_USB_Card_Reader_Hacking_with_Python.html
 # TODO: Add federal commercial driving codes "DCH" to all versions.
 
+import bisect
+import copy
 import datetime
-
+import functools
+import hashlib
+import operator
+import pprint
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from types import MappingProxyType
+
+# Decoding is reentrant: every AAMVA method keeps its per-call state in
+# locals, so one instance can be shared by any number of threads.  The
+# module-level caches (dates, element IDs, headers, heights and weights)
+# only ever map a key to an immutable value, so a race between threads can
+# at worst compute the same value twice.  `debug` is a process-wide
+# setting that is only ever read while decoding.
 debug = False
 
-if debug:
-    import pprint
-
 """ Constants and signals """  # Better way to do this?
 ANY = 0
 MAGSTRIPE = 1
@@ -89,6 +104,23 @@ IMPERIAL_WEIGHTS = {
     8: "281 - 320 lbs",
     9: "321+ lbs",
 }
+# Upper bound of each weight range but the last, for bisect, and the
+# weight used to approximate each range
+METRIC_WEIGHT_BOUNDS = (31, 45, 59, 70, 86, 100, 113, 127, 145)
+IMPERIAL_WEIGHT_BOUNDS = (70, 100, 130, 160, 190, 220, 250, 280, 320)
+METRIC_WEIGHT_APPROXIMATIONS = (20, 38, 53, 65, 79, 94, 107, 121, 137, 146)
+IMPERIAL_WEIGHT_APPROXIMATIONS = (50, 85, 115, 145, 175, 205, 235, 265, 300, 321)
+# Height, Weight and Header instances are interned, up to this many of each
+FLYWEIGHT_CACHE_SIZE = 4096
+
+# Error codes of ReadError.code, for what was wrong with a scan
+HEADER_ERROR = "header"  # compliance indicator, separators, file type, IIN
+DIRECTORY_ERROR = "directory"  # subfile count, designators, offsets, lengths
+VERSION_ERROR = "version"  # no decoder for the AAMVA version
+MISSING_ELEMENT = "missing"  # a required data element is absent (partial read)
+ELEMENT_ERROR = "element"  # a data element has an invalid value
+SWIPE_ERROR = "swipe"  # malformed magstripe tracks
+CARD_ERROR = "card"  # the card reader reported a bad swipe
 
 # PDF417 format specifications and validations
 PDF_LINEFEED = "\x0A"  # '\n' (line feed)
@@ -97,6 +129,11 @@ PDF_SEGTERM = "\x0D"  # '\r' segment terminator (carriage return)
 PDF_FILETYPE = "ANSI "  # identifies the file as an AAMVA compliant
 PDF_VERSIONS = list(range(64))  # decimal between 0 - 63
 PDF_ENTRIES = list(range(1, 100))  # decimal number of subfile identifiers
+PDF_FILESEP = "\x1C"  # file separator, which SC uses in place of RS
+# Payloads may also be given as bytes, which are decoded once on the way
+# in.  Latin-1 maps every byte to the character with the same code, so
+# offsets are the same in either form.
+TEXT_ENCODING = "latin-1"
 
 ISSUERS = {
     636033: "Alabama",
@@ -171,1387 +208,882 @@ ISSUERS = {
 }
 
 
-class AAMVA:
-    def __init__(self, data=None, format=[ANY], strict=True):
-        self.format = format
-        assert not isinstance(format, str)
-        self.data = data
-        self.strict = strict
+""" Date decoding """
+# Dates of birth and expiry repeat heavily across scans, so each layout's
+# parser remembers the most recently seen date strings.  datetime.date is
+# immutable, so cached dates are safe to share between results.
+DATE_CACHE_SIZE = 4096
 
-    def decode(self, data=None):
-        """
-        Decodes data from a string and returns a dictionary of values.
-        Data is decoded in the format preference specified in the constructor.
-        Missing or empty fields will usually be represented by 'None' type.
-        Note that the issue date is missing from the magstripe encoding, and
-        will always be represented by 'None'.
-        """
-        if data is None:
-            data = self.data
-        if data is None:
-            raise ValueError("No data to parse")
 
-        for form in self.format:
-            if form == ANY or form == MAGSTRIPE:
-                try:
-                    return self.decode_magstripe(data)
-                except (IndexError, AssertionError) as e:
-                    if form == MAGSTRIPE:
-                        raise ReadError(e)
-                    # fail silently and continue to the next format
-            if form == ANY or form == PDF417:
-                # ~ pprint.pprint(data)
-                # ~ return self.decode_barcode(data)
-                try:
-                    return self.decode_barcode(data)
-                except (IndexError, AssertionError, ReadError) as e:
-                    log(e)
-                    raise ReadError("Unable to decode as barcode")
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_usa_date(date):
+    # MMDDCCYY
+    return datetime.date(int(date[4:8]), int(date[0:2]), int(date[2:4]))
 
-    def decode_magstripe(self, data):
-        fields = data.split("^")  # split the field seperators
-        # check for start of sentinel character
-        assert fields[0][0] == "%", "Missing start sentinel character (%)"
-        assert fields[0][0:3] != "%E?", "Error reading card"
-
-        state = fields[0][1:3]
-        city = fields[0][3:16]
-        if len(city) == 13 and "^" not in city:
-            # City maxes out at 13 characters, and excludes the field
-            # separator.  Thus, name will be in the first field.
-            # city+name+address together should be no longer than 77 chars.
-            name_pre = fields[0][16:]
-            address = fields[1].split("$")
-            # track 2 data will be one behind in this case
-            remaining = fields[2]
-        else:
-            name_pre = fields[1]
-            address = fields[2].split("$")[0]
-            remaining = fields[3]  # track 2 & 3
-
-        assert len(name_pre) > 0, "Empty name field"
-        assert "$" in name_pre, "Name field missing delimiter ($)"
-        # entire name field is 35 characters with delimiters
-        name = name_pre.split("$")
-        middle = None
-        if len(name) == 3:
-            middle = name[2]
-
-        remaining = remaining.split("?")[1:3]  # remove prepended end sentinel
-
-        # track 2 start sentinel character
-        assert remaining[0][0] == ";", "Missing track 2 start sentinel (;)"
-        track2 = remaining[0].strip(";")
-        track2 = track2.split("=")
-        track3 = remaining[1]
-
-        assert len(track2) == 2 or len(track2) == 3, "Invalid track 2 length"
-        issue_identifier = track2[0][0:6]
-        if len(track2) == 3:
-            # up to 13 digits, overflow for more at end of track 2.
-            # in this case there's no overflow, indicated by the extra = seperator.
-            license_number = track2[0][6:20]
-        else:
-            license_number = track2[0][6:20] + track2[1][13:25]
-
-        expiry_str = track2[1][0:4]  # e.g. 1310 for 31 October 2013
-        expiry = datetime.date(
-            2000 + int(expiry_str[0:2]), int(expiry_str[2:4]) + 1, 1
-        ) - datetime.timedelta(days=1)
-
-        dob_str = track2[1][4:12]  # e.g. 19850215
-        dob = datetime.date(int(dob_str[0:4]), int(
-            dob_str[4:6]), int(dob_str[6:8]))
-
-        # parse track3:
-        template = track3[
-            1:2
-        ]  # FIXME: according to A.4.3 should only be 0,2 but mine says 1
-        security = track3[
-            2:3
-        ]  # FIXME: docs says 1 character long but says 00-63 are valid values.
-        postal_code = track3[3:14].strip()  # remove space padding
-        license_class = track3[14:16].strip()
-        restrictions = track3[16:26].strip()
-        endorsements = track3[26:30].strip()  # according to ANSI-20 4.11.7
-        sex = track3[30:31]
-        height = track3[31:34].strip()
-        weight = track3[34:37].strip()  # lbs for US, kg for CA/MX
-        hair = track3[37:40]
-        eyes = track3[40:43]
-
-        # assert 'F' in sex or 'M' in sex, "Invalid sex %s" % sex
-        #assert height.isdigit() or height == "", "Invalid height"
-        #assert weight.isdigit() or weight == "", "Invalid weight"
-        # assert hair in HAIRCOLOURS, "Invalid hair colour %s" % hair
-        # assert eyes in EYECOLOURS, "Invalid eye colour %s" % eyes
-
-        # Since there's no way to determine if a magstripe is for USA or
-        # Canada, we'll just have to set a default and assume units:
-        # cast weight to Weight() type:
-        if weight != "":
-            weight = Weight(None, int(weight), "USA")
-        else:
-            weight is None
-        # cast height (Also assumes no one is taller than 9'11"
-        height = Height((int(height[0]) * 12) + int(height[1:]), "USA")
-
-        return {
-            "first": name[1],
-            "last": name[0],
-            "middle": middle,
-            "city": city,
-            "state": state,
-            "address": address,
-            "IIN": issue_identifier,
-            "license_number": license_number,
-            "expiry": expiry,
-            "dob": dob,
-            "ZIP": postal_code,
-            "class": license_class,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "issued": None,
-            "units": IMPERIAL,
-            "suffix": None,
-            "prefix": None,
-        }
 
-    def decode_barcode(self, data):
-        # header
-        segterm = PDF_SEGTERM
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_iso_date(date):
+    # CCYYMMDD
+    return datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8]))
 
-        # strip all before compliance character:
-        data = "@" + "@".join(data.split("@")[1:])
-        # check for compliance character:
-        assert data[0] == "@", "Missing compliance character (@)"
-        assert data[1] == PDF_LINEFEED, "Missing data element separator (LF)"
-        if data[2] == "\x1C":
-            # SCDMV sample deviates from standard here
-            log("RECORDSEP (0x1E) missing, got FS instead (0x1C, SCDMV)")
-            # segterm = '\x0a' # Have to override to work with SC old format
-        else:
-            assert (
-                data[2] == PDF_RECORDSEP
-            ), "Missing record separator (RS) got (%s)" % repr(data[2])
-        assert data[3] == PDF_SEGTERM, "Missing segment terminator (CR)"
-        assert (data[4:9] == PDF_FILETYPE) or (data[4:9] == "AAMVA"), (
-            'Wrong file type (got "%s", should be "ANSI ")' % data[4:9]
-        )
-        issue_identifier = data[9:15]
-        assert issue_identifier.isdigit(), "Issue Identifier is not an integer"
-        version = int(data[15:17])
-        assert version in PDF_VERSIONS, (
-            "Invalid data version number (got %s, should be 0 - 63)" % version
-        )
 
-        log("Format version: " + str(version))
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_expiry_month(date):
+    """
+    Magstripe expiry dates are YYMM, meaning the last day of that month
+    """
+    year = 2000 + int(date[0:2])
+    month = int(date[2:4])
+    if month == 12:
+        return datetime.date(year, 12, 31)
+    return datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
 
-        parsed_data = ""
-        subfiles_raw = []
-        rev_offset = 0
 
-        if version in (0, 1):
-            nEntries = data[17:19]
-            assert nEntries.isdigit(), "Number of entries is not an integer"
-            nEntries = int(nEntries)
-            log("Entries: " + str(nEntries))
-            # subfile designator
-            # FIXME could also be 'ID'
-            assert data[19:21] == "DL" or data[19:21] == "ID", (
-                "Not a driver's license (Got '%s', should be 'DL')" % data[19:21]
-            )
-            offset = data[21:25]
-            assert offset.isdigit(), "Subfile offset is not an integer"
-            offset = int(offset)
-            # FIXME Either MD or SC is off-by-one on this part of the standard
-            if issue_identifier in ("636005"):
-                offset += 1
-            length = data[25:29]
-            assert length.isdigit(), "Subfile length is not an integer"
-            length = int(length)
-            decode_function = self._decode_barcode_v1
-
-            # parse subfile designators
-            read_offset = 10
-            record_type = data[19:21]
-            beginning = data[offset: offset + length].strip("\r")
-            if not beginning.startswith(record_type):
-                beginning = record_type + beginning
-
-            subfiles_raw.append(beginning)
-
-            # parse subfile designators
-            for fileId in range(nEntries - 1):
-                # Read each subfile designator
-                log("=== Subfile {0} ===".format(fileId))
-                if record_type is None:  # Subfile type determines document type
-                    record_type = data[read_offset + 19: read_offset + 21]
-                offset = data[read_offset + 21: read_offset + 25]
-                length = data[read_offset + 25: read_offset + 29]
-                assert offset.isdigit(), "Subfile offset is not an integer"
-                assert length.isdigit(), "Subfile length is not an integer"
-                offset = int(offset)
-                length = int(length) + 2
-                log("Offset: {0}".format(offset))
-                log("Length: {0}".format(length))
-                subfiles_raw.append(
-                    data[offset: offset + length]
-                )  # suck in all of record
-                log(data[offset: offset + length])
-                log("=== End Subfile ===")
-                read_offset += 10
-
-        elif version in (2, 3, 4, 5, 6, 7, 8, 9):
-            # version 2 and later add a jurisdiction field
-            jurisdiction_version = data[17:19]
-            assert (
-                jurisdiction_version.isdigit()
-            ), "Jurisidiction version number is not an integer"
-            nEntries = data[19:21]
-            assert nEntries.isdigit(), "Number of entries is not an integer"
-            nEntries = int(nEntries)
-            log("Entries: " + str(nEntries))
-
-            # parse subfile designators
-            read_offset = 0
-            record_type = None
-
-            for fileId in range(nEntries):
-                # Read each subfile designator
-                log("=== Subfile {0} ===".format(fileId))
-                if record_type is None:  # Subfile type determines document type
-                    record_type = data[read_offset + 21: read_offset + 23]
-                offset = data[read_offset + 23: read_offset + 27]
-                length = data[read_offset + 27: read_offset + 31]
-                assert offset.isdigit(), "Subfile offset is not an integer"
-                assert length.isdigit(), "Subfile length is not an integer"
-                offset = int(offset)
-                length = int(length)
-                log("Offset: {0}".format(offset))
-                log("Length: {0}".format(length))
-                subfiles_raw.append(
-                    data[offset: offset + length]
-                )  # suck in all of record
-                log(data[offset: offset + length])
-                log("=== End Subfile ===")
-                read_offset += 10
-
-            # ~ assert data[21:23] == 'DL', \
-            # ~ "Not a driver's license (Got '%s', should be 'DL')" % data[21:23]
-            # ~ offset = data[23:27]
-            # ~ assert offset.isdigit(), 'Subfile offset is not an integer'
-            # ~ offset = int(offset)
-            # ~ print "Offset: " + str(offset)
-            # ~ length = data[27:31]
-            # ~ assert length.isdigit(), 'Subfile length is not an integer'
-            # ~ length = int(length)
-            # ~ print "Length: " + str(length)
-
-            if version == 3:
-                decode_function = self._decode_barcode_v3
-            if version == 4:
-                decode_function = self._decode_barcode_v4
-            if version == 5:
-                decode_function = self._decode_barcode_v5
-            if version == 6:
-                decode_function = self._decode_barcode_v6
-            if version == 7:
-                decode_function = (
-                    self._decode_barcode_v8
-                )  # FIXME: Seems to only be optional field changes
-            if version == 8:
-                decode_function = self._decode_barcode_v8
-            if version == 9:
-                decode_function = self._decode_barcode_v9
-
-        # Seperate out subfiles, removing trailing empty list
-        parsed_data = "\n".join(subfiles_raw)
-        parsed_data.strip("\n")
-        parsed_data = parsed_data.split(segterm)
-
-        parsed_data = "".join(parsed_data)
-
-        log(parsed_data)
-        subfile = parsed_data.split(PDF_LINEFEED)
-        if debug:
-            pprint.pprint(subfile)
+def _no_date(date):
+    return None
 
-        #assert subfile[0][:2] == "DL" or subfile[0][:2] == "ID", (
-        #    "Not a driver's license (Got '%s', should be 'DL')" % subfile[0][:2]
-        #)
-        subfile[0] = subfile[0][2:]  # remove prepended "DL"
-        subfile[-1] = subfile[-1].strip(segterm)
-        # Decode fields as a dictionary
-        fields = dict((key[0:3], key[3:].strip()) for key in subfile)
 
-        try:
-            return decode_function(fields, issue_identifier)
-        except UnboundLocalError:
-            raise NotImplemented(
-                "ERROR: Version {0} decoding not implemented!".format(version)
-            )
+# Date parser for each country or format name
+DATE_PARSERS = {
+    "USA": _parse_usa_date,
+    "ISO": _parse_iso_date,
+    "CAN": _parse_iso_date,
+}
 
-    def _decode_barcode_v0(self, data):
-        """Decodes a version 0 barcode specification (prior to 2000)"""
-        pass  # TODO
-
-    def _decode_barcode_v1(self, fields, issueIdentifier):
-        warnings = []
-        # Version 1 (AAMVA DL/ID-2000 standard)
-        try:  # Prefer the optional, field-seperated values
-            name = []
-            name[0] = fields["DAB"]  # Lastname, OPTIONAL 31
-            name[1] = fields["DAC"]  # Firstname, OPTIONAL 32
-            name[2] = fields["DAD"]  # Middle name/initial, OPTIONAL 33
-            nameSuffix = fields["DAE"]  # OPTIONAL 34
-            namePrefix = fields["DAF"]  # OPTIONAL 35
-        except KeyError:  # fall back on the required field
-            name = fields["DAA"].split(",")  # REQUIRED 1
-            nameSuffix = None
-            namePrefix = None
-
-        # Convert datetime objects
-        dba = fields["DBA"]  # Expiry date REQUIRED 11
-        expiry = datetime.date(int(dba[0:4]), int(dba[4:6]), int(dba[6:8]))
-        dbb = fields["DBB"]  # Date of Birth REQUIRED 12
-        dob = datetime.date(int(dbb[0:4]), int(dbb[4:6]), int(dbb[6:8]))
-        dbd = fields["DBD"]  # Document issue date REQUIRED 14
-        issued = datetime.date(int(dbd[0:4]), int(dbd[4:6]), int(dbd[6:8]))
-
-        sex = fields["DBC"]  # REQUIRED 13
-        if sex == "1":  # SCDMV v1 discrepancy
-            sex = "M"
-        elif sex == "2":
-            sex = "F"
-        assert "F" in sex or "M" in sex, "Invalid sex"
-
-        # Optional fields:
-        country = "USA"
-        try:
-            height = fields["DAV"]  # Prefer metric units OPTIONAL 42
-            weight = fields["DAX"]  # OPTIONAL 43
-            units = METRIC
-            country = "CAN"
-        except KeyError:
-            try:
-                height = fields["DAU"]  # U.S. imperial units OPTIONAL 20
-                weight = fields["DAW"]  # OPTIONAL 21
-                units = IMPERIAL
-            except KeyError:
-                # No height/weight defined (these fields are optional by the standard)
-                height = None
-                weight = None
-                units = None
-        finally:
-            pass
-            #assert height.isdigit() or height is not None, "Invalid height"
-            #assert weight.isdigit() or height is not None, "Invalid weight"
 
-        # weight is optional
-        if units == METRIC:
-            try:
-                weight = Weight(None, int(fields["DAX"]))
-            except KeyError:
-                weight = None
-        elif units == IMPERIAL:
-            try:
-                weight = Weight(None, int(fields["DAW"]), "USA")
-            except KeyError:
-                weight = None
+def parse_date(date, fmt="ISO"):
+    """
+    Parses a barcode date string in the layout used by `fmt`: MMDDCCYY for
+    "USA", CCYYMMDD for "ISO" or "CAN".  Returns None for any other format.
+    """
+    parser = DATE_PARSERS.get(fmt)
+    if parser is None:
+        parser = DATE_PARSERS.get(fmt.upper(), _no_date)
+    return parser(date)
 
-        try:
-            hair = fields["DAZ"].strip()
-            eyes = fields["DAY"].strip()
-        except KeyError:
-            hair = None
-            eyes = None
 
-        address2 = None  # (OPTIONAL 2009 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
+def parse_dates(dates, fmt="ISO"):
+    """
+    Parses a whole column of date strings in the layout used by `fmt`,
+    returning a list of dates.  Empty or missing values are returned as
+    None.
+    """
+    parser = DATE_PARSERS.get(fmt)
+    if parser is None:
+        parser = DATE_PARSERS.get(fmt.upper(), _no_date)
+    return [parser(date) if date else None for date in dates]
 
-        # assert hair in HAIRCOLOURS, "Invalid hair colour"
-        # assert eyes in EYECOLOURS, "Invalid eye colour"
 
-        # MD doesn't always encode restrictions (2015 license):
-        try:
-            restrictions = fields["DAS"].strip()
-        except:
-            restrictions = None
-            warnings.append("Missing required field: restrictions (DAS)")
-        try:
-            endorsements = fields["DAT"].strip()
-            card_type = "DL"
-        except:
-            restrictions = None
-            card_type = "ID"
-            warnings.append("Missing required field: endorsements (DAT)")
+def sniff_format(data):
+    """
+    Classifies raw input by its first non-blank characters: MAGSTRIPE for
+    a track 1 (%) or track 2 (;) start sentinel, PDF417 for the compliance
+    indicator and data element separator (@ and LF), or ANY if it could be
+    either.  Accepts the same input types as the decoders.
+    """
+    head = _buffer(data[:4]).lstrip()
+    if head[:1] in ("%", ";"):
+        return MAGSTRIPE
+    if head[:2] == "@" + PDF_LINEFEED:
+        return PDF417
+    return ANY
 
-        # Middle name not always encoded, or comma skipped:
-        if len(name) == 2:
-            name.append(None)
-
-        arrival_dates = {}
-
-        rv = {
-            "first": name[1].strip(),
-            "last": name[0].strip(),
-            "middle": name[2],
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "ZIP": fields["DAK"].strip(),
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "class": fields["DAR"].strip(),
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": nameSuffix,
-            "prefix": namePrefix,
-            "document": None,
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 1,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
-        return rv
 
-    def _decode_barcode_v3(self, fields, issueIdentifier):
-        warnings = []
-        if debug:
-            pprint.pprint(fields)
-        # required fields
-        country = fields["DCG"]  # USA or CAN
-
-        # convert dates
-        dba = fields["DBA"]  # expiry (REQUIRED REF d.)
-        expiry = self._parse_date(dba, country)
-        dbd = fields["DBD"]  # issue date (REQUIRED REF g.)
-        issued = self._parse_date(dbd, country)
-        dbb = fields["DBB"]  # date of birth (REQUIRED REF h.)
-        dob = self._parse_date(dbb, country)
-
-        # jurisdiction-specific (required for DL only):
-        try:
-            vehicle_class = fields["DCA"].strip()
-            restrictions = fields["DCB"].strip()
-            endorsements = fields["DCD"].strip()
-            card_type = DRIVER_LICENSE
-        except KeyError:
-            # not a DL, use None instead
-            vehicle_class = None
-            restrictions = None
-            endorsements = None
-            card_type = IDENTITY_CARD
-
-        # Physical description
-        sex = fields["DBC"]
-        assert sex in "129", "Invalid sex"
-        if sex == "1":
-            sex = MALE
-        if sex == "2":
-            sex = FEMALE
-        if sex == "9":
-            sex = NOT_SPECIFIED
-
-        # Some v.03 barcodes (Indiana) [wrongly, and stupidly] omit
-        # the mandatory height (DAU) field.
-        try:
-            # Normal v.03 barcodes:
-            height = fields["DAU"]
-            if height[-2:] == "in":  # inches
-                height = int(height[0:3])
-                units = IMPERIAL
-                height = Height(height, format="USA")
-            elif height[-2:].lower() == "cm":  # metric
-                height = int(height[0:3])
-                units = METRIC
-                height = Height(height)
-            else:
-                height = None
-                #raise AssertionError("Invalid unit for height")
-        except KeyError:
-            try:  # Indiana puts it in the jurisdiction field ZIJ
-                height = fields["ZIJ"].split("-")
-                units = IMPERIAL
-                height = Height(
-                    (int(height[0]) * 12) + int(height[1]), format="USA")
-            except KeyError:
-                # Give up on parsing height
-                log("ERROR: Unable to parse height.")
-                height = None
+def _buffer(data):
+    """
+    Returns str input as it is, and bytes or any other buffer (such as a
+    bytearray or memoryview) decoded to a str, so that the decoders only
+    ever have to deal with text.
+    """
+    if isinstance(data, str):
+        return data
+    return str(data, TEXT_ENCODING)
+
+
+""" Instrumentation """
+# Stage durations are only measured for decoders with an instrument.
+_clock = time.perf_counter
+
+
+def _lap(instrument, stage, start):
+    """Reports the time since `start` for a stage and returns the time now"""
+    now = _clock()
+    instrument(stage, now - start)
+    return now
+
+
+""" Magstripe decoding """
+# Fixed-width fields of track 3, counted from its start sentinel, read with
+# a single itemgetter call per swipe.  The template (1:2) and security (2:3)
+# characters in front of them aren't used.
+_TRACK3_FIELDS = operator.itemgetter(
+    slice(3, 14),  # postal code, space padded
+    slice(14, 16),  # license class
+    slice(16, 26),  # restrictions
+    slice(26, 30),  # endorsements, according to ANSI-20 4.11.7
+    slice(30, 31),  # sex
+    slice(31, 34),  # height, as FII
+    slice(34, 37),  # weight, lbs for US, kg for CA/MX
+    slice(37, 40),  # hair
+    slice(40, 43),  # eyes
+)
+# Track 2 is split in two by its field separator (=): the IIN and up to 14
+# characters of license number, then the expiry (YYMM) and date of birth.
+# A longer license number continues after the date of birth, unless the
+# track ends with a second field separator.
+_TRACK2_NUMBER = operator.itemgetter(slice(0, 6), slice(6, 20))
+_TRACK2_DATES = operator.itemgetter(slice(0, 4), slice(4, 12), slice(13, 25))
+# The city is up to 13 characters after the start sentinel and state, and
+# is followed by a field separator unless it uses all 13.
+_CITY_END = 16
+
+
+def _decode_swipe(data):
+    rv = _parse_swipe(data)
+    if isinstance(rv, ReadError):
+        raise rv
+    return rv
+
+
+def _parse_swipe(data):
+    """
+    Decodes a magstripe swipe, returning its dictionary or a ReadError
+    (which is returned rather than raised) if it is malformed
+    """
+    data = _buffer(data)
+    if data[:1] != "%":
+        return ReadError(
+            "Missing start sentinel character (%)", code=SWIPE_ERROR, offset=0
+        )
+    if data[:3] == "%E?":
+        return ReadError("Error reading card", code=CARD_ERROR, offset=0)
+
+    # end sentinels separate the tracks; the last one may be missing
+    tracks = data.split("?", 3)
+    if len(tracks) < 3:
+        return ReadError(
+            "Missing end sentinel (?)", code=SWIPE_ERROR, offset=len(data)
+        )
+    track2 = tracks[1]
+    track3 = tracks[2]
+    track2_start = len(tracks[0]) + 1
+    track3_start = track2_start + len(track2) + 1
+
+    fields = tracks[0].split("^", 3)
+    head = fields[0]
+    state = head[1:3]
+    if len(head) > _CITY_END:
+        # a 13 character city runs straight into the name.  city, name and
+        # address together should be no longer than 77 characters.
+        city = head[3:_CITY_END]
+        name = head[_CITY_END:]
+        address = fields[1] if len(fields) > 1 else None
+    else:
+        city = head[3:]
+        name = fields[1] if len(fields) > 1 else ""
+        address = fields[2] if len(fields) > 2 else None
+    if address is None:
+        return ReadError(
+            "Missing field separator (^)", code=SWIPE_ERROR, offset=len(tracks[0])
+        )
+    address = address.split("$", 1)[0]
 
-        # Eye colour is mandatory
-        eyes = fields["DAY"]
-        assert eyes in EYECOLOURS, "Invalid eye colour: {0}".format(eyes)
+    if len(name) == 0:
+        return ReadError("Empty name field", code=SWIPE_ERROR, offset=len(head) + 1)
+    if "$" not in name:
+        return ReadError(
+            "Name field missing delimiter ($)", code=SWIPE_ERROR, offset=len(head) + 1
+        )
+    # entire name field is 35 characters with delimiters
+    name = name.split("$")
+    middle = None
+    if len(name) == 3:
+        middle = name[2]
+
+    if track2[:1] != ";":
+        return ReadError(
+            "Missing track 2 start sentinel (;)", code=SWIPE_ERROR, offset=track2_start
+        )
+    track2 = track2[1:].split("=")
+    if len(track2) != 2 and len(track2) != 3:
+        return ReadError(
+            "Invalid track 2 length", code=SWIPE_ERROR, offset=track2_start
+        )
+    issue_identifier, license_number = _TRACK2_NUMBER(track2[0])
+    expiry, dob, overflow = _TRACK2_DATES(track2[1])
+    if len(track2) == 2:
+        license_number += overflow
+    if not (expiry.isdigit() and len(expiry) == 4 and dob.isdigit() and len(dob) == 8):
+        return ReadError(
+            "Invalid track 2 dates",
+            code=ELEMENT_ERROR,
+            offset=track2_start + len(track2[0]) + 2,
+        )
 
-        # But hair colour is optional for some reason in this version
-        try:
-            hair = fields["DAZ"]
-            assert hair in HAIRCOLOURS, "Invalid hair colour: {0}".format(hair)
-        except KeyError:
-            try:  # Indiana
-                hair = fields["ZIL"]
-                assert hair in HAIRCOLOURS, "Invalid hair colour: {0}".format(
-                    hair)
-            except KeyError:
-                hair = None
+    (
+        postal_code,
+        license_class,
+        restrictions,
+        endorsements,
+        sex,
+        height,
+        weight,
+        hair,
+        eyes,
+    ) = _TRACK3_FIELDS(track3)
+
+    # Since there's no way to determine if a magstripe is for USA or
+    # Canada, we'll just have to set a default and assume units.
+    # Height is FII (this assumes no one is taller than 9'11")
+    height = height.strip()
+    if len(height) < 2 or not height.isdigit():
+        return ReadError("Invalid height", code=ELEMENT_ERROR, offset=track3_start + 31)
+    height = Height(int(height[0]) * 12 + int(height[1:]), IMPERIAL)
+    weight = weight.strip()
+    if weight and not weight.isdigit():
+        return ReadError("Invalid weight", code=ELEMENT_ERROR, offset=track3_start + 34)
+    weight = Weight(None, int(weight), IMPERIAL) if weight else None
+
+    return {
+        "first": name[1],
+        "last": name[0],
+        "middle": middle,
+        "city": city,
+        "state": state,
+        "address": address,
+        "IIN": issue_identifier,
+        "license_number": license_number,
+        "expiry": _parse_expiry_month(expiry),  # e.g. 1310 for 31 October 2013
+        "dob": _parse_iso_date(dob),  # e.g. 19850215
+        "ZIP": postal_code.strip(),  # remove space padding
+        "class": license_class.strip(),
+        "restrictions": restrictions.strip(),
+        "endorsements": endorsements.strip(),
+        "sex": sex,
+        "height": height,
+        "weight": weight,
+        "hair": hair,
+        "eyes": eyes,
+        "issued": None,
+        "units": IMPERIAL,
+        "suffix": None,
+        "prefix": None,
+    }
 
-        # name suffix optional. No prefix field in this version.
-        try:
-            name_suffix = fields["DCU"].strip()
-        except KeyError:
-            name_suffix = None
 
-        # Try weight range
-        try:
-            weight = fields["DCE"]
-            if units == METRIC:
-                weight = Weight(int(weight), format="ISO")
-            elif units == IMPERIAL:
-                weight = Weight(int(weight), format="USA")
-        except KeyError:
-            try:  # Indiana again
-                weight = fields["ZIK"]
-                assert weight.isdigit(
-                ), "Weight is non-integer: {0}".format(weight)
-                weight = Weight(int(weight), format="USA")
-            except KeyError:
-                weight = None  # Give up
+class AAMVA:
+    def __init__(
+        self,
+        data=None,
+        format=[ANY],
+        strict=True,
+        lazy=False,
+        records=False,
+        cache=None,
+        instrument=None,
+    ):
+        if isinstance(format, str):
+            raise TypeError("format must be a list of formats, not a string")
+        self.format = format
+        self.data = data
+        self.strict = strict
+        self.lazy = lazy
+        self.records = records
+        self.cache = cache
+        self.instrument = instrument
+        self._plans = {}  # resolved format plans, keyed by format
 
-        # Abstract the name field:
-        names = fields["DCT"].split(",")
-        firstname = names[0].strip()
-        if len(names) == 1:  # No middle name
-            middlename = None
-        else:
-            middlename = ", ".join(names[1:]).strip()
-
-        # Indiana, again, uses spaces instead
-        if "," not in fields["DCT"]:
-            names = fields["DCT"].split(" ")
-            firstname = names[0].strip()
-            if len(names) == 1:
-                middlename = None
-            else:
-                middlename = " ".join(names[1:]).strip()
-
-        address2 = None  # (OPTIONAL 2009 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
-
-        arrival_dates = {}
-
-        lastname = fields["DCS"].strip()  # (REQUIRED 2005 e)
-
-        rv = {
-            "first": firstname,
-            "last": lastname,
-            "middle": middlename,
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "ZIP": fields["DAK"].strip(),
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "class": vehicle_class,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": name_suffix,
-            "prefix": None,
-            "document": fields["DCF"].strip(),  # Mandatory 2005 q.
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 3,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
-        return rv
+    def decode(self, data=None):
+        """
+        Decodes data from a string and returns a dictionary of values.
+        Data is decoded in the format preference specified in the constructor.
+        Missing or empty fields will usually be represented by 'None' type.
+        Note that the issue date is missing from the magstripe encoding, and
+        will always be represented by 'None'.
+        """
+        if data is None:
+            data = self.data
+        if data is None:
+            raise ValueError("No data to parse")
 
-    def _decode_barcode_v4(self, fields, issueIdentifier):
-        warnings = []
-        # required fields
-        country = fields["DCG"]  # USA or CAN
+        result = self.try_decode(data)
+        if isinstance(result, ReadError):
+            raise result
+        return result
 
-        # convert dates
-        dba = fields["DBA"]  # expiry (REQUIRED REF d.)
-        expiry = self._parse_date(dba, country)
-        dbd = fields["DBD"]  # issue date (REQUIRED REF g.)
-        issued = self._parse_date(dbd, country)
-        dbb = fields["DBB"]  # date of birth (REQUIRED REF h.)
-        dob = self._parse_date(dbb, country)
+    def try_decode(self, data=None):
+        """
+        Decodes data as decode() does, but returns a ReadError in place of
+        the dictionary instead of raising it if the data can't be decoded.
+        The error's `code` and `offset` say what was wrong and where.
+        Malformed scans are validated without raising exceptions wherever
+        they can be, so this is the cheaper way to handle frequent bad reads.
+        """
+        if data is None:
+            data = self.data
+        if data is None:
+            raise ValueError("No data to parse")
 
-        # jurisdiction-specific (required for DL only):
+        key = tuple(self.format)
         try:
-            vehicleClass = fields["DCA"].strip()
-            restrictions = fields["DCB"].strip()
-            endorsements = fields["DCD"].strip()
-            card_type = DRIVER_LICENSE
+            plan = self._plans[key]
         except KeyError:
-            # not a DL, use None instead
-            vehicleClass = None
-            restrictions = None
-            endorsements = None
-            card_type = IDENTITY_CARD
-
-        # Physical description
-        sex = fields["DBC"]
-        assert sex in "129", "Invalid sex"
-        if sex == "1":
-            sex = MALE
-        if sex == "2":
-            sex = FEMALE
-        if sex == "9":
-            sex = NOT_SPECIFIED
-
-        height = fields["DAU"]
-        if height[-2:].lower() == "cm":  # metric
-            height = int(height[0:3])
-            units = METRIC
-            height = Height(height)
-        elif height[-1] == '"':
-            # US height encoding for some implementations of this version is feet and inches
-            # (e.g. 6'-01"")
-            feet = int(height[0])
-            inches = int(height[3:5])
-            units = IMPERIAL
-            height = Height((feet * 12 + inches), format="USA")
-        elif height[-2:].lower() == "in":
-            height = int(height[0:3])
-            units = IMPERIAL
-            height = Height(height, format="USA")
-        else:
-            height = None
-            #raise AssertionError("Invalid unit for height")
+            # another thread may be resolving the same plan, which is fine
+            plan = self._plans.setdefault(key, self._resolve_formats())
+        return self._decode(plan, data)
 
-        # weight is optional
-        if units == METRIC:
-            try:
-                weight = Weight(None, int(fields["DAX"]))
-            except KeyError:
-                weight = None
-        elif units == IMPERIAL:
-            try:
-                weight = Weight(None, int(fields["DAW"]), "USA")
-            except KeyError:
-                weight = None
-        if weight is None:
-            # Try weight range
+    def decode_many(self, iterable):
+        """
+        Decodes each item of an iterable in turn, yielding one dictionary per
+        item in input order.  The format preference is resolved once for the
+        whole batch.  An item that cannot be decoded yields a ReadError in
+        place of its dictionary so that one bad scan doesn't stop the run.
+        """
+        plan = self._resolve_formats()
+        for data in iterable:
             try:
-                weight = fields["DCE"]
-                if units == METRIC:
-                    weight = Weight(int(weight), format="ISO")
-                elif units == IMPERIAL:
-                    weight = Weight(int(weight), format="USA")
-            except KeyError:
-                weight = None
+                result = self._decode(plan, data)
+            except Exception as e:
+                result = ReadError(e)
+                result.__cause__ = e
+            yield result
 
-        # Hair/eye colour are mandatory, but some (NJ) don't encode hair colour
-        try:
-            hair = fields["DAZ"]
-            if hair not in HAIRCOLOURS:
-                warnings.append("Invalid hair colour: {0}".format(hair))
-        except KeyError:
-            hair = None
-            warnings.append("Missing mandatory field: hair colour (DAZ)")
-        try:
-            eyes = fields["DAY"]
-            if eyes not in EYECOLOURS:
-                warnings.append("Invalid eye colour: {0}".format(eyes))
-        except KeyError:
-            eyes = None
-            warnings.append("Missing mandatory field: hair colour (DAZ)")
+    def _resolve_formats(self):
+        """
+        Resolves the format preference specified in the constructor into a
+        plan: for each format that sniff_format() can return, an ordered list
+        of (decode function, fatal, error message, stage name) steps.  A
+        failed step that isn't fatal continues to the next format; otherwise
+        the failure is returned as a ReadError with the given message (and
+        the code and offset of the original error), or the original error if
+        there is none.  Decode functions return their ReadErrors rather than
+        raising them.
+
+        Input that is recognisably a magstripe or a barcode only runs the
+        steps for that format, so a barcode read with format ANY doesn't
+        pay for a failed magstripe decode first.  Ambiguous input, or input
+        that matches none of the preferred formats, runs every step.
+        """
+        steps = []
+        for form in self.format:
+            if form == ANY or form == MAGSTRIPE:
+                steps.append(
+                    (self._try_magstripe, form == MAGSTRIPE, None, "magstripe")
+                )
+            if form == ANY or form == PDF417:
+                steps.append(
+                    (
+                        self._try_barcode,
+                        True,
+                        "Unable to decode as barcode",
+                        "barcode",
+                    )
+                )
+        plan = {ANY: steps}
+        for form, stage in ((MAGSTRIPE, "magstripe"), (PDF417, "barcode")):
+            matching = [step for step in steps if step[3] == stage]
+            if matching:
+                # there's nothing left to fall back on
+                decode_function, fatal, message, stage = matching[-1]
+                matching[-1] = (decode_function, True, message, stage)
+                plan[form] = matching
+            else:
+                plan[form] = steps
+        return plan
 
-        # name suffix optional. No prefix field in this version.
-        try:
-            name_suffix = fields["DCU"].strip()
-        except KeyError:
-            name_suffix = None
-
-        address2 = None  # (OPTIONAL 2009 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
-
-        lastname = fields["DCS"].strip()  # (REQUIRED 2005 e)
-        firstname = fields["DAC"].strip()  # (REQUIRED 2005 f)
-        arrival_dates = {}
-
-        rv = {
-            "first": fields["DAC"].strip(),
-            "last": fields["DCS"].strip(),
-            "middle": fields["DAD"].strip(),
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "ZIP": fields["DAK"].strip(),
-            "class": vehicleClass,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": name_suffix,
-            "prefix": None,  # Removed from this version
-            "document": fields["DCF"].strip(),
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 4,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
-        return rv
+    def _decode(self, plan, data):
+        instrument = self.instrument
+        if instrument is not None:
+            return self._decode_timed(plan, data, instrument)
+        return self._decode_cached(plan, data)
 
-    def _decode_barcode_v5(self, fields, issueIdentifier):
-        warnings = []
-        # required fields
-        country = fields["DCG"]  # USA or CAN
-
-        # convert dates
-        dba = fields["DBA"]  # expiry (REQUIRED REF d.)
-        expiry = self._parse_date(dba, country)
-        dbd = fields["DBD"]  # issue date (REQUIRED REF g.)
-        issued = self._parse_date(dbd, country)
-        dbb = fields["DBB"]  # date of birth (REQUIRED REF h.)
-        dob = self._parse_date(dbb, country)
-
-        # jurisdiction-specific (required for DL only):
-        # FIXME - check if fields are empty
+    def _decode_timed(self, plan, data, instrument):
+        start = _clock()
         try:
-            vehicleClass = fields["DCA"].strip()
-            restrictions = fields["DCB"].strip()
-            endorsements = fields["DCD"].strip()
-            card_type = DRIVER_LICENSE
-        except KeyError:
-            # not a DL, use None instead
-            vehicleClass = None
-            restrictions = None
-            endorsements = None
-            card_type = IDENTITY_CARD
-
-        # Physical description
-        sex = fields["DBC"]
-        assert sex in "129", "Invalid sex"
-        if sex == "1":
-            sex = MALE
-        if sex == "2":
-            sex = FEMALE
-        if sex == "9":
-            sex == NOT_SPECIFIED
-
-        height = fields["DAU"]
-        if height[-2:] == "in":  # inches
-            height = int(height[0:3])
-            units = IMPERIAL
-            height = Height(height, format="USA")
-        elif height[-2:].lower() == "cm":  # metric
-            height = int(height[0:3])
-            units = METRIC
-            height = Height(height)
+            result = self._decode_cached(plan, data)
+        except Exception:
+            instrument("error", _clock() - start)
+            raise
+        if isinstance(result, ReadError):
+            instrument("error", _clock() - start)
         else:
-            height = None
-            #raise AssertionError("Invalid unit for height")
-
-        # weight is optional
-        if units == METRIC:
-            try:
-                weight = Weight(None, int(fields["DAX"]))
-            except KeyError:
-                weight = None
-        elif units == IMPERIAL:
-            try:
-                weight = Weight(None, int(fields["DAW"]), "USA")
-            except KeyError:
-                weight = None
-        if weight is None:
-            # Try weight range
-            try:
-                weight = fields["DCE"]
-                if units == METRIC:
-                    weight = Weight(int(weight), format="ISO")
-                elif units == IMPERIAL:
-                    weight = Weight(int(weight), format="USA")
-            except KeyError:
-                weight = None
-
-        # Hair/eye colour are mandatory
-        hair = fields.get("DAZ")
-        eyes = fields.get("DAY")
-        #assert hair in HAIRCOLOURS, "Invalid hair colour: {0}".format(eyes)
-        #assert eyes in EYECOLOURS, "Invalid eye colour: {0}".format(hair)
+            instrument("decode", _clock() - start)
+        return result
+
+    def _decode_cached(self, plan, data):
+        data = _buffer(data)
+        steps = plan[sniff_format(data)]
+        cache = self.cache
+        if cache is None:
+            return self._decode_steps(steps, data)
+        # results depend on the decoder's settings as well as the input
+        key = (cache.digest(data), tuple(self.format), self.lazy, self.records)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = self._decode_steps(steps, data)
+            if not isinstance(result, ReadError):
+                cache.put(key, result)
+        return result
+
+    def _decode_steps(self, steps, data):
+        instrument = self.instrument
+        for decode_function, fatal, message, stage in steps:
+            if instrument is not None:
+                start = _clock()
+            result = decode_function(data)
+            if isinstance(result, ReadError):
+                if instrument is not None:
+                    instrument(stage + "_failed", _clock() - start)
+                if not fatal:
+                    continue  # fail silently and continue to the next format
+                log(result)
+                if message is None:
+                    return result
+                error = ReadError(message, code=result.code, offset=result.offset)
+                error.__cause__ = result
+                return error
+            if instrument is not None:
+                instrument(stage, _clock() - start)
+            return result
 
-        # name suffix optional. No prefix field in this version.
-        try:
-            nameSuffix = fields["DCU"].strip()
-        except KeyError:
-            nameSuffix = None
-
-        # v5 adds optional date fields DDH, DDI, and DDJ (Under 18/19/21 until)
-        arrival_dates = {}
-        if "DDH" in list(fields.keys()):
-            arrival_dates["under_18_until"] = self._parse_date(fields["DDH"])
-        if "DDI" in list(fields.keys()):
-            arrival_dates["under_19_until"] = self._parse_date(fields["DDI"])
-        if "DDJ" in list(fields.keys()):
-            arrival_dates["under_21_until"] = self._parse_date(fields["DDJ"])
-
-        address2 = None  # (OPTIONAL 2009 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
-
-        rv = {
-            "first": fields["DAC"].strip(),
-            "last": fields["DCS"].strip(),
-            "middle": fields["DAD"].strip(),
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "ZIP": fields["DAK"].strip(),
-            "class": vehicleClass,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": nameSuffix,
-            "prefix": None,
-            "document": fields["DCF"].strip(),
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 5,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
+    def decode_magstripe(self, data):
+        rv = _decode_swipe(data)
+        if self.records:
+            return License.from_dict(rv)
         return rv
 
-    def _decode_barcode_v6(self, fields, issueIdentifier):  # 2011 standard
-        warnings = []
-        # required fields
-        country = fields["DCG"]  # USA or CAN
-
-        # 2011 e, f, g, are required name fields
-        lastname = fields["DCS"].strip()  # (REQUIRED 2011 e)
-        firstname = fields["DAC"].strip()  # (REQUIRED 2011 f)
-        middlename = fields["DAD"].strip()  # (REQUIRED 2011 g)
-
-        # 2011 t, u, and v indicate if names are truncated:
-        if fields["DDE"] == "T":
-            lastname += "…"
-        if fields["DDF"] == "T":
-            firstname += "…"
-        if fields["DDG"] == "T":
-            middlename += "…"
-
-        # convert dates
-        dba = fields["DBA"]  # expiry (REQUIRED 2011 d.)
-        expiry = self._parse_date(dba, country)
-        dbd = fields["DBD"]  # issue date (REQUIRED 2011 h.)
-        issued = self._parse_date(dbd, country)
-        dbb = fields["DBB"]  # date of birth (REQUIRED 2011 i.)
-        dob = self._parse_date(dbb, country)
-
-        # jurisdiction-specific (required for DL only):
-        # FIXME - check if fields are empty
+    def _try_magstripe(self, data):
         try:
-            vehicle_class = fields["DCA"].strip()  # (REQUIRED 2011 a.)
-            restrictions = fields["DCB"].strip()  # (REQUIRED 2011 b.)
-            endorsements = fields["DCD"].strip()  # (REQUIRED 2011 c.)
-            card_type = DRIVER_LICENSE
-        except KeyError:
-            # not a DL, use None instead
-            vehicle_class = None
-            restrictions = None
-            endorsements = None
-            card_type = IDENTITY_CARD
-
-        # Physical description
-        sex = fields["DBC"]  # (REQUIRED 2011 j.)
-        assert sex in "12", "Invalid sex"
-        if sex == "1":
-            sex = MALE
-        if sex == "2":
-            sex = FEMALE
-        if sex == "9":
-            sex = NOT_SPECIFIED
-
-        eyes = fields["DAY"]  # (REQUIRED 2011 k.)
-        assert eyes in EYECOLOURS, "Invalid eye colour: {0}".format(eyes)
-
-        height = fields["DAU"]  # (REQUIRED 2011 l.)
-        if height[-2:] == "in":  # inches
-            height = int(height[0:3])
-            units = IMPERIAL
-            height = Height(height, format="USA")
-        elif height[-2:].lower() == "cm":  # metric
-            height = int(height[0:3])
-            units = METRIC
-            height = Height(height)
-        else:
-            height = None
-            #raise AssertionError("Invalid unit for height")
-
-        # 2011 m, n, o, p, are required address elements
-
-        # weight is optional
-        if units == METRIC:
-            try:
-                weight = Weight(None, int(fields["DAX"]))
-            except KeyError:
-                weight = None
-        elif units == IMPERIAL:
-            try:
-                weight = Weight(None, int(fields["DAW"]), "USA")
-            except KeyError:
-                weight = None
-        if weight is None:
-            # Try weight range
+            rv = _parse_swipe(data)
+        except _FIELD_ERRORS as e:  # e.g. a date that doesn't exist
+            rv = ReadError(e, code=ELEMENT_ERROR)
+            rv.__cause__ = e
+        if isinstance(rv, ReadError) or not self.records:
+            return rv
+        return License.from_dict(rv)
+
+    def decode_magstripes(self, iterable):
+        """
+        Decodes each swipe of an iterable as a magstripe, yielding one
+        dictionary (or License) per swipe in input order.  Unlike
+        decode_many() there is no format sniffing, fallback or caching, so
+        this is the fastest way through a batch that is known to be all
+        magstripes.  A swipe that cannot be decoded yields a ReadError.
+        """
+        for data in iterable:
             try:
-                weight = fields["DCE"]
-                if units == METRIC:
-                    weight = Weight(int(weight), format="ISO")
-                elif units == IMPERIAL:
-                    weight = Weight(int(weight), format="USA")
-            except KeyError:
-                weight = None
+                rv = self._try_magstripe(data)
+            except Exception as e:
+                rv = ReadError(e)
+                rv.__cause__ = e
+            if isinstance(rv, ReadError):
+                log(rv)
+            yield rv
 
-        # optional fields:
-        address2 = None  # (OPTIONAL 2011 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
-
-        hair = None  # (OPTIONAL 2011 b.)
-        if "DAZ" in list(fields.keys()):
-            hair = fields["DAZ"]  # Optional
-            assert hair in HAIRCOLOURS, "Invalid hair colour: {0}".format(hair)
+    def decode_barcode(self, data):
+        rv = self._decode_barcode(_buffer(data), False)
+        if isinstance(rv, ReadError):
+            raise rv
+        return rv
 
-        # TODO: OPTIONAL 2011 fields c - h
+    def _try_barcode(self, data):
+        return self._decode_barcode(data, True)
 
-        # name suffix optional. No prefix field in this version.
+    def _decode_barcode(self, data, capture):
+        """
+        Decodes a PDF417 payload, returning a ReadError for a malformed
+        header or directory or an unsupported version.  Errors converting
+        the data elements are raised as they are, or returned as a ReadError
+        with the offset of the element at fault if `capture` is true.
+        """
+        instrument = self.instrument
+        if instrument is not None:
+            start = _clock()
+        header = self._parse_header(data)
+        if isinstance(header, ReadError):
+            return header
+        issue_identifier, version, jurisdiction_version, subfiles = header
+        if instrument is not None:
+            start = _lap(instrument, "header", start)
+
+        # Jurisdiction-specific (Z) subfiles are kept as spans and are only
+        # decoded if they're read.
+        standard = []
+        jurisdiction = {}
+        for subfile in subfiles:
+            if subfile[0][:1] == "Z":
+                jurisdiction.setdefault(subfile[0], subfile[1:])
+            else:
+                standard.append(subfile)
+
+        # Decode fields as a dictionary, one subfile span at a time
+        fields = {}
+        for subfile in standard:
+            fields.update(_subfile_elements(data, *subfile))
+        fields[_JURISDICTION] = JurisdictionSubfiles(
+            issue_identifier, data, jurisdiction
+        )
+        if instrument is not None:
+            start = _lap(instrument, "elements", start)
+        if debug:
+            log(pprint.pformat(fields))
+
+        getters = BARCODE_SPECS.get(version)
+        if getters is None:
+            return ReadError(
+                "Version {0} decoding not implemented".format(version),
+                code=VERSION_ERROR,
+                offset=data.find("@") + 15,
+            )
+        if not standard:
+            return ReadError(
+                "Missing DL/ID subfile",
+                code=DIRECTORY_ERROR,
+                offset=subfiles[0][1] if subfiles else None,
+            )
+        if self.lazy and not self.records:
+            return LazyRecord(getters, fields, issue_identifier, version)
+        rv = {"IIN": issue_identifier, "version": version}
         try:
-            nameSuffix = fields["DCU"].strip()  # (OPTIONAL 2011 i.)
-        except KeyError:
-            nameSuffix = None
-
-        # TODO: OPTIONAL 2011 fields j - u
-
-        # v6 adds optional date fields DDH, DDI, and DDJ (Under 18/19/21 until)
-        arrival_dates = {}
-        if "DDH" in list(fields.keys()):
-            arrival_dates["under_18_until"] = self._parse_date(fields["DDH"])
-        if "DDI" in list(fields.keys()):
-            arrival_dates["under_19_until"] = self._parse_date(fields["DDI"])
-        if "DDJ" in list(fields.keys()):
-            arrival_dates["under_21_until"] = self._parse_date(fields["DDJ"])
-
-        # TODO: OPTIONAL 2011 field a.a.
-
-        rv = {
-            "first": firstname,
-            "last": lastname,
-            "middle": middlename,
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "ZIP": fields["DAK"].strip(),
-            "class": vehicle_class,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": nameSuffix,
-            "prefix": None,
-            "document": fields["DCF"].strip(),
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 7,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
+            if instrument is None:
+                _decode_fields(getters, fields, rv)
+            else:
+                _decode_fields_timed(getters, fields, rv, instrument)
+        except _FIELD_ERRORS as e:
+            if not capture:
+                raise
+            return _field_error(e, getters, rv, data, standard[0])
+        if self.records:
+            return License.from_dict(rv, jurisdiction_version)
         return rv
 
-    def _decode_barcode_v8(self, fields, issueIdentifier):  # 2013 standard
-        warnings = []
-        # required fields
-        country = fields["DCG"]  # USA or CAN
-
-        # 2013 e, f, g, are required name fields
-        lastname = fields["DCS"].strip()  # (REQUIRED 2013 e)
-        firstname = fields["DAC"].strip()  # (REQUIRED 2013 f)
-        middlename = fields["DAD"].strip()  # (REQUIRED 2013 g)
-
-        # 2013 t, u, and v indicate if names are truncated:
-        if fields["DDE"] == "T":
-            lastname += "…"
-        if fields["DDF"] == "T":
-            firstname += "…"
-        if fields["DDG"] == "T":
-            middlename += "…"
-
-        # convert dates
-        dba = fields["DBA"]  # expiry (REQUIRED 2013 d.)
-        expiry = self._parse_date(dba, country)
-        dbd = fields["DBD"]  # issue date (REQUIRED 2013 h.)
-        issued = self._parse_date(dbd, country)
-        dbb = fields["DBB"]  # date of birth (REQUIRED 2013 i.)
-        dob = self._parse_date(dbb, country)
-
-        # jurisdiction-specific (required for DL only):
-        # FIXME - check if fields are empty
-        try:
-            vehicle_class = fields["DCA"].strip()  # (REQUIRED 2013 a.)
-            restrictions = fields["DCB"].strip()  # (REQUIRED 2013 b.)
-            endorsements = fields["DCD"].strip()  # (REQUIRED 2013 c.)
-            card_type = DRIVER_LICENSE
-        except KeyError:
-            # not a DL, use None instead
-            vehicle_class = None
-            restrictions = None
-            endorsements = None
-            card_type = IDENTITY_CARD
-
-        # Physical description
-        sex = fields["DBC"]  # (REQUIRED 2013 j.)
-        assert sex in "129", "Invalid sex"
-        if sex == "1":
-            sex = MALE
-        if sex == "2":
-            sex = FEMALE
-        if sex == "9":
-            sex = NOT_SPECIFIED
-
-        eyes = fields["DAY"]  # (REQUIRED 2013 k.)
-        assert eyes in EYECOLOURS, "Invalid eye colour: {0}".format(eyes)
-
-        height = fields["DAU"]  # (REQUIRED 2013 l.)
-        if height[-2:] == "in":  # inches
-            height = int(height[0:3])
-            units = IMPERIAL
-            height = Height(height, format="USA")
-        elif height[-2:].lower() == "cm":  # metric
-            height = int(height[0:3])
-            units = METRIC
-            height = Height(height)
-        else:
-            height = None
-            #raise AssertionError("Invalid unit for height")
+    def peek_header(self, data):
+        """
+        Reads only the header of a PDF417 payload, returning a Header with its
+        issuer identification number, AAMVA version and jurisdiction version
+        without decoding any of the subfiles.
+        """
+        data = _buffer(data)
+        issue_identifier, version, jurisdiction_version, subfiles = self._read_header(
+            data
+        )
+        return Header(issue_identifier, version, jurisdiction_version)
 
-        # 2013 m, n, o, p, are required address elements
+    def peek_key(self, data):
+        """
+        Returns an (issuer identification number, license number) tuple for a
+        PDF417 payload, finding the license number (DAQ) with a single scan
+        of the DL/ID subfile instead of decoding it.  The license number is
+        None if the element isn't present.
+        """
+        data = _buffer(data)
+        issue_identifier, version, jurisdiction_version, subfiles = self._read_header(
+            data
+        )
+        if not subfiles:
+            return issue_identifier, None
+        return issue_identifier, _find_element(data, subfiles[0], "DAQ")
 
-        # weight is optional
-        if units == METRIC:
-            try:
-                weight = Weight(None, int(fields["DAX"]))
-            except KeyError:
-                weight = None
-        elif units == IMPERIAL:
-            try:
-                weight = Weight(None, int(fields["DAW"]), "USA")
-            except KeyError:
-                weight = None
-        if weight is None:
-            # Try weight range
-            try:
-                weight = fields["DCE"]
-                if units == METRIC:
-                    weight = Weight(int(weight), format="ISO")
-                elif units == IMPERIAL:
-                    weight = Weight(int(weight), format="USA")
-            except KeyError:
-                weight = None
+    @staticmethod
+    def _read_header(data):
+        """
+        Validates the header of a PDF417 payload and reads the subfile
+        designators that follow it.  Returns a tuple of (issuer identification
+        number, AAMVA version, jurisdiction version, subfiles), where subfiles
+        is a list of (type, start, end) spans into data.  The payload must
+        be a string (see _buffer()).
+        Raises ReadError if the header is malformed.
+        """
+        header = AAMVA._parse_header(data)
+        if isinstance(header, ReadError):
+            raise header
+        return header
 
-        # optional fields:
-        address2 = None  # (OPTIONAL 2013 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
+    @staticmethod
+    def _parse_header(data):
+        """
+        Reads the header of a PDF417 payload as _read_header() does, but
+        returns the ReadError for a malformed header instead of raising it
+        """
+        # skip anything before the compliance character:
+        base = data.find("@")
+        # check for compliance character:
+        if base < 0:
+            return ReadError(
+                "Missing compliance character (@)", code=HEADER_ERROR, offset=0
+            )
+        if data[base + 1: base + 2] != PDF_LINEFEED:
+            return ReadError(
+                "Missing data element separator (LF)",
+                code=HEADER_ERROR,
+                offset=base + 1,
+            )
+        if data[base + 2: base + 3] == PDF_FILESEP:
+            # SCDMV sample deviates from standard here
+            log("RECORDSEP (0x1E) missing, got FS instead (0x1C, SCDMV)")
+        elif data[base + 2: base + 3] != PDF_RECORDSEP:
+            return ReadError(
+                "Missing record separator (RS) got (%s)"
+                % repr(data[base + 2: base + 3]),
+                code=HEADER_ERROR,
+                offset=base + 2,
+            )
+        if data[base + 3: base + 4] != PDF_SEGTERM:
+            return ReadError(
+                "Missing segment terminator (CR)", code=HEADER_ERROR, offset=base + 3
+            )
+        filetype = data[base + 4: base + 9]
+        if filetype not in (PDF_FILETYPE, "AAMVA"):
+            return ReadError(
+                'Wrong file type (got "%s", should be "ANSI ")' % filetype,
+                code=HEADER_ERROR,
+                offset=base + 4,
+            )
+        issue_identifier = data[base + 9: base + 15]
+        if len(issue_identifier) != 6 or not issue_identifier.isdigit():
+            return ReadError(
+                "Issue Identifier is not an integer", code=HEADER_ERROR, offset=base + 9
+            )
+        version = data[base + 15: base + 17]
+        if len(version) == 2 and version.isdigit():
+            version = int(version)
+        if version not in PDF_VERSIONS:
+            return ReadError(
+                "Invalid data version number (got %s, should be 0 - 63)" % version,
+                code=HEADER_ERROR,
+                offset=base + 15,
+            )
 
-        hair = None  # (OPTIONAL 2013 b.)
-        if "DAZ" in list(fields.keys()):
-            hair = fields["DAZ"]  # Optional
-            assert hair in HAIRCOLOURS, "Invalid hair colour: {0}".format(hair)
+        log("Format version: %s", version)
 
-        # TODO: OPTIONAL 2013 fields c - h
+        if version in (0, 1):
+            jurisdiction_version = None
+            directory = base + 17
+        else:
+            # version 2 and later add a jurisdiction field
+            jurisdiction_version = data[base + 17: base + 19]
+            if len(jurisdiction_version) != 2 or not jurisdiction_version.isdigit():
+                return ReadError(
+                    "Jurisidiction version number is not an integer",
+                    code=HEADER_ERROR,
+                    offset=base + 17,
+                )
+            jurisdiction_version = int(jurisdiction_version)
+            directory = base + 19
+
+        nEntries = data[directory: directory + 2]
+        if len(nEntries) != 2 or not nEntries.isdigit():
+            return ReadError(
+                "Number of entries is not an integer",
+                code=DIRECTORY_ERROR,
+                offset=directory,
+            )
+        nEntries = int(nEntries)
+        log("Entries: %s", nEntries)
+
+        # parse subfile designators
+        subfiles = []
+        for fileId in range(nEntries):
+            # Read each subfile designator
+            log("=== Subfile %s ===", fileId)
+            read_offset = directory + 2 + fileId * 10
+            record_type = data[read_offset: read_offset + 2]
+            offset = data[read_offset + 2: read_offset + 6]
+            length = data[read_offset + 6: read_offset + 10]
+            if len(offset) != 4 or not offset.isdigit():
+                return ReadError(
+                    "Subfile offset is not an integer",
+                    code=DIRECTORY_ERROR,
+                    offset=read_offset + 2,
+                )
+            if len(length) != 4 or not length.isdigit():
+                return ReadError(
+                    "Subfile length is not an integer",
+                    code=DIRECTORY_ERROR,
+                    offset=read_offset + 6,
+                )
+            offset = int(offset)
+            length = int(length)
+            if version in (0, 1):
+                if fileId == 0:
+                    # Subfile type determines document type
+                    if record_type != "DL" and record_type != "ID":
+                        return ReadError(
+                            "Not a driver's license (Got '%s', should be 'DL')"
+                            % record_type,
+                            code=DIRECTORY_ERROR,
+                            offset=read_offset,
+                        )
+                    # FIXME Either MD or SC is off-by-one on this part of the standard
+                    if issue_identifier == "636005":
+                        offset += 1
+                else:
+                    length += 2
+            log("Offset: %s", offset)
+            log("Length: %s", length)
+            subfiles.append((record_type, base + offset, base + offset + length))
+            log("=== End Subfile ===")
+
+        return issue_identifier, version, jurisdiction_version, subfiles
+
+    _parse_date = staticmethod(parse_date)
+
+
+_MISSING = object()
+
+
+class DecodeCache:
+    """
+    Bounded LRU cache of decoded results, keyed by a digest of the raw scan.
+    Pass one to AAMVA(cache=DecodeCache()) to have decode() and
+    decode_many() skip decoding scans they have seen recently.  The cache
+    holds at most `maxsize` results, each for at most `ttl` seconds if
+    given, and keeps hit/miss counters.  Results are copied on the way in
+    and out so callers can't modify the cached copy.  Failed decodes are
+    not cached.
+    """
 
-        # name suffix optional. No prefix field in this version.
-        try:
-            name_suffix = fields["DCU"].strip()  # (OPTIONAL 2013 i.)
-        except KeyError:
-            name_suffix = None
-
-        # TODO: OPTIONAL 2013 fields j - u
-
-        # v6 adds optional date fields DDH, DDI, and DDJ (Under 18/19/21 until)
-        arrival_dates = {}
-        if "DDH" in list(fields.keys()):
-            arrival_dates["under_18_until"] = self._parse_date(fields["DDH"])
-        if "DDI" in list(fields.keys()):
-            arrival_dates["under_19_until"] = self._parse_date(fields["DDI"])
-        if "DDJ" in list(fields.keys()):
-            arrival_dates["under_21_until"] = self._parse_date(fields["DDJ"])
-
-        # TODO: OPTIONAL 2013 field a.a.
-
-        rv = {
-            "first": firstname,
-            "last": lastname,
-            "middle": middlename,
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "ZIP": fields["DAK"].strip(),
-            "class": vehicle_class,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": name_suffix,
-            "prefix": None,
-            "document": fields["DCF"].strip(),
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 8,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
-        return rv
+    def __init__(self, maxsize=4096, ttl=None, clock=time.monotonic):
+        if maxsize <= 0:
+            raise ValueError("Cache size must be positive")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-    def _decode_barcode_v9(self, fields, issueIdentifier):  # 2016 standard
-        warnings = []
-        # Add: "unspecified" sex option
-        # required fields
-        country = fields["DCG"]  # USA or CAN
-
-        # 2016 e, f, g, are required name fields
-        lastname = fields["DCS"].strip()  # (REQUIRED 2016 e)
-        firstname = fields["DAC"].strip()  # (REQUIRED 2016 f)
-        middlename = fields["DAD"].strip()  # (REQUIRED 2016 g)
-
-        # 2016 t, u, and v indicate if names are truncated:
-        if fields["DDE"] == "T":
-            lastname += "…"
-        if fields["DDF"] == "T":
-            firstname += "…"
-        if fields["DDG"] == "T":
-            middlename += "…"
-
-        # convert dates
-        dba = fields["DBA"]  # expiry (REQUIRED 2016 d.)
-        expiry = self._parse_date(dba, country)
-        dbd = fields["DBD"]  # issue date (REQUIRED 2016 h.)
-        issued = self._parse_date(dbd, country)
-        dbb = fields["DBB"]  # date of birth (REQUIRED 2016 i.)
-        dob = self._parse_date(dbb, country)
-
-        # jurisdiction-specific (required for DL only):
-        # FIXME - check if fields are empty
-        try:
-            vehicle_class = fields["DCA"].strip()  # (REQUIRED 2016 a.)
-            restrictions = fields["DCB"].strip()  # (REQUIRED 2016 b.)
-            endorsements = fields["DCD"].strip()  # (REQUIRED 2016 c.)
-            card_type = DRIVER_LICENSE
-        except KeyError:
-            # not a DL, use None instead
-            vehicle_class = None
-            restrictions = None
-            endorsements = None
-            card_type = IDENTITY_CARD
-
-        # Physical description
-        sex = fields["DBC"]  # (REQUIRED 2016 j.)
-        assert sex in "129", "Invalid sex"
-        if sex == "1":
-            sex = MALE
-        if sex == "2":
-            sex = FEMALE
-        if sex == "9":
-            sex = NOT_SPECIFIED
-
-        eyes = fields["DAY"]  # (REQUIRED 2016 k.)
-        assert eyes in EYECOLOURS, "Invalid eye colour: {0}".format(eyes)
-
-        height = fields["DAU"]  # (REQUIRED 2016 l.)
-        if height[-2:].lower() == "in":  # inches
-            height = int(height[0:3])
-            units = IMPERIAL
-            height = Height(height, format="USA")
-        elif height[-2:].lower() == "cm":  # metric
-            height = int(height[0:3])
-            units = METRIC
-            height = Height(height)
-        else:
-            height = None
-            #raise AssertionError("Invalid unit for height")
+    @staticmethod
+    def digest(data):
+        """
+        Returns a 128-bit BLAKE2 digest of a raw scan
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8", "surrogatepass")
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return _copy_result(value)
+                del self._entries[key]
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        value = _copy_result(value)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _copy_result(result):
+    """
+    Copies a decoded result deeply enough that changing the copy, or any
+    of the containers in it, can't change the original.
+    """
+    if isinstance(result, dict):
+        result = dict(result)
+        for key in ("arrival_dates", "warnings"):
+            if key in result:
+                result[key] = copy.copy(result[key])
+    elif isinstance(result, License):
+        result = copy.copy(result)
+        if isinstance(result.arrival_dates, dict):
+            result.arrival_dates = dict(result.arrival_dates)
+    elif isinstance(result, LazyRecord):
+        result = copy.copy(result)
+    return result
+
+
+class StageTimings:
+    """
+    Collects the stage durations reported by an instrumented decoder,
+    AAMVA(instrument=StageTimings()), keeping a count, total and maximum
+    for each stage:
+
+    - decode, error: a whole decode() call that returned or raised
+    - magstripe, barcode: a successful attempt at decoding one format
+    - magstripe_failed, barcode_failed: a failed attempt, such as the
+      magstripe attempt made before decoding a barcode with format ANY
+    - header: validating the header and reading the subfile directory
+    - elements: splitting the subfiles into data elements
+    - fields: converting data elements into the result
+    - units: converting height and weight
+
+    Any callable taking (stage, seconds) can be used as an instrument
+    instead.
+    """
 
-        # 2016 m, n, o, p, are required address elements
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
 
-        # weight is optional
-        if units == METRIC:
+    def __call__(self, stage, seconds):
+        with self._lock:
             try:
-                weight = Weight(None, int(fields["DAX"]))
+                totals = self.stages[stage]
             except KeyError:
-                weight = None
-        elif units == IMPERIAL:
-            try:
-                weight = Weight(None, int(fields["DAW"]), "USA")
-            except KeyError:
-                weight = None
-        if weight is None:
-            # Try weight range
-            try:
-                weight = fields["DCE"]
-                if units == METRIC:
-                    weight = Weight(int(weight), format="ISO")
-                elif units == IMPERIAL:
-                    weight = Weight(int(weight), format="USA")
-            except KeyError:
-                weight = None
-
-        # optional fields:
-        address2 = None  # (OPTIONAL 2016 a.)
-        if "DAH" in list(fields.keys()):
-            address2 = fields["DAH"].strip()
-
-        hair = None  # (OPTIONAL 2016 b.)
-        if "DAZ" in list(fields.keys()):
-            hair = fields["DAZ"]  # Optional
-            assert hair in HAIRCOLOURS, "Invalid hair colour: {0}".format(hair)
-
-        # TODO: OPTIONAL 2013 fields c - h
+                totals = self.stages[stage] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+            if seconds > totals[2]:
+                totals[2] = seconds
 
-        # name suffix optional. No prefix field in this version.
-        try:
-            nameSuffix = fields["DCU"].strip()  # (OPTIONAL 2016 i.)
-        except KeyError:
-            nameSuffix = None
-
-        # TODO: OPTIONAL 2016 fields j - u
-
-        # v6 adds optional date fields DDH, DDI, and DDJ (Under 18/19/21 until)
-        arrival_dates = {}
-        if "DDH" in list(fields.keys()):
-            arrival_dates["under_18_until"] = self._parse_date(fields["DDH"])
-        if "DDI" in list(fields.keys()):
-            arrival_dates["under_19_until"] = self._parse_date(fields["DDI"])
-        if "DDJ" in list(fields.keys()):
-            arrival_dates["under_21_until"] = self._parse_date(fields["DDJ"])
-
-        # TODO: OPTIONAL 2016 field a.a.
-
-        rv = {
-            "first": firstname,
-            "last": lastname,
-            "middle": middlename,
-            "address": fields["DAG"].strip(),
-            "address2": address2,
-            "city": fields["DAI"].strip(),
-            "state": fields["DAJ"].strip(),
-            "country": country,
-            "IIN": issueIdentifier,
-            "license_number": fields["DAQ"].strip(),
-            "expiry": expiry,
-            "dob": dob,
-            "ZIP": fields["DAK"].strip(),
-            "class": vehicle_class,
-            "restrictions": restrictions,
-            "endorsements": endorsements,
-            "sex": sex,
-            "height": height,
-            "weight": weight,
-            "hair": hair,
-            "eyes": eyes,
-            "units": units,
-            "issued": issued,
-            "suffix": nameSuffix,
-            "prefix": None,
-            "document": fields["DCF"].strip(),
-            "arrival_dates": arrival_dates,
-            "card_type": card_type,
-            "version": 9,
-            "standards": (len(warnings) == 0),
-            "warnings": warnings,
-        }
-        return rv
+    def report(self):
+        """
+        Returns a dictionary of {"count", "total", "mean", "max"} for each
+        stage, with times in seconds.
+        """
+        with self._lock:
+            return dict(
+                (
+                    stage,
+                    {
+                        "count": count,
+                        "total": total,
+                        "mean": total / count,
+                        "max": longest,
+                    },
+                )
+                for stage, (count, total, longest) in self.stages.items()
+            )
 
-    @staticmethod
-    def _parse_date(date, fmt="ISO"):
-        fmt = fmt.upper()
-        if fmt == "USA":
-            return datetime.date(int(date[4:8]), int(date[0:2]), int(date[2:4]))
-        elif fmt == "ISO" or fmt == "CAN":
-            return datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8]))
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
 
 
 class ReadError(Exception):
-    pass
+    """
+    Raised (or returned by AAMVA.try_decode() and decode_many()) for a scan
+    that can't be decoded.  `code` is one of the error codes such as
+    HEADER_ERROR or MISSING_ELEMENT, and `offset` is the offset into the scan
+    where the problem was found; either may be None if it isn't known.
+    """
+
+    def __init__(self, *args, code=None, offset=None):
+        super().__init__(*args)
+        self.code = code
+        self.offset = offset
 
 
 class HeightError(Exception):
@@ -1562,16 +1094,8 @@ class WeightError(Exception):
     pass
 
 
-class Subfile:
-    """
-    Subfile abstraction to help organize parsing of raw PDF417 data.
-    Not intended for external use
-    """
-
-    type = None
-    offset = None
-    length = None
-    data = {}
+# Errors that converting a malformed data element can raise
+_FIELD_ERRORS = (KeyError, IndexError, ValueError, ReadError, HeightError, WeightError)
 
 
 class Height:
@@ -1581,40 +1105,76 @@ class Height:
     international format, this class makes it easy to convert between the
     units provided by AAMVA physical descriptions between inches (USA) and
     centimetres (Canada)
+
+    Heights are immutable and interned: Height(70, "USA") returns the same
+    instance every time, so decoding doesn't build a new one per scan.
     """
 
-    def __init__(self, height, format="ISO"):
-        self.format = format
+    __slots__ = ("format", "units", "height", "_metric", "_imperial")
+    _cache = {}
+
+    def __new__(cls, height, format="ISO"):
+        # 70 and 70.0 are equal, but shouldn't be the same instance
+        key = (type(height), height, format)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            pass
         if format == "ISO" or format == "CAN":  # use metric (cm)
-            self.units = METRIC
+            units = METRIC
+            metric = height
+            imperial = int(round(height * 0.393700787))  # convert to inches
         elif format == "USA":
-            self.units = IMPERIAL
+            units = IMPERIAL
+            metric = int(round(height * 2.54))  # convert to cm
+            imperial = height
         else:
             raise HeightError("Invalid format: '%s'" % format)
 
-        self.height = height
+        self = object.__new__(cls)
+        _set = object.__setattr__
+        _set(self, "format", format)
+        _set(self, "units", units)
+        _set(self, "height", height)
+        _set(self, "_metric", metric)
+        _set(self, "_imperial", imperial)
+        if len(cls._cache) < FLYWEIGHT_CACHE_SIZE:
+            self = cls._cache.setdefault(key, self)
+        return self
 
     def as_metric(self):
         """
         Returns height as integer in centimetres
         """
-        if self.units == METRIC:
-            return self.height
-        else:
-            return int(round(self.height * 0.393700787))  # convert to cm
+        return self._metric
 
     def as_imperial(self):
         """
         Returns height as integer in inches
         """
-        if self.units == IMPERIAL:
-            return self.height
-        else:
-            return int(round(self.height * 2.54))  # convert to inches
+        return self._imperial
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (self.__class__, (self.height, self.format))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __eq__(self, other):
-        if other.units == self.units:
-            return self.height == other.height
+        if not isinstance(other, Height):
+            return NotImplemented
+        return other.units == self.units and self.height == other.height
+
+    def __hash__(self):
+        return hash((self.units, self.height))
 
     def __repr__(self):
         return "%s(%s, format='%s')" % (
@@ -1633,134 +1193,78 @@ class Height:
 class Weight:
     """
     Represents the physical description of weight in an unit-neutral way.
+
+    Like heights, weights are immutable and interned.  Weights in different
+    units are equal if they fall in the same weight range.
     """
 
-    def __init__(self, weight_range, weight=None, format="ISO"):
-        self.format = format
+    __slots__ = ("format", "units", "exact", "weight", "weightRange", "_metric", "_imperial")
+    _cache = {}
+
+    def __new__(cls, weight_range, weight=None, format="ISO"):
+        key = (type(weight_range), weight_range, type(weight), weight, format)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            pass
         if format == "ISO" or format == "CAN":  # use metric
-            self.units = METRIC
+            units = METRIC
         elif format == "USA":  # use imperial
-            self.units = IMPERIAL
+            units = IMPERIAL
         else:
             raise WeightError("Invalid format: '%s'" % format)
 
         if weight_range is None:  # Defined by exact weight (lbs or kg)
-            self.exact = True
-            assert weight != None and type(weight) == int, "Invalid weight"
-            self.weight = weight
-            if self.units == METRIC:
-                self.weightRange = self._get_metric_range(weight)
-            else:
-                self.weightRange = self._get_imperial_range(weight)
-
+            exact = True
+            if type(weight) != int:
+                raise WeightError("Invalid weight")
+            weight_range = weight_range_of(weight, units)
         else:  # Defined by weight range
-            self.exact = False
-            assert type(weight_range) == int
-            self.weightRange = weight_range
-            if self.units == METRIC:
-                self.weight = self._metric_approximation(weight_range)
-            else:
-                self.weight = self._imperial_approximation(weight_range)
+            exact = False
+            if type(weight_range) != int or not 0 <= weight_range <= 9:
+                raise WeightError("Invalid weight range")
+            weight = approximate_weight(weight_range, units)
+        if units == METRIC:
+            metric = weight
+            imperial = int(round(weight * 2.2))
+        else:
+            metric = int(round(weight / 2.2))
+            imperial = weight
+
+        self = object.__new__(cls)
+        _set = object.__setattr__
+        _set(self, "format", format)
+        _set(self, "units", units)
+        _set(self, "exact", exact)
+        _set(self, "weight", weight)
+        _set(self, "weightRange", weight_range)
+        _set(self, "_metric", metric)
+        _set(self, "_imperial", imperial)
+        if len(cls._cache) < FLYWEIGHT_CACHE_SIZE:
+            self = cls._cache.setdefault(key, self)
+        return self
 
     def as_metric(self):  # Returns integer
-        if self.units == METRIC:
-            return self.weight
-        else:
-            return int(round(self.weight / 2.2))
+        return self._metric
 
     def as_imperial(self):  # Returns integer
-        if self.units == IMPERIAL:
-            return self.weight
-        else:
-            return int(round(self.weight * 2.2))
+        return self._imperial
 
-    def _get_metric_range(self, weight):
-        """
-        Returns the integer weight range given a weight in kilograms
-        """
-        # TODO: Make this more pythonic
-        if weight <= 31:
-            return 0
-        elif weight > 31 and weight <= 45:
-            return 1
-        elif weight > 45 and weight <= 59:
-            return 2
-        elif weight > 59 and weight <= 70:
-            return 3
-        elif weight > 70 and weight <= 86:
-            return 4
-        elif weight > 86 and weight <= 100:
-            return 5
-        elif weight > 100 and weight <= 113:
-            return 6
-        elif weight > 113 and weight <= 127:
-            return 7
-        elif weight > 127 and weight <= 145:
-            return 8
-        elif weight > 146:
-            return 9
-        else:
-            return None
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
 
-    def _metric_approximation(self, weight):
-        """
-        Return an approximation of the weight given a weight range
-        """
-        table = {
-            0: 20,
-            1: 38,
-            2: 53,
-            3: 65,
-            4: 79,
-            5: 94,
-            6: 107,
-            7: 121,
-            8: 137,
-            9: 146,
-        }
-        return table[weight]
-
-    def _get_imperial_range(self, weight):
-        """
-        Returns the integer weight range given a weight in pounds
-        """
-        if weight <= 70:
-            return 0
-        elif weight > 70 and weight <= 100:
-            return 1
-        elif weight > 100 and weight <= 130:
-            return 2
-        elif weight > 130 and weight <= 160:
-            return 3
-        elif weight > 160 and weight <= 190:
-            return 4
-        elif weight > 190 and weight <= 220:
-            return 5
-        elif weight > 220 and weight <= 250:
-            return 6
-        elif weight > 250 and weight <= 280:
-            return 7
-        elif weight > 280 and weight <= 320:
-            return 8
-        elif weight > 320:
-            return 9
-        else:
-            return None
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        if self.exact:
+            return (self.__class__, (None, self.weight, self.format))
+        return (self.__class__, (self.weightRange, None, self.format))
+
+    def __copy__(self):
+        return self
 
-    def _imperial_approximation(self, weight):
-        table = {
-            0: 50,
-            1: 85,
-            2: 115,
-            3: 145,
-            4: 175,
-            5: 205,
-            6: 235,
-            7: 265,
-            8: 300,
-            9: 320,
-        }
-        return table[weight]
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         if self.exact:
@@ -1775,13 +1279,17 @@ class Weight:
                 return IMPERIAL_WEIGHTS[self.weightRange]
 
     def __eq__(self, other):
-        if other is None:
-            return False
+        if not isinstance(other, Weight):
+            return NotImplemented
         if self.units == other.units:
             return self.weight == other.weight
         else:
             return self.weightRange == other.weightRange
 
+    def __hash__(self):
+        # weights that are equal are always in the same range
+        return hash(self.weightRange)
+
     # Not sure why you'd ever need to do this
     def __add__(self, other):
         if self.units == METRIC:
@@ -1798,39 +1306,1011 @@ class Weight:
         )
 
 
-def log(string):
-    """Barebones logging"""
-    if debug:
-        print(string)
+def weight_range_of(weight, units=METRIC):
+    """
+    Returns the weight range (0-9) of a weight in kilograms, or in pounds
+    if `units` is IMPERIAL
+    """
+    if units == IMPERIAL:
+        return bisect.bisect_left(IMPERIAL_WEIGHT_BOUNDS, weight)
+    return bisect.bisect_left(METRIC_WEIGHT_BOUNDS, weight)
+
+
+def approximate_weight(weight_range, units=METRIC):
+    """
+    Returns a weight in kilograms (or pounds if `units` is IMPERIAL) that
+    stands for a weight range
+    """
+    if units == IMPERIAL:
+        return IMPERIAL_WEIGHT_APPROXIMATIONS[weight_range]
+    return METRIC_WEIGHT_APPROXIMATIONS[weight_range]
 
 
-if __name__ == "__main__":
-    import pprint
+def convert_heights(heights, units=METRIC):
+    """
+    Converts a whole column of heights, each a Height or None, to a list of
+    integers in centimetres (or inches if `units` is IMPERIAL).  Missing
+    heights stay None.
+    """
+    if units == IMPERIAL:
+        return [None if height is None else height._imperial for height in heights]
+    return [None if height is None else height._metric for height in heights]
+
+
+def convert_weights(weights, units=METRIC):
+    """
+    Converts a whole column of weights, each a Weight or None, to a list of
+    integers in kilograms (or pounds if `units` is IMPERIAL).  Missing
+    weights stay None.
+    """
+    if units == IMPERIAL:
+        return [None if weight is None else weight._imperial for weight in weights]
+    return [None if weight is None else weight._metric for weight in weights]
 
-    parser = AAMVA()
 
-    # ~ while True:
-    # ~ try: #Reading from an HID card reader (stdin)
-    # ~ pprint.pprint(parser.decode(raw_input("Swipe a card")))
-    # ~ except ReadError as e:
-    # ~ print e
-    # ~ print "Read error.  Try again."
+class LazyRecord(Mapping):
+    """
+    Read-only dictionary of decoded barcode values, returned in place of a
+    dict when the decoder is created with AAMVA(lazy=True).  The raw data
+    elements are kept as read from the barcode, and each value is only
+    converted (dates parsed, Height and Weight constructed, etc.) the first
+    time it is read, after which it is cached.  Note that this also defers
+    any validation of a value until it is read.
+    """
+
+    __slots__ = ("_getters", "_fields", "_values")
 
-    # reading from a serial barcode reader
-    import serial
+    def __init__(self, getters, fields, issue_identifier, version):
+        self._getters = getters
+        self._fields = fields
+        self._values = {"IIN": issue_identifier, "version": version}
 
-    ser = serial.Serial("/dev/ttyACM0")
-    while True:
-        charbuffer = ""
-        print("Scan a license")
-        while charbuffer[-2:] != "\r\n":
-            char = ser.read(1)
-            charbuffer += char
+    def __getitem__(self, key):
         try:
-            print("Got string: " + repr(charbuffer) + "\n\n\n\n")
-            pprint.pprint(parser.decode_barcode(str(charbuffer)))
-        except Exception as e:
-            print("Parse error. Try again")
-            print(e)
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._values[key] = self._getters[key](self._fields, self)
+        return value
+
+    def __iter__(self):
+        yield "IIN"
+        yield "version"
+        yield from self._getters
+
+    def __len__(self):
+        return len(self._getters) + 2
+
+    def __contains__(self, key):
+        return key in self._values or key in self._getters
+
+    def copy(self):
+        """
+        Returns a plain dictionary with every value converted
+        """
+        return dict(self.items())
+
+    def __copy__(self):
+        record = self.__class__.__new__(self.__class__)
+        record._getters = self._getters
+        record._fields = self._fields
+        record._values = _copy_result(self._values)
+        return record
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.copy())
+
+
+# Decoders for jurisdiction-specific subfiles, keyed by (IIN, subfile type),
+# e.g. ("636037", "ZI").  Each is called with a dictionary of the subfile's
+# data elements and returns the value to expose for it.
+SUBFILE_DECODERS = {}
+
+
+class JurisdictionSubfiles(Mapping):
+    """
+    Read-only dictionary of the jurisdiction-specific subfiles of a barcode
+    (ZV, ZW, ...), by subfile type.  Each subfile is kept as a span of the
+    raw payload and is only decoded the first time it is read: by the
+    decoder in SUBFILE_DECODERS for the issuer and subfile type, or else
+    into a read-only dictionary of its data elements.
+    """
+
+    __slots__ = ("iin", "_data", "_spans", "_elements", "_values")
+
+    def __init__(self, iin, data, spans):
+        self.iin = iin
+        self._data = data
+        self._spans = spans
+        self._elements = {}
+        self._values = {}
+
+    def __getitem__(self, subfile_type):
+        try:
+            return self._values[subfile_type]
+        except KeyError:
+            pass
+        elements = self.elements(subfile_type)
+        decoder = SUBFILE_DECODERS.get((self.iin, subfile_type))
+        if decoder is None:
+            value = MappingProxyType(elements)
+        else:
+            value = decoder(dict(elements))
+        return self._values.setdefault(subfile_type, value)
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __contains__(self, subfile_type):
+        return subfile_type in self._spans
+
+    def elements(self, subfile_type):
+        """
+        Returns a dictionary of the data elements of a subfile, without
+        running its registered decoder.  Raises KeyError if there is no
+        such subfile.
+        """
+        try:
+            return self._elements[subfile_type]
+        except KeyError:
+            pass
+        start, end = _locate_subfile(self._data, subfile_type, *self._spans[subfile_type])
+        elements = _subfile_elements(self._data, subfile_type, start, end)
+        return self._elements.setdefault(subfile_type, elements)
+
+    def span(self, subfile_type):
+        """
+        Returns the (start, end) span of a subfile within the payload
+        """
+        return self._spans[subfile_type]
+
+    def __reduce__(self):
+        # decoded values are left behind, as they may not be picklable
+        return (self.__class__, (self.iin, self._data, self._spans))
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.iin, list(self._spans))
+
+
+def _locate_subfile(data, subfile_type, start, end):
+    """
+    Returns the span of a subfile from its type designator to its segment
+    terminator.  Directories are often off by a few characters (and version
+    1 lengths are padded by two), so the designator nearest to the offset
+    in the directory is used, if there is one.
+    """
+    marker = PDF_SEGTERM + subfile_type
+    before = data.rfind(marker, 0, start + len(marker))
+    after = data.find(marker, start, end)
+    if before < 0 and after < 0:
+        return start, end
+    if after < 0 or (before >= 0 and start - before <= after - start):
+        designator = before + 1
+    else:
+        designator = after + 1
+    stop = data.find(PDF_SEGTERM, designator)
+    if stop < 0:
+        stop = min(len(data), end + designator - start)
+    return designator, stop
+
+
+# Shared stand-ins for absent optional data in License records
+NO_ARRIVAL_DATES = MappingProxyType({})
+NO_WARNINGS = ()
+
+# Output keys of decode_magstripe() and decode_barcode(), besides IIN and
+# version, with the License attributes they are stored in.
+_MAGSTRIPE_KEYS = (
+    ("first", "first"),
+    ("last", "last"),
+    ("middle", "middle"),
+    ("city", "city"),
+    ("state", "state"),
+    ("address", "address"),
+    ("license_number", "license_number"),
+    ("expiry", "expiry"),
+    ("dob", "dob"),
+    ("ZIP", "ZIP"),
+    ("class", "vehicle_class"),
+    ("restrictions", "restrictions"),
+    ("endorsements", "endorsements"),
+    ("sex", "sex"),
+    ("height", "height"),
+    ("weight", "weight"),
+    ("hair", "hair"),
+    ("eyes", "eyes"),
+    ("issued", "issued"),
+    ("units", "units"),
+    ("suffix", "suffix"),
+    ("prefix", "prefix"),
+)
+_BARCODE_KEYS = _MAGSTRIPE_KEYS + (
+    ("address2", "address2"),
+    ("country", "country"),
+    ("document", "document"),
+    ("arrival_dates", "arrival_dates"),
+    ("card_type", "card_type"),
+    ("standards", "standards"),
+    ("warnings", "warnings"),
+    ("jurisdiction", "jurisdiction"),
+)
+# Short, frequently repeated values that are interned so that records
+# share a single copy of each
+_INTERNED = ("state", "sex", "hair", "eyes", "units", "country", "card_type")
+
+
+class Header:
+    """
+    Identifies the issuer and format of a License.  Headers are immutable
+    and shared between every record with the same values (up to
+    FLYWEIGHT_CACHE_SIZE different headers).
+    """
+
+    __slots__ = ("iin", "version", "jurisdiction_version", "format")
+    _cache = {}
 
-    ser.close()
+    def __new__(cls, iin, version=None, jurisdiction_version=None, format=PDF417):
+        key = (iin, version, jurisdiction_version, format)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            pass
+        header = object.__new__(cls)
+        object.__setattr__(header, "iin", iin)
+        object.__setattr__(header, "version", version)
+        object.__setattr__(header, "jurisdiction_version", jurisdiction_version)
+        object.__setattr__(header, "format", format)
+        if len(cls._cache) < FLYWEIGHT_CACHE_SIZE:
+            header = cls._cache.setdefault(key, header)
+        return header
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __reduce__(self):
+        return (
+            self.__class__,
+            (self.iin, self.version, self.jurisdiction_version, self.format),
+        )
+
+    def __repr__(self):
+        return "%s(iin=%r, version=%r, jurisdiction_version=%r, format=%r)" % (
+            self.__class__.__name__,
+            self.iin,
+            self.version,
+            self.jurisdiction_version,
+            self.format,
+        )
+
+
+class License:
+    """
+    Compact record of a decoded license or identity card, returned in place
+    of a dict when the decoder is created with AAMVA(records=True).  Values
+    are available as attributes (record.header.iin, record.dob) or by their
+    dictionary key (record['IIN'], record['class']), and to_dict() converts
+    back to the dictionary decode_barcode() or decode_magstripe() returns.
+    The vehicle class is stored as the vehicle_class attribute.
+    """
+
+    __slots__ = ("header",) + tuple(attribute for key, attribute in _BARCODE_KEYS)
+
+    @classmethod
+    def from_dict(cls, data, jurisdiction_version=None):
+        """
+        Builds a record from a decoded dictionary
+        """
+        record = cls.__new__(cls)
+        if "version" in data:
+            keys = _BARCODE_KEYS
+            record.header = Header(data["IIN"], data["version"], jurisdiction_version)
+        else:
+            keys = _MAGSTRIPE_KEYS
+            record.header = Header(data["IIN"], format=MAGSTRIPE)
+            for key, attribute in _BARCODE_KEYS[len(_MAGSTRIPE_KEYS):]:
+                setattr(record, attribute, None)
+        for key, attribute in keys:
+            setattr(record, attribute, data[key])
+        for attribute in _INTERNED:
+            value = getattr(record, attribute)
+            if type(value) is str:
+                setattr(record, attribute, sys.intern(value))
+        record.arrival_dates = record.arrival_dates or NO_ARRIVAL_DATES
+        record.warnings = tuple(record.warnings or NO_WARNINGS)
+        return record
+
+    def to_dict(self):
+        """
+        Returns the record as the dictionary it was decoded to
+        """
+        header = self.header
+        rv = {"IIN": header.iin}
+        if header.format == MAGSTRIPE:
+            keys = _MAGSTRIPE_KEYS
+        else:
+            keys = _BARCODE_KEYS
+            rv["version"] = header.version
+        for key, attribute in keys:
+            rv[key] = getattr(self, attribute)
+        if header.format != MAGSTRIPE:
+            rv["arrival_dates"] = dict(self.arrival_dates)
+            rv["warnings"] = list(self.warnings)
+        return rv
+
+    def __getitem__(self, key):
+        if key == "IIN":
+            return self.header.iin
+        if key == "version":
+            return self.header.version
+        if key == "class":
+            key = "vehicle_class"
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        if isinstance(other, License):
+            other = other.to_dict()
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_dict())
+
+
+""" Declarative field specifications for each barcode version """
+# Each version is described by a table of (output key, element ID,
+# converter, required) entries, compiled once at import into an ordered
+# dictionary of output key -> getter that _decode_fields() runs in order,
+# or that LazyRecord runs one key at a time.
+#
+# Entries with an element ID read that element from the subfile; its
+# converter (if any) is called as converter(value, rv) with the output
+# dictionary built so far, and optional elements that are absent decode as
+# None.  Entries without an element ID derive their value from all of the
+# fields with converter(fields, rv), so they may depend on earlier entries.
+
+REQUIRED = True
+OPTIONAL = False
+
+
+def _compile_spec(entries):
+    getters = dict(
+        (key, _make_getter(element, converter, required))
+        for key, element, converter, required in entries
+    )
+    # every version keeps its jurisdiction-specific subfiles, undecoded
+    getters["jurisdiction"] = _jurisdiction
+    return getters
+
+
+# Element ID read by each getter made for an element, so that a value that
+# fails to convert can be found in the payload
+_GETTER_ELEMENTS = {}
+
+
+def _make_getter(element, converter, required):
+    if element is None:
+        return converter
+    get = _element_getter(element, converter, required)
+    _GETTER_ELEMENTS[get] = element
+    return get
+
+
+def _element_getter(element, converter, required):
+    if converter is None:
+        if required:
+            return lambda fields, rv: fields[element]
+        return lambda fields, rv: fields.get(element)
+    if required:
+        return lambda fields, rv: converter(fields[element], rv)
+
+    def get(fields, rv):
+        value = fields.get(element)
+        if value is None:
+            return None
+        return converter(value, rv)
+
+    return get
+
+
+def _derive_spec(entries, *replacements):
+    """Returns a copy of a spec table with the given entries replaced by key"""
+    replacements = dict((entry[0], entry) for entry in replacements)
+    return tuple(replacements.get(entry[0], entry) for entry in entries)
+
+
+def _decode_fields(getters, fields, rv):
+    for key, get in getters.items():
+        rv[key] = get(fields, rv)
+    return rv
+
+
+# Keys whose getters convert height and weight, timed as the "units" stage
+_UNIT_KEYS = frozenset(("height", "units", "weight"))
+
+
+def _decode_fields_timed(getters, fields, rv, instrument):
+    converting = 0.0
+    units = 0.0
+    for key, get in getters.items():
+        start = _clock()
+        rv[key] = get(fields, rv)
+        if key in _UNIT_KEYS:
+            units += _clock() - start
+        else:
+            converting += _clock() - start
+    instrument("fields", converting)
+    instrument("units", units)
+    return rv
+
+
+# Key of the JurisdictionSubfiles in a fields dictionary, which can't be
+# mistaken for a data element ID
+_JURISDICTION = "Z"
+# Key under which the name fields, once split, are kept in a fields
+# dictionary, so each name entry of a spec doesn't split them again.  Data
+# elements never contain a line feed.
+_NAMES = PDF_LINEFEED + "names"
+
+
+def _jurisdiction(fields, rv):
+    return fields[_JURISDICTION]
+
+
+def _jurisdiction_element(fields, element):
+    """
+    Returns the value of a jurisdiction-specific data element (e.g. ZIJ)
+    from the subfile named by its first two characters, or None
+    """
+    subfiles = fields[_JURISDICTION]
+    if element[:2] not in subfiles:
+        return None
+    return subfiles.elements(element[:2]).get(element)
+
+
+def _none(fields, rv):
+    return None
+
+
+def _no_arrival_dates(fields, rv):
+    return {}
+
+
+def _no_warnings(fields, rv):
+    return []
+
+
+def _standards(fields, rv):
+    return len(rv["warnings"]) == 0
+
+
+def _date(value, rv):
+    return DATE_PARSERS.get(rv["country"], _no_date)(value)
+
+
+def _iso_date(value, rv):
+    return _parse_iso_date(value)
+
+
+SEXES = {"1": MALE, "2": FEMALE, "9": NOT_SPECIFIED}
+
+
+def _sex(allowed):
+    def convert(value, rv):
+        if value not in allowed:
+            raise ReadError("Invalid sex", code=ELEMENT_ERROR)
+        return SEXES.get(value, value)
+
+    return convert
+
+
+def _eyes(value, rv):
+    if value not in EYECOLOURS:
+        raise ReadError("Invalid eye colour: {0}".format(value), code=ELEMENT_ERROR)
+    return value
+
+
+def _hair(value, rv):
+    if value not in HAIRCOLOURS:
+        raise ReadError("Invalid hair colour: {0}".format(value), code=ELEMENT_ERROR)
+    return value
+
+
+def _is_driver_license(fields):
+    # jurisdiction-specific fields are required for DL only
+    # FIXME - check if fields are empty
+    return "DCA" in fields and "DCB" in fields and "DCD" in fields
+
+
+def _license_field(element):
+    def get(fields, rv):
+        if _is_driver_license(fields):
+            return fields[element]
+        return None  # not a DL, use None instead
+
+    return get
+
+
+def _card_type(fields, rv):
+    if _is_driver_license(fields):
+        return DRIVER_LICENSE
+    return IDENTITY_CARD
+
+
+def _truncated(element, truncation):
+    # 2011 t, u, and v indicate if names are truncated
+    def get(fields, rv):
+        if fields[truncation] == "T":
+            return fields[element] + "…"
+        return fields[element]
+
+    return get
+
+
+def _height(value, rv):
+    if value[-2:] == "in":  # inches
+        return Height(int(value[0:3]), format="USA")
+    elif value[-2:].lower() == "cm":  # metric
+        return Height(int(value[0:3]))
+    return None
+
+
+def _height_v4(value, rv):
+    if value[-2:].lower() == "cm":  # metric
+        return Height(int(value[0:3]))
+    elif value[-1] == '"':
+        # US height encoding for some implementations of this version is feet and inches
+        # (e.g. 6'-01"")
+        return Height(int(value[0]) * 12 + int(value[3:5]), format="USA")
+    elif value[-2:].lower() == "in":
+        return Height(int(value[0:3]), format="USA")
+    return None
+
+
+def _height_v9(value, rv):
+    if value[-2:].lower() == "in":  # inches
+        return Height(int(value[0:3]), format="USA")
+    return _height(value, rv)
+
+
+def _units(fields, rv):
+    height = rv["height"]
+    if height is None:
+        return None
+    return height.units
+
+
+def _weight(fields, rv):
+    # exact weight is optional, fall back on the weight range
+    units = rv["units"]
+    if units == METRIC:
+        if "DAX" in fields:
+            return Weight(None, int(fields["DAX"]))
+        if "DCE" in fields:
+            return Weight(int(fields["DCE"]), format="ISO")
+    elif units == IMPERIAL:
+        if "DAW" in fields:
+            return Weight(None, int(fields["DAW"]), "USA")
+        if "DCE" in fields:
+            return Weight(int(fields["DCE"]), format="USA")
+    return None
+
+
+def _arrival_dates(fields, rv):
+    # v5 adds optional date fields DDH, DDI, and DDJ (Under 18/19/21 until)
+    arrival_dates = {}
+    if "DDH" in fields:
+        arrival_dates["under_18_until"] = _date(fields["DDH"], rv)
+    if "DDI" in fields:
+        arrival_dates["under_19_until"] = _date(fields["DDI"], rv)
+    if "DDJ" in fields:
+        arrival_dates["under_21_until"] = _date(fields["DDJ"], rv)
+    return arrival_dates
+
+
+# Version 1 (AAMVA DL/ID-2000 standard)
+
+
+def _v1_names(fields):
+    names = fields.get(_NAMES)
+    if names is not None:
+        return names
+    if "DAB" in fields:  # Prefer the optional, field-seperated values
+        names = (
+            fields["DAB"],  # Lastname, OPTIONAL 31
+            fields.get("DAC"),  # Firstname, OPTIONAL 32
+            fields.get("DAD"),  # Middle name/initial, OPTIONAL 33
+            fields.get("DAE"),  # Suffix, OPTIONAL 34
+            fields.get("DAF"),  # Prefix, OPTIONAL 35
+        )
+    else:
+        # fall back on the required field
+        name = fields["DAA"].split(",")  # REQUIRED 1
+        # Middle name not always encoded, or comma skipped:
+        middle = name[2] if len(name) > 2 else None
+        names = (name[0].strip(), name[1].strip(), middle, None, None)
+    fields[_NAMES] = names
+    return names
+
+
+def _v1_units(fields, rv):
+    if "DAV" in fields and "DAX" in fields:  # Prefer metric units OPTIONAL 42, 43
+        return METRIC
+    if "DAU" in fields and "DAW" in fields:  # U.S. imperial units OPTIONAL 20, 21
+        return IMPERIAL
+    # No height/weight defined (these fields are optional by the standard)
+    return None
+
+
+def _v1_country(fields, rv):
+    if rv["units"] == METRIC:
+        return "CAN"
+    return "USA"
+
+
+def _v1_height(fields, rv):
+    units = rv["units"]
+    if units == METRIC:
+        return fields["DAV"]
+    elif units == IMPERIAL:
+        return fields["DAU"]
+    return None
+
+
+def _v1_weight(fields, rv):
+    units = rv["units"]
+    if units == METRIC:
+        return Weight(None, int(fields["DAX"]))
+    elif units == IMPERIAL:
+        return Weight(None, int(fields["DAW"]), "USA")
+    return None
+
+
+def _v1_sex(value, rv):
+    if value == "1":  # SCDMV v1 discrepancy
+        value = MALE
+    elif value == "2":
+        value = FEMALE
+    if "F" not in value and "M" not in value:
+        raise ReadError("Invalid sex", code=ELEMENT_ERROR)
+    return value
+
+
+def _v1_hair(fields, rv):
+    if "DAY" in fields:
+        return fields.get("DAZ")
+    return None
+
+
+def _v1_eyes(fields, rv):
+    if "DAZ" in fields:
+        return fields.get("DAY")
+    return None
+
+
+def _v1_card_type(fields, rv):
+    if "DAT" in fields:
+        return DRIVER_LICENSE
+    return IDENTITY_CARD
+
+
+def _v1_warnings(fields, rv):
+    warnings = []
+    # MD doesn't always encode restrictions (2015 license):
+    if "DAS" not in fields:
+        warnings.append("Missing required field: restrictions (DAS)")
+    if "DAT" not in fields:
+        warnings.append("Missing required field: endorsements (DAT)")
+    return warnings
+
+
+V1_SPEC = (
+    # (output key, element ID, converter, required)
+    ("last", None, lambda fields, rv: _v1_names(fields)[0], REQUIRED),
+    ("first", None, lambda fields, rv: _v1_names(fields)[1], REQUIRED),
+    ("middle", None, lambda fields, rv: _v1_names(fields)[2], OPTIONAL),
+    ("suffix", None, lambda fields, rv: _v1_names(fields)[3], OPTIONAL),
+    ("prefix", None, lambda fields, rv: _v1_names(fields)[4], OPTIONAL),
+    ("address", "DAG", None, REQUIRED),
+    ("address2", "DAH", None, OPTIONAL),
+    ("city", "DAI", None, REQUIRED),
+    ("state", "DAJ", None, REQUIRED),
+    ("ZIP", "DAK", None, REQUIRED),
+    ("license_number", "DAQ", None, REQUIRED),
+    ("expiry", "DBA", _iso_date, REQUIRED),  # REQUIRED 11
+    ("dob", "DBB", _iso_date, REQUIRED),  # REQUIRED 12
+    ("issued", "DBD", _iso_date, REQUIRED),  # REQUIRED 14
+    ("class", "DAR", None, REQUIRED),
+    ("restrictions", "DAS", None, OPTIONAL),
+    ("endorsements", "DAT", None, OPTIONAL),
+    ("sex", "DBC", _v1_sex, REQUIRED),  # REQUIRED 13
+    ("units", None, _v1_units, OPTIONAL),
+    ("country", None, _v1_country, REQUIRED),
+    ("height", None, _v1_height, OPTIONAL),
+    ("weight", None, _v1_weight, OPTIONAL),
+    ("hair", None, _v1_hair, OPTIONAL),
+    ("eyes", None, _v1_eyes, OPTIONAL),
+    ("document", None, _none, OPTIONAL),
+    ("arrival_dates", None, _no_arrival_dates, REQUIRED),
+    ("card_type", None, _v1_card_type, REQUIRED),
+    ("warnings", None, _v1_warnings, REQUIRED),
+    ("standards", None, _standards, REQUIRED),
+)
+
+# Version 3 (AAMVA DL/ID-2005 standard)
+
+
+def _v3_names(fields):
+    names = fields.get(_NAMES)
+    if names is not None:
+        return names
+    # Abstract the name field:
+    value = fields["DCT"]
+    if "," in value:
+        names = value.split(",")
+        separator = ", "
+    else:  # Indiana uses spaces instead
+        names = value.split(" ")
+        separator = " "
+    if len(names) == 1:  # No middle name
+        names = (names[0].strip(), None)
+    else:
+        names = (names[0].strip(), separator.join(names[1:]).strip())
+    fields[_NAMES] = names
+    return names
+
+
+def _v3_height(fields, rv):
+    # Some v.03 barcodes (Indiana) [wrongly, and stupidly] omit
+    # the mandatory height (DAU) field.
+    if "DAU" in fields:
+        return _height(fields["DAU"], rv)
+    height = _jurisdiction_element(fields, "ZIJ")
+    if height is not None:  # Indiana puts it in the jurisdiction field ZIJ
+        height = height.split("-")
+        return Height((int(height[0]) * 12) + int(height[1]), format="USA")
+    # Give up on parsing height
+    log("ERROR: Unable to parse height.")
+    return None
+
+
+def _v3_hair(fields, rv):
+    # Hair colour is optional for some reason in this version
+    if "DAZ" in fields:
+        return _hair(fields["DAZ"], rv)
+    hair = _jurisdiction_element(fields, "ZIL")
+    if hair is not None:  # Indiana
+        return _hair(hair, rv)
+    return None
+
+
+def _v3_weight(fields, rv):
+    units = rv["units"]
+    if "DCE" in fields:  # Try weight range
+        if units == METRIC:
+            return Weight(int(fields["DCE"]), format="ISO")
+        elif units == IMPERIAL:
+            return Weight(int(fields["DCE"]), format="USA")
+        return None
+    weight = _jurisdiction_element(fields, "ZIK")
+    if weight is not None:  # Indiana again
+        if not weight.isdigit():
+            raise ReadError(
+                "Weight is non-integer: {0}".format(weight), code=ELEMENT_ERROR
+            )
+        return Weight(int(weight), format="USA")
+    return None  # Give up
+
+
+V3_SPEC = (
+    # (output key, element ID, converter, required)
+    ("country", "DCG", None, REQUIRED),  # USA or CAN
+    ("first", None, lambda fields, rv: _v3_names(fields)[0], REQUIRED),
+    ("last", "DCS", None, REQUIRED),  # (REQUIRED 2005 e)
+    ("middle", None, lambda fields, rv: _v3_names(fields)[1], REQUIRED),
+    ("address", "DAG", None, REQUIRED),
+    ("address2", "DAH", None, OPTIONAL),  # (OPTIONAL 2009 a.)
+    ("city", "DAI", None, REQUIRED),
+    ("state", "DAJ", None, REQUIRED),
+    ("ZIP", "DAK", None, REQUIRED),
+    ("license_number", "DAQ", None, REQUIRED),
+    ("expiry", "DBA", _date, REQUIRED),  # (REQUIRED REF d.)
+    ("issued", "DBD", _date, REQUIRED),  # (REQUIRED REF g.)
+    ("dob", "DBB", _date, REQUIRED),  # (REQUIRED REF h.)
+    ("class", None, _license_field("DCA"), OPTIONAL),
+    ("restrictions", None, _license_field("DCB"), OPTIONAL),
+    ("endorsements", None, _license_field("DCD"), OPTIONAL),
+    ("card_type", None, _card_type, REQUIRED),
+    ("sex", "DBC", _sex("129"), REQUIRED),
+    ("height", None, _v3_height, OPTIONAL),
+    ("units", None, _units, OPTIONAL),
+    ("weight", None, _v3_weight, OPTIONAL),
+    ("eyes", "DAY", _eyes, REQUIRED),  # Eye colour is mandatory
+    ("hair", None, _v3_hair, OPTIONAL),
+    ("suffix", "DCU", None, OPTIONAL),  # No prefix field in this version.
+    ("prefix", None, _none, OPTIONAL),
+    ("document", "DCF", None, REQUIRED),  # Mandatory 2005 q.
+    ("arrival_dates", None, _no_arrival_dates, REQUIRED),
+    ("warnings", None, _no_warnings, REQUIRED),
+    ("standards", None, _standards, REQUIRED),
+)
+
+# Version 4 (AAMVA DL/ID-2009 standard)
+
+
+def _v4_warnings(fields, rv):
+    # Hair/eye colour are mandatory, but some (NJ) don't encode hair colour
+    warnings = []
+    hair = fields.get("DAZ")
+    if hair is None:
+        warnings.append("Missing mandatory field: hair colour (DAZ)")
+    elif hair not in HAIRCOLOURS:
+        warnings.append("Invalid hair colour: {0}".format(hair))
+    eyes = fields.get("DAY")
+    if eyes is None:
+        warnings.append("Missing mandatory field: eye colour (DAY)")
+    elif eyes not in EYECOLOURS:
+        warnings.append("Invalid eye colour: {0}".format(eyes))
+    return warnings
+
+
+V4_SPEC = _derive_spec(
+    V3_SPEC,
+    ("first", "DAC", None, REQUIRED),  # (REQUIRED 2009 f)
+    ("middle", "DAD", None, REQUIRED),
+    ("height", "DAU", _height_v4, REQUIRED),
+    ("weight", None, _weight, OPTIONAL),
+    ("eyes", "DAY", None, OPTIONAL),
+    ("hair", "DAZ", None, OPTIONAL),
+    ("warnings", None, _v4_warnings, REQUIRED),
+)
+
+# Version 5 adds the optional DDH, DDI and DDJ dates
+
+V5_SPEC = _derive_spec(
+    V4_SPEC,
+    ("height", "DAU", _height, REQUIRED),
+    ("arrival_dates", None, _arrival_dates, REQUIRED),
+    ("warnings", None, _no_warnings, REQUIRED),
+)
+
+# Version 6 (AAMVA DL/ID-2011 standard)
+
+V6_SPEC = _derive_spec(
+    V5_SPEC,
+    ("first", None, _truncated("DAC", "DDF"), REQUIRED),  # (REQUIRED 2011 f)
+    ("last", None, _truncated("DCS", "DDE"), REQUIRED),  # (REQUIRED 2011 e)
+    ("middle", None, _truncated("DAD", "DDG"), REQUIRED),  # (REQUIRED 2011 g)
+    ("sex", "DBC", _sex("12"), REQUIRED),  # (REQUIRED 2011 j.)
+    ("eyes", "DAY", _eyes, REQUIRED),  # (REQUIRED 2011 k.)
+    ("hair", "DAZ", _hair, OPTIONAL),  # (OPTIONAL 2011 b.)
+)
+
+# Version 8 (AAMVA DL/ID-2013 standard)
+
+V8_SPEC = _derive_spec(
+    V6_SPEC,
+    ("sex", "DBC", _sex("129"), REQUIRED),  # (REQUIRED 2013 j.)
+)
+
+# Version 9 (AAMVA DL/ID-2016 standard)
+
+V9_SPEC = _derive_spec(
+    V8_SPEC,
+    ("height", "DAU", _height_v9, REQUIRED),  # (REQUIRED 2016 l.)
+)
+
+# Compiled decoder steps for each AAMVA version
+BARCODE_SPECS = {
+    0: _compile_spec(V1_SPEC),
+    1: _compile_spec(V1_SPEC),
+    3: _compile_spec(V3_SPEC),
+    4: _compile_spec(V4_SPEC),
+    5: _compile_spec(V5_SPEC),
+    6: _compile_spec(V6_SPEC),
+    7: _compile_spec(V8_SPEC),  # FIXME: Seems to only be optional field changes
+    8: _compile_spec(V8_SPEC),
+    9: _compile_spec(V9_SPEC),
+    10: _compile_spec(V9_SPEC),
+}
+
+
+_SEPARATORS = PDF_SEGTERM + PDF_LINEFEED
+
+
+def _subfile_elements(data, subfile_type, start, end):
+    """
+    Tokenizes a (type, start, end) subfile span of a PDF417 payload,
+    returning a dictionary of its data elements.  A data element runs to
+    the next line feed or segment terminator.
+
+    This copies the span: it is sliced, its segment terminators are
+    replaced and it is split into lines, each of which is stripped.  These
+    C-level passes turned out faster than walking the payload in place
+    and yielding (element ID, start, end) spans, so only _element_span()
+    and _find_element(), which look up single elements, work on spans.
+    """
+    while start < end and data[start] in _SEPARATORS:
+        start += 1
+    if data.startswith(subfile_type, start):
+        start += 2  # skip the subfile type designator
+    lines = data[start:end].replace(PDF_SEGTERM, PDF_LINEFEED).split(PDF_LINEFEED)
+    return {line[:3]: line[3:].strip() for line in lines if line}
+
+
+def _find_element(data, subfile, element):
+    """
+    Finds a single data element in a (type, start, end) subfile span without
+    tokenizing the rest of the subfile, returning its value or None.
+    """
+    span = _element_span(data, subfile, element)
+    if span is None:
+        return None
+    start, stop = span
+    return data[start:stop].strip()
+
+
+def _element_span(data, subfile, element):
+    """
+    Returns the (start, end) offsets of the value of a data element in a
+    (type, start, end) subfile span, or None if it isn't there
+    """
+    subfile_type, start, end = subfile
+    while start < end and data.startswith(PDF_SEGTERM, start):
+        start += 1
+    if data.startswith(subfile_type, start):
+        start += 2  # skip the subfile type designator
+    if not data.startswith(element, start, end):
+        # every other element starts a new line
+        start = data.find(PDF_LINEFEED + element, start, end)
+        if start < 0:
+            return None
+        start += 1
+    start += 3
+    stop = data.find(PDF_LINEFEED, start, end)
+    if stop < 0:
+        stop = end
+    return start, stop
+
+
+def _field_error(error, getters, rv, data, subfile):
+    """
+    Returns a ReadError for an exception raised while converting the data
+    elements of a barcode, given the values converted so far and the span
+    of the DL/ID subfile
+    """
+    if isinstance(error, KeyError):
+        # a required element that isn't there, most often a partial read
+        result = ReadError(
+            "Missing required field: {0}".format(error.args[0]),
+            code=MISSING_ELEMENT,
+            offset=min(subfile[2], len(data)),
+        )
+    else:
+        key = next(key for key in getters if key not in rv)
+        element = _GETTER_ELEMENTS.get(getters[key])
+        span = None
+        if element is not None:
+            span = _element_span(data, subfile, element)
+        result = ReadError(
+            "Invalid {0}: {1}".format(key, error),
+            code=ELEMENT_ERROR,
+            offset=None if span is None else span[0],
+        )
+    result.__cause__ = error
+    return result
+
+
+def log(string, *args):
+    """
+    Barebones logging.  Arguments are only formatted into the message
+    (printf-style) when debugging is enabled.
+    """
+    if debug:
+        print(string % args if args else string)
@@ -0,0 +1,210 @@
+# age.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Age checks at the door ("is this person under 21?") straight from the raw
+# scan.  Only the date of birth (or an "under X until" date) is read, never
+# the rest of the credential, and dates are compared as CCYYMMDD integers:
+# someone born on or before today's date X years ago is at least X years
+# old, so the cutoff for every age is worked out once per day.
+
+import collections
+import datetime
+import time
+
+from .aamva import (
+    DIRECTORY_ERROR,
+    HEADER_ERROR,
+    MAGSTRIPE,
+    PDF_LINEFEED,
+    ReadError,
+    _buffer,
+    _find_element,
+    sniff_format,
+)
+
+AGES = (18, 19, 21)
+# "Under X until" elements of version 5 and later, the date the holder
+# turns X
+UNDER_UNTIL = {18: "DDH", 19: "DDI", 21: "DDJ"}
+
+AgeCheck = collections.namedtuple("AgeCheck", ("under_18", "under_19", "under_21"))
+
+
+def date_key(date):
+    """
+    Returns a date as a CCYYMMDD integer, which orders the same way
+    """
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def birth_date_key(data):
+    """
+    Returns the date of birth in a raw scan as a CCYYMMDD integer, reading
+    only the DBB element of a barcode or track 2 of a magstripe
+    """
+    data = _buffer(data)
+    if sniff_format(data) == MAGSTRIPE:
+        return _parse_key(_swipe_birth_date(data))
+    version, subfile = _dl_subfile(data)
+    return _parse_key(_find_element(data, subfile, "DBB"))
+
+
+class AgeGate:
+    """
+    Answers under 18/19/21 questions for raw scans with one integer
+    comparison per age:
+
+        gate = AgeGate()
+        if gate.is_under(scan, 21):
+            ...  # no entry
+        gate.check(scan)  # AgeCheck(under_18=False, under_19=False, under_21=True)
+
+    The cutoffs are recomputed when the local date changes, which is
+    noticed with a single call of `clock` (time.time by default).  A gate
+    may be shared between threads.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        # (end of the day in seconds, today as CCYYMMDD), replaced as a whole
+        self._day = (float("-inf"), 0)
+
+    def today(self):
+        """
+        Returns today's date as a CCYYMMDD integer
+        """
+        now = self._clock()
+        expires, today = self._day
+        if now >= expires:
+            date = datetime.date.fromtimestamp(now)
+            tomorrow = datetime.datetime.combine(
+                date + datetime.timedelta(days=1), datetime.time()
+            )
+            today = date_key(date)
+            self._day = (tomorrow.timestamp(), today)
+        return today
+
+    def cutoff(self, age):
+        """
+        Returns the latest date of birth, as a CCYYMMDD integer, of someone
+        who is at least `age` years old today.  Someone born on 29 February
+        comes of age on 1 March in other years.
+        """
+        return self.today() - age * 10000
+
+    def is_under(self, data, age):
+        """
+        Returns True if the holder of the credential in a raw scan is under
+        `age` today.  Barcodes of version 5 and later with an "under X
+        until" date for the age are checked against that date; otherwise
+        the date of birth is.  Raises ReadError if the scan has no valid
+        date to check.
+        """
+        return self._under(data, (age,))[0]
+
+    def check(self, data):
+        """
+        Returns an AgeCheck of whether the holder of the credential in a raw
+        scan is under 18, 19 and 21 today, reading each age as is_under()
+        does
+        """
+        return AgeCheck(*self._under(data, AGES))
+
+    def _under(self, data, ages):
+        data = _buffer(data)
+        today = self.today()
+        if sniff_format(data) == MAGSTRIPE:
+            birth = _parse_key(_swipe_birth_date(data))
+            return [birth > today - age * 10000 for age in ages]
+        version, subfile = _dl_subfile(data)
+        birth = None
+        rv = []
+        for age in ages:
+            if version >= 5 and age in UNDER_UNTIL:
+                until = _find_element(data, subfile, UNDER_UNTIL[age])
+                if until:
+                    rv.append(today < _parse_key(until))
+                    continue
+            if birth is None:
+                # read at most once, and only if an age needs it
+                birth = _parse_key(_find_element(data, subfile, "DBB"))
+            rv.append(birth > today - age * 10000)
+        return rv
+
+
+def _dl_subfile(data):
+    """
+    Returns the AAMVA version of a PDF417 payload and the (type, start, end)
+    span of its DL/ID subfile.  That subfile always comes first, so unlike
+    AAMVA._read_header() only the first entry of the directory is read.
+    """
+    base = data.find("@")
+    if base < 0:
+        raise ReadError(
+            "Missing compliance character (@)", code=HEADER_ERROR, offset=0
+        )
+    if data[base + 1: base + 2] != PDF_LINEFEED:
+        raise ReadError(
+            "Missing data element separator (LF)", code=HEADER_ERROR, offset=base + 1
+        )
+    version = data[base + 15: base + 17]
+    if len(version) != 2 or not version.isdigit():
+        raise ReadError(
+            "Invalid data version number", code=HEADER_ERROR, offset=base + 15
+        )
+    version = int(version)
+    # version 2 and later add a jurisdiction field
+    directory = base + (17 if version in (0, 1) else 19)
+    entry = data[directory + 2: directory + 12]
+    if len(entry) != 10 or not entry[2:].isdigit():
+        raise ReadError(
+            "Missing subfile designator", code=DIRECTORY_ERROR, offset=directory + 2
+        )
+    subfile_type = entry[:2]
+    start = base + int(entry[2:6])
+    if version in (0, 1) and data[base + 9: base + 15] == "636005":
+        start += 1  # see AAMVA._read_header()
+    return version, (subfile_type, start, start + int(entry[6:]))
+
+
+def _swipe_birth_date(data):
+    # Track 2 is ;IIN and license number=YYMM expiry, CCYYMMDD date of birth
+    start = data.find(";")
+    separator = data.find("=", start)
+    stop = data.find("?", start)
+    if start < 0 or separator < 0 or not separator < stop:
+        raise ReadError("Missing track 2")
+    return data[separator + 5: separator + 13]
+
+
+def _parse_key(date):
+    """
+    Returns a CCYYMMDD or MMDDCCYY date string as a CCYYMMDD integer.  No
+    month is 13 or more and no century before 13 is in use, so the first
+    two digits tell the layouts apart without knowing the issuer's country.
+    """
+    if not date or len(date) != 8 or not date.isdigit():
+        raise ReadError("Invalid date: %r" % (date,))
+    if date[:2] > "12":
+        key = int(date)
+    else:
+        key = int(date[4:] + date[:4])
+    if not (1 <= key // 100 % 100 <= 12 and 1 <= key % 100 <= 31):
+        raise ReadError("Invalid date: %r" % (date,))
+    return key
@@ -0,0 +1,258 @@
+# archive.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Random access to append-only archives of raw scans, as written by a
+# scanner (or several concatenated captures).  The archive is memory
+# mapped and the offsets of its payloads are kept in a sidecar index file,
+# so later runs can go straight to record N, or hand byte ranges of the
+# archive to parallel workers, without reading it from the start.
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from .aamva import AAMVA
+from .reader import payload_spans
+
+INDEX_SUFFIX = ".idx"
+# magic, archive size, resume offset, record count, CRC of the tail
+_INDEX_HEADER = struct.Struct("<8sQQQI")
+_INDEX_MAGIC = b"AAMVAIX1"
+# bytes before the end of the indexed part of the archive that are checked
+# to make sure the index still belongs to it
+_CHECK_SIZE = 4096
+
+
+class ScanArchive:
+    """
+    A read-only, memory-mapped archive of raw scans.  Payloads are framed
+    by their compliance indicator and header (or magstripe start sentinel)
+    exactly as reader.StreamFramer frames a live stream, and are returned
+    as bytes:
+
+        with ScanArchive("scans.bin") as archive:
+            archive[1000]
+            for start, end in archive.partition(8):
+                ...  # in each worker:
+                ScanArchive("scans.bin").decode_range(start, end)
+
+    The index is saved to `index` (the archive path plus ".idx" by
+    default, or nowhere if None).  An index left by an earlier run is
+    reused, and if the archive has grown since, only the new part is
+    scanned.  If the index can't be written (say, on read-only storage)
+    it is only kept in memory.
+    """
+
+    def __init__(self, path, index=True):
+        self.path = path
+        if index is True:
+            index = path + INDEX_SUFFIX
+        self.index = index
+        self._file = open(path, "rb")
+        self._map = None
+        self._size = 0
+        self._resume = 0
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._saved = False
+        self._mmap()
+        if index:
+            self._saved = self._load()
+        self.refresh()
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, n):
+        start, end = self.span(n)
+        return self._map[start:end]
+
+    def __iter__(self):
+        for n in range(len(self._starts)):
+            yield self._map[self._starts[n]: self._ends[n]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def span(self, n):
+        """
+        Returns the (start, end) byte offsets of record `n`
+        """
+        if n < 0:
+            n += len(self._starts)
+        if not 0 <= n < len(self._starts):
+            raise IndexError("archive record out of range")
+        return self._starts[n], self._ends[n]
+
+    def refresh(self):
+        """
+        Indexes anything appended to the archive since it was opened (or
+        since the index was saved) and saves the index if it changed.
+        Returns the number of records added.
+        """
+        if os.fstat(self._file.fileno()).st_size != self._size:
+            self._mmap()
+        if self._resume == self._size and (self._saved or not self.index):
+            return 0
+        # a payload that was cut short by the end of the archive when it was
+        # last indexed is framed again
+        count = bisect.bisect_left(self._starts, self._resume)
+        del self._starts[count:]
+        del self._ends[count:]
+        resume = self._size
+        if self._size:
+            for start, end, complete in payload_spans(self._map, self._resume):
+                self._starts.append(start)
+                self._ends.append(end)
+                if not complete:
+                    resume = start
+        self._resume = resume
+        if self.index:
+            self._save()
+        return len(self._starts) - count
+
+    def partition(self, parts):
+        """
+        Splits the archive into at most `parts` (start, end) byte ranges of
+        about the same size, each beginning and ending on a payload
+        boundary, for decode_range() or records() in separate workers.
+        """
+        if not self._starts:
+            return []
+        first, last = self._starts[0], self._ends[-1]
+        ranges = []
+        start = first
+        for part in range(1, parts):
+            target = first + (last - first) * part // parts
+            n = bisect.bisect_left(self._starts, target)
+            if n >= len(self._starts):
+                break
+            boundary = self._starts[n]
+            if boundary > start:
+                ranges.append((start, boundary))
+                start = boundary
+        ranges.append((start, last))
+        return ranges
+
+    def records(self, start=0, end=None):
+        """
+        Yields each payload that starts within the byte range [start, end)
+        """
+        first = bisect.bisect_left(self._starts, start)
+        if end is None:
+            last = len(self._starts)
+        else:
+            last = bisect.bisect_left(self._starts, end)
+        for n in range(first, last):
+            yield self._map[self._starts[n]: self._ends[n]]
+
+    def decode_range(self, start=0, end=None, parser=None):
+        """
+        Decodes each payload that starts within the byte range [start, end),
+        yielding results (or ReadErrors) as AAMVA.decode_many() does.
+        """
+        if parser is None:
+            parser = AAMVA()
+        return parser.decode_many(self.records(start, end))
+
+    def _mmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _check(self, size):
+        return zlib.crc32(self._map[max(0, size - _CHECK_SIZE): size]) if size else 0
+
+    def _load(self):
+        try:
+            with open(self.index, "rb") as f:
+                header = f.read(_INDEX_HEADER.size)
+                if len(header) != _INDEX_HEADER.size:
+                    return False
+                magic, size, resume, count, check = _INDEX_HEADER.unpack(header)
+                if magic != _INDEX_MAGIC or size > self._size or resume > size:
+                    return False
+                if self._check(size) != check:
+                    return False
+                starts, ends = array("Q"), array("Q")
+                starts.fromfile(f, count)
+                ends.fromfile(f, count)
+        except (OSError, EOFError):
+            return False
+        if sys.byteorder == "big":
+            starts.byteswap()
+            ends.byteswap()
+        self._starts = starts
+        self._ends = ends
+        self._resume = resume
+        return True
+
+    def _save(self):
+        starts, ends = self._starts, self._ends
+        if sys.byteorder == "big":
+            starts, ends = array("Q", starts), array("Q", ends)
+            starts.byteswap()
+            ends.byteswap()
+        temporary = "%s.%d.tmp" % (self.index, os.getpid())
+        try:
+            with open(temporary, "wb") as f:
+                f.write(
+                    _INDEX_HEADER.pack(
+                        _INDEX_MAGIC,
+                        self._size,
+                        self._resume,
+                        len(starts),
+                        self._check(self._size),
+                    )
+                )
+                starts.tofile(f)
+                ends.tofile(f)
+            os.replace(temporary, self.index)
+        except OSError:
+            # e.g. a read-only directory: the index is kept in memory only
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            return
+        self._saved = True
+
+
+def decode_archive(path, parser=None):
+    """
+    Yields the decoded result (or ReadError) of every payload in an archive
+    """
+    with ScanArchive(path) as archive:
+        yield from archive.decode_range(parser=parser)
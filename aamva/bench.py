@@ -0,0 +1,419 @@
+# bench.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Benchmark suite for the decoders.  Run with:
+#
+#   python -m aamva.bench                       # print a report
+#   python -m aamva.bench --save bench.json     # record a baseline
+#   python -m aamva.bench --compare bench.json  # exit 1 on a regression
+#
+# Every benchmark is timed one call at a time so latency percentiles can
+# be reported alongside throughput, then run a few more times under
+# tracemalloc to measure the memory allocated by a single call.
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import age, dedupe, encoder
+from .aamva import (
+    AAMVA,
+    IMPERIAL,
+    MAGSTRIPE,
+    METRIC,
+    PDF417,
+    Height,
+    StageTimings,
+    Weight,
+)
+from .reader import StreamFramer
+
+ROUNDS = 2000
+WARMUP = 50
+# Fraction by which a benchmark may be slower (or allocate more) than the
+# baseline before a comparison run fails.
+TOLERANCE = 0.25
+# Allocation is measured as the least of this many traced calls, and
+# differences of fewer than ALLOC_FLOOR bytes are never a regression.
+ALLOC_SAMPLES = 5
+ALLOC_FLOOR = 256
+THREADS = (1, 2, 4, 8)
+
+# Sample data, one per barcode version that real samples exist for.  These
+# are copies of samples in test.py (which notes where they come from), and
+# a test there checks that they stay the same.
+BARCODES = OrderedDict(
+    [
+        (
+            "v1",
+            "@\n\x1e\rANSI 6360000102DL00390188ZV02270031DLDAQ0123456789ABC\nDAAPUBLIC,JOHN,Q\nDAG123 MAIN STREET\nDAIANYTOWN\nDAJVA\nDAK123459999  \nDARDM  \nDAS       \nDAT     \nDAU509\nDAW175\nDAYBL \nDAZBR \nDBA20011201\nDBB19761123\nDBCM\nDBD19961201\rZVZVAJURISICTIONDEFINEDELEMENT\r\\928\\111\\100\\180\\605\\739\\922\r\n",
+        ),
+        (
+            "v1-sc",
+            "@\n\x1c\rANSI 6360050101DL00300201DLDAQ102245737\nDAASAMPLE,DRIVER,CREDENTIAL,\nDAG1500 PARK ST\nDAICOLUMBIA\nDAJSC\nDAK292012731  \nDARD   \nDAS          \nDAT     \nDAU600\nDAW200\nDAY   \nDAZ   \nDBA20190928\nDBB19780928\nDBC1\nDBD20091026\nDBG2\nDBH1\r\r\n",
+        ),
+        (
+            "v3",
+            "@\n\x1e\rANSI 636000030001DL00310440DLDCANONE\nDCB158X9     \nDCDS    \nDBA08142017\nDCSMAURY                                   \nDCTJUSTIN,WILLIAM                                                                  \nDBD08142009\nDBB07151958\nDBC1\nDAYBRO\nDAU075 in\nDAG17 FIRST STREET                    \nDAISTAUNTON            \nDAJVA\nDAK244010000  \nDAQT16700185                \nDCF061234567                \nDCGUSA\nDCHS   \nDDC00000000\nDDB12102008\nDDDN\nDDAN\nDCK9060600000017843         \n\r\r\n",
+        ),
+        (
+            "v4",
+            "@\n\x1e\rANSI 636037040002DL00410514ZI05550117DLDCAX-1X-2\nDCBX-1X-2X-3X-4\nDCDX-1XY\nDBA07042010\nDCSSAMPLEFAMILYNAMEUPTO40CHARACTERSXYWXYWXY\nDACHEIDIFIRSTNAMEUPTO40CHARACTERSXYWXYWXYWX\nDADMIDDLENAMEUPTO40CHARACTERSXYWXYWXYWXYWXY\nDBD07042006\nDBB07041989\nDBC2\nDAYHAZ\nDAU5'-04\"\nDAG123 SAMPLE DRIVE                   \nDAHAPT B                              \nDAIINDIANAPOLIS        \nDAJIN\nDAK462040000  \nDAQ1234-56-7890             \nDCF07040602300001           \nDCGUSA\nDDEN\nDDFN\nDDGN\nDAZBLN         \nDCK12345678900000000000     \nDCUXYWXY\nDAW120\nDDAF\nDDBMMDDCCYY\nDDD1\n\rZIZIAMEDICAL CONDITION\nZIBMEDICAL ALERT\nZIC023\nZIDDONOR\nZIEUNDER 18 UNTIL 07/04/07\nZIFUNDER 21 UNTIL 07/04/10\nZIGOP\n\r\r\n",
+        ),
+        (
+            "v6",
+            "@\n\x1e\rANSI 636055060002DL00410288ZG03290093DLDCAC\nDCBB\nDCDNONE\nDBA07012017\nDCSSAMPLE\nDDEU\nDACJANICE\nDDFU\nDADNONE\nDDGU\nDBD07012012\nDBB07011957\nDBC2\nDAYBLU\nDAU064 in\nDAG123 MAIN STREET\nDAIANYTOWN\nDAJGA\nDAK303341234  \nDAQ123456789\nDAW120\nDCF1234509876543210987654321\nDCGUSA\nDCUNONE\nDCK1234567890123456789012345\nDDAF\nDDB01302012\nDDK1\n\rZGZGAN\nZGBN\nZGC5-04\nZGDROCKDALE\nZGEN\nZGFABC123456789-1234567\nZGG12345-67891234567ABC\nZGH000\n\r\r\n",
+        ),
+        (
+            "v7",
+            "@\n\x1e\rANSI 636001070002DL00410392ZN04330047DLDCANONE  \nDCBNONE        \nDCDNONE \nDBA08312013\nDCSMichael                                 \nDACM                                       \nDADMotorist                                \nDBD08312013\nDBB08312013\nDBC1\nDAYBRO\nDAU064 in\nDAG2345 ANYWHERE STREET               \nDAIYOUR CITY           \nDAJNY\nDAK123450000  \nDAQNONE                     \nDCFNONE                     \nDCGUSA\nDDEN\nDDFN\nDDGN\n\rZNZNAMDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5\n\r\r\n",
+        ),
+        (
+            "v8",
+            "@\n\x1e\rANSI 636023080102DL00410280ZO03210024DLDBA05262020\nDCSLASTNAME\nDACFIRSTNAME\nDADW\nDBD05132016\nDBB05261991\nDBC1\nDAYBLU\nDAU072 IN\nDAG5115 TEST DR\nDAIPENNSITUCKY\nDAJOH\nDAK606061337  \nDAQTG834904\nDCF2520UQ7248040000\nDCGUSA\nDDEN\nDDFN\nDDGN\nDAZBRO\nDCIUS,CALIFORNIA\nDCJNONE\nDCUNONE\nDCE4\nDDAM\nDDB12042013\nDAW170\nDDK1\nDCAD\nDCBB\nDCDNONE\rZOZOAY\nZOBY\nZOE05262020\r",
+        ),
+        (
+            "v10",
+            "@\n\x1e\rANSI 636000100002DL00410278ZV03190008DLDAQT64235789\nDCSSAMPLE\nDDEN\nDACMICHAEL\nDDFN\nDADJOHN\nDDGN\nDCUJR\nDCAD\nDCBK\nDCDPH\nDBD06062019\nDBB06061986\nDBA12102024\nDBC1\nDAU068 in\nDAYBRO\nDAG2300 WEST BROAD STREET\nDAIRICHMOND\nDAJVA\nDAK232690000  \nDCF2424244747474786102204\nDCGUSA\nDCK123456789\nDDAF\nDDB06062018\nDDC06062020\nDDD1\rZVZVA01\r\r\n",
+        ),
+    ]
+)
+
+MAGSTRIPES = OrderedDict(
+    [
+        (
+            "tx",
+            '%TXAUSTIN^DOE$JOHN^12345 SHERBOURNE ST^?;63601538774194=150819810101?#" 78729      C               1505130BLKBLK?',
+        ),
+        (
+            "fl",
+            "%FLDELRAY BEACH^DOE$JOHN$^4818 S FEDERAL BLVD^           ?;6360100462172082009=2101198701010=?#! 33435      I               1600                                   ECCECC00000?",
+        ),
+    ]
+)
+
+_DAQ = re.compile("(\nDAQ|DLDAQ)([0-9A-Z]+)")
+_DBB = re.compile("\nDBB([0-9]{8})")
+
+
+def generate(count, seed=0):
+    """
+    Returns `count` synthetic barcodes made by varying the license number
+    and date of birth of the samples.  Replacements keep every element the
+    same length, so the subfile directories stay valid.
+    """
+    rng = random.Random(seed)
+    parser = AAMVA()
+    samples = list(BARCODES.values())
+    generated = []
+    for i in range(count):
+        data = samples[i % len(samples)]
+        data = _DAQ.sub(
+            lambda m: m.group(1) + _digits(rng, len(m.group(2))),
+            data,
+            count=1,
+        )
+        year = rng.randint(1930, 2010)
+        month = rng.randint(1, 12)
+        day = rng.randint(1, 28)
+        if parser.peek_header(data).version <= 1:
+            dob = "%04d%02d%02d" % (year, month, day)
+        else:
+            dob = "%02d%02d%04d" % (month, day, year)
+        data = _DBB.sub("\nDBB" + dob, data, count=1)
+        generated.append(data)
+    return generated
+
+
+def _digits(rng, length):
+    return "".join(rng.choice("0123456789") for i in range(length))
+
+
+def benchmarks(generated=1000):
+    """
+    Returns an ordered dictionary of benchmark names to zero-argument
+    callables.
+    """
+    parser = AAMVA()
+    pdf417 = AAMVA(format=[PDF417])
+    magstripe = AAMVA(format=[MAGSTRIPE])
+    cases = OrderedDict()
+
+    for name, data in BARCODES.items():
+        cases["decode_barcode/" + name] = _bind(parser.decode_barcode, data)
+    # no samples exist for these versions, so use synthetic barcodes
+    for version in (5, 9):
+        cases["decode_barcode/v%d" % version] = _cycle(
+            parser.decode_barcode, list(encoder.generate(100, version))
+        )
+    for name, data in MAGSTRIPES.items():
+        cases["decode_magstripe/" + name] = _bind(parser.decode_magstripe, data)
+
+    cases["decode/pdf417"] = _bind(pdf417.decode, BARCODES["v8"])
+    cases["decode/magstripe"] = _bind(magstripe.decode, MAGSTRIPES["tx"])
+    cases["decode/bytes"] = _bind(pdf417.decode, BARCODES["v8"].encode("latin-1"))
+    # ANY sniffs the input first, so a barcode or a magstripe only runs its
+    # own decoder.  Input that can't be told apart (here a barcode behind an
+    # AIM symbology identifier) still tries the magstripe decoder first.
+    cases["decode/any-barcode"] = _bind(parser.decode, BARCODES["v8"])
+    cases["decode/any-magstripe"] = _bind(parser.decode, MAGSTRIPES["tx"])
+    cases["decode/any-unsniffed"] = _bind(parser.decode, "]L0" + BARCODES["v8"])
+    cases["decode/generated"] = _cycle(parser.decode, generate(generated))
+    # one operation is a batch of 100 swipes
+    swipes = list(encoder.generate(100, magstripe=True))
+    cases["decode_magstripes/100"] = _bind(_drain, parser.decode_magstripes, swipes)
+    instrumented = AAMVA(format=[PDF417], instrument=StageTimings())
+    cases["decode/instrumented"] = _bind(instrumented.decode, BARCODES["v8"])
+
+    stream = "".join(list(BARCODES.values()) + list(MAGSTRIPES.values()))
+    cases["framer/64"] = _bind(_frame, stream.encode("latin-1"), 64)
+
+    gate = age.AgeGate()
+    cases["age/is_under"] = _cycle(lambda data: gate.is_under(data, 21), generate(100))
+    cases["age/check"] = _cycle(gate.check, generate(100))
+
+    cases["dedupe/fingerprint"] = _cycle(dedupe.fingerprint, generate(100))
+    fingerprints = random.Random(0)
+    index = dedupe.DedupeIndex(capacity=ROUNDS * 2)
+    cases["dedupe/add"] = lambda: index.add_fingerprint(fingerprints.getrandbits(64))
+
+    records = [encoder.random_record(random.Random(i)) for i in range(100)]
+    cases["encode/barcode"] = _cycle(encoder.encode_barcode, records)
+    cases["encode/magstripe"] = _cycle(encoder.encode_magstripe, records)
+
+    cases["height/imperial"] = _bind(Height, 70, IMPERIAL)
+    cases["height/metric"] = _bind(Height, 178, METRIC)
+    cases["weight/exact"] = lambda: Weight(None, 170, IMPERIAL)
+    cases["weight/range"] = lambda: Weight(5, format=METRIC)
+    return cases
+
+
+def _drain(function, items):
+    for result in function(items):
+        pass
+
+
+def _frame(stream, size):
+    framer = StreamFramer()
+    for i in range(0, len(stream), size):
+        framer.feed(stream[i: i + size])
+    return framer.flush()
+
+
+def _bind(function, *args):
+    return lambda: function(*args)
+
+
+def _cycle(function, items):
+    items = itertools.cycle(items)
+    return lambda: function(next(items))
+
+
+def measure(function, rounds=ROUNDS, warmup=WARMUP):
+    """
+    Times `rounds` calls of `function` and returns a dictionary of
+    throughput (ops), median and 99th percentile latency in microseconds
+    (p50, p99), and the bytes allocated by a single call (alloc), the
+    least of ALLOC_SAMPLES traced calls.
+    """
+    for i in range(warmup):
+        function()
+
+    clock = time.perf_counter_ns
+    timings = []
+    for i in range(rounds):
+        start = clock()
+        function()
+        timings.append(clock() - start)
+    timings.sort()
+
+    allocs = []
+    tracemalloc.start()
+    try:
+        for i in range(ALLOC_SAMPLES):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function()
+            allocs.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "ops": rounds * 1e9 / max(sum(timings), 1),
+        "p50": _percentile(timings, 0.50) / 1000,
+        "p99": _percentile(timings, 0.99) / 1000,
+        "alloc": min(allocs),
+    }
+
+
+def _percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def run(pattern=None, rounds=ROUNDS, generated=1000):
+    """
+    Runs every benchmark whose name contains `pattern` (all of them if
+    None) and returns a report suitable for save() and compare().
+    """
+    results = OrderedDict()
+    for name, function in benchmarks(generated).items():
+        if pattern is None or pattern in name:
+            results[name] = measure(function, rounds)
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "rounds": rounds,
+        "results": results,
+    }
+
+
+def scaling(threads=THREADS, count=4000, generated=1000):
+    """
+    Decodes `count` generated payloads with a single shared AAMVA instance,
+    split evenly across each number of threads in `threads`, and returns an
+    ordered dictionary of thread count to decodes per second.  Throughput
+    only grows with the thread count on free-threaded builds of Python.
+    """
+    parser = AAMVA()
+    items = list(itertools.islice(itertools.cycle(generate(generated)), count))
+    results = OrderedDict()
+    for workers in threads:
+        # every thread starts decoding at once, after the pool is up
+        barrier = threading.Barrier(workers + 1)
+
+        def work(chunk):
+            barrier.wait()
+            for data in chunk:
+                parser.decode(data)
+
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(work, items[i::workers]) for i in range(workers)]
+            barrier.wait()
+            start = time.perf_counter()
+            for future in futures:
+                future.result()
+            seconds = time.perf_counter() - start
+        results[workers] = count / seconds
+    return results
+
+
+def format_scaling(results):
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    lines = [
+        "%-8s %12s %8s   (GIL %s)"
+        % ("threads", "ops/s", "speedup", "enabled" if gil else "disabled")
+    ]
+    single = next(iter(results.values()))
+    for workers, ops in results.items():
+        lines.append("%-8d %12.0f %7.2fx" % (workers, ops, ops / single))
+    return "\n".join(lines)
+
+
+def save(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """
+    Returns a list of (name, metric, baseline, current) tuples for every
+    benchmark that is slower, or allocates more, than the baseline by more
+    than `tolerance` (and, for allocation, by at least ALLOC_FLOOR bytes).
+    Benchmarks missing from either report are ignored.
+    """
+    regressions = []
+    for name, current in report["results"].items():
+        try:
+            previous = baseline["results"][name]
+        except KeyError:
+            continue
+        if current["ops"] < previous["ops"] * (1 - tolerance):
+            regressions.append((name, "ops", previous["ops"], current["ops"]))
+        growth = current["alloc"] - previous["alloc"]
+        if growth > max(previous["alloc"] * tolerance, ALLOC_FLOOR):
+            regressions.append((name, "alloc", previous["alloc"], current["alloc"]))
+    return regressions
+
+
+def format_report(report, baseline=None):
+    lines = [
+        "%-28s %12s %10s %10s %10s %8s"
+        % ("benchmark", "ops/s", "p50 (us)", "p99 (us)", "alloc (B)", "change")
+    ]
+    for name, result in report["results"].items():
+        change = ""
+        if baseline is not None and name in baseline["results"]:
+            previous = baseline["results"][name]["ops"]
+            change = "%+.1f%%" % ((result["ops"] / previous - 1) * 100)
+        lines.append(
+            "%-28s %12.0f %10.2f %10.2f %10d %8s"
+            % (name, result["ops"], result["p50"], result["p99"], result["alloc"], change)
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(prog="python -m aamva.bench")
+    arguments.add_argument("-k", dest="pattern", help="only run benchmarks matching PATTERN")
+    arguments.add_argument("-n", "--rounds", type=int, default=ROUNDS)
+    arguments.add_argument("--save", metavar="PATH", help="write the results as a JSON baseline")
+    arguments.add_argument("--compare", metavar="PATH", help="fail if slower than a JSON baseline")
+    arguments.add_argument("--tolerance", type=float, default=TOLERANCE)
+    arguments.add_argument(
+        "--threads",
+        metavar="N,N...",
+        help="measure decoding throughput of a shared decoder across thread counts",
+    )
+    options = arguments.parse_args(argv)
+
+    if options.threads:
+        threads = [int(n) for n in options.threads.split(",")]
+        print(format_scaling(scaling(threads)))
+        return 0
+
+    baseline = load(options.compare) if options.compare else None
+    report = run(options.pattern, options.rounds)
+    print(format_report(report, baseline))
+    if options.save:
+        save(report, options.save)
+    if baseline is not None:
+        regressions = compare(report, baseline, options.tolerance)
+        for name, metric, previous, current in regressions:
+            print("REGRESSION %s %s: %.2f -> %.2f" % (name, metric, previous, current))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# bulk.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Spreads decoding of large batches of raw scans across a pool of worker
+# processes, for CPU-bound backfills where one core isn't enough.
+
+import collections
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .aamva import ANY, AAMVA
+
+# Chunks start small so the first results arrive quickly, then grow or
+# shrink so that each one keeps a worker busy for about `target` seconds.
+INITIAL_CHUNKSIZE = 64
+MIN_CHUNKSIZE = 16
+MAX_CHUNKSIZE = 65536
+
+
+class WorkerStats:
+    """
+    Running totals for a single worker process.
+    """
+
+    __slots__ = ("pid", "chunks", "items", "seconds")
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.chunks = 0
+        self.items = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Returns the number of items decoded per second of worker time
+        """
+        if not self.seconds:
+            return 0.0
+        return self.items / self.seconds
+
+    def __repr__(self):
+        return "%s(pid=%s, chunks=%s, items=%s, seconds=%.3f)" % (
+            self.__class__.__name__,
+            self.pid,
+            self.chunks,
+            self.items,
+            self.seconds,
+        )
+
+
+class BulkDecoder:
+    """
+    Decodes an iterable of raw magstripe or PDF417 scans on a process pool,
+    yielding results in input order exactly as AAMVA.decode_many() would.
+    Work is submitted in chunks, sized adaptively unless `chunksize` is
+    given, with at most two chunks in flight per worker so memory use is
+    bounded by the chunk size rather than the length of the input.
+    """
+
+    def __init__(self, workers=None, format=[ANY], chunksize=None, target=0.05):
+        if isinstance(format, str):
+            raise TypeError("format must be a list of formats, not a string")
+        self.workers = workers or os.cpu_count() or 1
+        self.format = format
+        self.chunksize = chunksize
+        self.target = target
+        self.stats = {}
+
+    def decode(self, items):
+        iterator = iter(items)
+        size = self.chunksize or INITIAL_CHUNKSIZE
+        pending = collections.deque()
+        pool = ProcessPoolExecutor(self.workers)
+        try:
+            while True:
+                while len(pending) < self.workers * 2:
+                    chunk = list(itertools.islice(iterator, size))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_decode_chunk, self.format, chunk))
+                if not pending:
+                    break
+                pid, seconds, results = pending.popleft().result()
+                self._record(pid, len(results), seconds)
+                if self.chunksize is None and seconds > 0:
+                    size = int(self.target * len(results) / seconds)
+                    size = max(MIN_CHUNKSIZE, min(size, MAX_CHUNKSIZE))
+                yield from results
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def throughput(self):
+        """
+        Returns a dictionary of items decoded per second for each worker
+        process, keyed by process ID.
+        """
+        return dict((pid, stats.throughput) for pid, stats in self.stats.items())
+
+    def _record(self, pid, items, seconds):
+        try:
+            stats = self.stats[pid]
+        except KeyError:
+            stats = self.stats[pid] = WorkerStats(pid)
+        stats.chunks += 1
+        stats.items += items
+        stats.seconds += seconds
+
+
+def decode_bulk(items, workers=None, format=[ANY], chunksize=None):
+    """
+    Decodes every item of an iterable on a process pool and returns a list
+    of results in input order.  Items that fail to decode are represented by
+    a ReadError.
+    """
+    decoder = BulkDecoder(workers, format, chunksize)
+    return list(decoder.decode(items))
+
+
+def _decode_chunk(format, chunk):
+    """Worker entry point: decodes one chunk and times it"""
+    start = time.perf_counter()
+    results = list(AAMVA(format=format).decode_many(chunk))
+    return os.getpid(), time.perf_counter() - start, results
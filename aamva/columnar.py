@@ -0,0 +1,211 @@
+# columnar.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Columnar batch output for analytics.  Decoded values are written
+# straight into typed column buffers (array.array, or NumPy arrays when
+# NumPy is installed) instead of being kept as a list of dictionaries.
+
+import datetime
+from array import array
+
+from .aamva import (
+    AAMVA,
+    EYECOLOURS,
+    FEMALE,
+    HAIRCOLOURS,
+    MALE,
+    NOT_SPECIFIED,
+    Height,
+    ReadError,
+    Weight,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Dates are stored as days since 1970-01-01, which is also the layout of a
+# NumPy datetime64[D] array.  Missing dates use NumPy's NaT value.
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+NAT = -(2 ** 63)
+# Missing heights, weights and category codes
+MISSING = -1
+
+DATE_COLUMNS = ("dob", "expiry", "issued")
+# Category columns with the labels that are known up front; unexpected
+# values are given new codes as they are seen.
+CATEGORY_COLUMNS = (
+    ("sex", (MALE, FEMALE, NOT_SPECIFIED)),
+    ("eyes", EYECOLOURS),
+    ("hair", HAIRCOLOURS),
+    ("state", ()),
+)
+STRING_COLUMNS = (
+    "IIN",
+    "license_number",
+    "document",
+    "first",
+    "middle",
+    "last",
+    "prefix",
+    "suffix",
+    "address",
+    "address2",
+    "city",
+    "ZIP",
+    "country",
+    "class",
+    "restrictions",
+    "endorsements",
+    "card_type",
+)
+
+
+class ColumnBatch:
+    """
+    Accumulates decoded results as columns:
+
+    - index: position of each decoded item in the input
+    - dob, expiry, issued: days since 1970-01-01 (datetime64[D] with NumPy)
+    - sex, eyes, hair, state: small-integer codes into `categories`
+    - height: centimetres, and weight: kilograms.  Version 1 barcodes
+      decode height as a plain string in unknown units, which is left out
+      (as MISSING).
+    - everything else in STRING_COLUMNS as a list of strings (or None)
+
+    Missing values are NaT for dates and -1 for the integer columns.
+    Items that could not be decoded are recorded in `errors` as
+    (index, ReadError) tuples and have no row.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.errors = []
+        self._index = array("q")
+        self._dates = dict((name, array("q")) for name in DATE_COLUMNS)
+        self._codes = dict((name, array("h")) for name, labels in CATEGORY_COLUMNS)
+        self._categories = dict(
+            (name, dict((label, code) for code, label in enumerate(labels)))
+            for name, labels in CATEGORY_COLUMNS
+        )
+        self._height = array("h")
+        self._weight = array("h")
+        self._strings = dict((name, []) for name in STRING_COLUMNS)
+
+    def append(self, result, index=None):
+        """
+        Adds one decoded result (a dict, LazyRecord or License) as a new row
+        """
+        if index is None:
+            index = self.rows + len(self.errors)
+        self._index.append(index)
+        for name, column in self._dates.items():
+            date = result[name]
+            column.append(NAT if date is None else date.toordinal() - EPOCH)
+        for name, column in self._codes.items():
+            column.append(self._code(name, result[name]))
+        height = result["height"]
+        self._height.append(height.as_metric() if isinstance(height, Height) else MISSING)
+        weight = result["weight"]
+        self._weight.append(weight.as_metric() if isinstance(weight, Weight) else MISSING)
+        for name, column in self._strings.items():
+            column.append(_get(result, name))
+        self.rows += 1
+
+    def extend(self, results):
+        """
+        Adds each item yielded by AAMVA.decode_many(), recording errors
+        """
+        for index, result in enumerate(results, self.rows + len(self.errors)):
+            if isinstance(result, ReadError):
+                self.errors.append((index, result))
+            else:
+                self.append(result, index)
+
+    @property
+    def categories(self):
+        """
+        Returns the list of labels for each category column, indexed by code
+        """
+        return dict(
+            (name, list(codes)) for name, codes in self._categories.items()
+        )
+
+    def columns(self, use_numpy=None):
+        """
+        Returns a dictionary of columns.  NumPy arrays are returned if
+        `use_numpy` is true, or if it is None and NumPy is installed;
+        otherwise the integer columns are array.array buffers.  The NumPy
+        integer and date arrays share memory with the batch's buffers, so no
+        more rows can be added while they exist; array.array columns and
+        string lists are copies.
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        columns = {"index": self._index}
+        columns.update(self._dates)
+        columns.update(self._codes)
+        columns["height"] = self._height
+        columns["weight"] = self._weight
+        if use_numpy:
+            columns = dict(
+                (name, numpy.asarray(memoryview(column)))
+                for name, column in columns.items()
+            )
+            for name in DATE_COLUMNS:
+                columns[name] = columns[name].view("datetime64[D]")
+            for name, column in self._strings.items():
+                columns[name] = numpy.array(column, dtype=object)
+        else:
+            columns = dict(
+                (name, array(column.typecode, column))
+                for name, column in columns.items()
+            )
+            for name, column in self._strings.items():
+                columns[name] = list(column)
+        return columns
+
+    def _code(self, name, value):
+        if value is None:
+            return MISSING
+        codes = self._categories[name]
+        try:
+            return codes[value]
+        except KeyError:
+            code = codes[value] = len(codes)
+            return code
+
+
+def decode_columns(items, parser=None):
+    """
+    Decodes an iterable of raw scans into a ColumnBatch
+    """
+    if parser is None:
+        parser = AAMVA()
+    batch = ColumnBatch()
+    batch.extend(parser.decode_many(items))
+    return batch
+
+
+def _get(result, key):
+    try:
+        return result[key]
+    except KeyError:
+        return None
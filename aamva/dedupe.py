@@ -0,0 +1,324 @@
+# dedupe.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Duplicate scan detection for very large runs of scans ("has this card
+# already been scanned today?").  Each credential is reduced to a 64-bit
+# fingerprint of its issuer, license number and document discriminator,
+# read straight out of the raw scan without decoding it.  Fingerprints are
+# kept in a Bloom filter, which answers most lookups for new cards on its
+# own, backed by a sorted array of every fingerprint for exact answers.
+
+import bisect
+import hashlib
+import math
+import random
+import struct
+import sys
+import threading
+from array import array
+
+from .aamva import (
+    AAMVA,
+    MAGSTRIPE,
+    _TRACK2_DATES,
+    _TRACK2_NUMBER,
+    ReadError,
+    _buffer,
+    _find_element,
+    sniff_format,
+)
+
+CAPACITY = 1000000
+ERROR_RATE = 0.001
+# Fingerprints are buffered in a set until there are this many (or a
+# quarter as many as are already sorted) and then merged into the array.
+PENDING_SIZE = 65536
+# Runs are merged this many fingerprints at a time, so merging never holds
+# more than a chunk of them as Python ints.
+MERGE_CHUNK = 65536
+
+# The Bloom filter is pattern-blocked: each fingerprint picks a 64-bit word
+# of the filter and one of 4096 masks of _PATTERN_BITS bits to set in it,
+# so a lookup is a single read.  Blocking needs about twice the bits of a
+# classic Bloom filter for the same false positive rate, and can't do much
+# better than 0.05% however large it is.
+_PATTERN_BITS = 7
+_PATTERN_SHIFT = 12
+_PATTERN_MASK = (1 << _PATTERN_SHIFT) - 1
+_BLOCK_OVERHEAD = 2.0
+
+# magic, filter words, fingerprint count
+_FILE_HEADER = struct.Struct("<8sQQ")
+_FILE_MAGIC = b"AAMVADD1"
+# separates the parts of an identity before hashing
+_SEPARATOR = "\x1c"
+
+
+def identity(data):
+    """
+    Returns the (IIN, license number, document discriminator) that
+    identifies the credential in a raw scan.  Only the header and the two
+    elements are read from a barcode, and only track 2 from a magstripe;
+    magstripes have no document discriminator, so it is None for them, as
+    it is for barcodes without a DCF element.
+    """
+    data = _buffer(data)
+    if sniff_format(data) == MAGSTRIPE:
+        return _magstripe_identity(data)
+    iin, version, jurisdiction_version, subfiles = AAMVA._read_header(data)
+    if not subfiles:
+        raise ReadError("No subfiles")
+    number = _find_element(data, subfiles[0], "DAQ")
+    if not number:
+        raise ReadError("Missing license number (DAQ)")
+    return iin, number, _find_element(data, subfiles[0], "DCF") or None
+
+
+def fingerprint(data):
+    """
+    Returns a stable 64-bit fingerprint of the credential in a raw scan,
+    the same in every process and on every run
+    """
+    return fingerprint_identity(*identity(data))
+
+
+def fingerprint_identity(iin, number, discriminator=None):
+    """
+    Returns the 64-bit fingerprint of an (IIN, license number, document
+    discriminator) identity, e.g. from a decoded result
+    """
+    key = iin + _SEPARATOR + number
+    if discriminator:
+        key += _SEPARATOR + discriminator
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _magstripe_identity(data):
+    start = data.find(";")
+    stop = data.find("?", start)
+    if start < 0 or stop < 0:
+        raise ReadError("Missing track 2")
+    track2 = data[start + 1: stop].split("=")
+    if len(track2) not in (2, 3):
+        raise ReadError("Invalid track 2 length")
+    iin, number = _TRACK2_NUMBER(track2[0])
+    if len(track2) == 2:
+        number += _TRACK2_DATES(track2[1])[2]  # license number overflow
+    if not number:
+        raise ReadError("Missing license number")
+    return iin, number, None
+
+
+class DedupeIndex:
+    """
+    Set of credential fingerprints for finding duplicate scans, sized for
+    `capacity` credentials with a Bloom filter false positive rate of about
+    `error_rate`.  Answers are always exact: a Bloom filter hit is checked
+    against the sorted fingerprint store, which takes 8 bytes per
+    credential.
+
+        index = DedupeIndex(capacity=20000000)
+        if not index.add(scan):
+            ...  # already scanned
+
+    Indexes built by separate workers with the same capacity and error
+    rate can be combined with merge(), and saved to and loaded from disk.
+    Methods may be called from any number of threads.
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2 * _BLOCK_OVERHEAD
+        self._init(max(1, int(math.ceil(bits / 64))))
+
+    def _init(self, words):
+        self.words = words
+        self._filter = array("Q", bytes(8 * words))
+        self._sorted = array("Q")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sorted) + len(self._pending)
+
+    def __contains__(self, data):
+        return self.contains_fingerprint(fingerprint(data))
+
+    def add(self, data):
+        """
+        Adds the credential in a raw scan to the index.  Returns True if it
+        is new, or False if it has been seen before.  Raises ReadError if
+        the scan doesn't identify a credential.
+        """
+        return self.add_fingerprint(fingerprint(data))
+
+    def contains_fingerprint(self, value):
+        pattern = _PATTERNS[value & _PATTERN_MASK]
+        if self._filter[(value >> _PATTERN_SHIFT) % self.words] & pattern != pattern:
+            return False
+        with self._lock:
+            return self._stored(value)
+
+    def add_fingerprint(self, value):
+        """
+        Adds a fingerprint to the index, returning True if it is new
+        """
+        pattern = _PATTERNS[value & _PATTERN_MASK]
+        word = (value >> _PATTERN_SHIFT) % self.words
+        with self._lock:
+            bloom = self._filter
+            if bloom[word] & pattern == pattern:
+                if self._stored(value):
+                    return False
+            else:
+                bloom[word] |= pattern
+            self._pending.add(value)
+            if len(self._pending) >= max(PENDING_SIZE, len(self._sorted) // 4):
+                self._flush()
+            return True
+
+    def merge(self, other):
+        """
+        Adds every fingerprint of another index (e.g. from another worker)
+        to this one.  Both must have been created with the same capacity
+        and error rate.
+        """
+        if self.words != other.words:
+            raise ValueError("Can't merge indexes of different sizes")
+        with other._lock:
+            bloom = other._filter.tobytes()
+            values = _merge_runs(other._sorted, array("Q", sorted(other._pending)))
+        with self._lock:
+            bloom = int.from_bytes(bloom, sys.byteorder) | int.from_bytes(
+                self._filter.tobytes(), sys.byteorder
+            )
+            self._filter = array("Q", bloom.to_bytes(8 * self.words, sys.byteorder))
+            self._flush()
+            self._sorted = _merge_runs(self._sorted, values)
+
+    def save(self, path):
+        """
+        Writes the index to a file
+        """
+        with self._lock:
+            self._flush()
+            bloom, values = self._filter, self._sorted
+            if sys.byteorder == "big":
+                bloom, values = array("Q", bloom), array("Q", values)
+                bloom.byteswap()
+                values.byteswap()
+            with open(path, "wb") as f:
+                f.write(_FILE_HEADER.pack(_FILE_MAGIC, self.words, len(values)))
+                bloom.tofile(f)
+                values.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index written by save()
+        """
+        index = cls.__new__(cls)
+        with open(path, "rb") as f:
+            header = f.read(_FILE_HEADER.size)
+            if len(header) != _FILE_HEADER.size:
+                raise ValueError("Not a dedupe index: %s" % path)
+            magic, words, count = _FILE_HEADER.unpack(header)
+            if magic != _FILE_MAGIC:
+                raise ValueError("Not a dedupe index: %s" % path)
+            index._init(0)
+            index.words = words
+            index._filter.fromfile(f, words)
+            index._sorted.fromfile(f, count)
+        if sys.byteorder == "big":
+            index._filter.byteswap()
+            index._sorted.byteswap()
+        return index
+
+    def _stored(self, value):
+        if value in self._pending:
+            return True
+        values = self._sorted
+        i = bisect.bisect_left(values, value)
+        return i < len(values) and values[i] == value
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._sorted = _merge_runs(self._sorted, array("Q", sorted(self._pending)))
+        self._pending = set()
+
+
+def _merge_runs(a, b):
+    """
+    Merges two sorted arrays of fingerprints into a new one, dropping
+    duplicates, without ever holding more than a chunk of them as Python
+    ints
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    merged = array("Q")
+    if len(b) * 8 <= len(a):
+        # A short run (such as the pending fingerprints) is inserted into
+        # the long one, which is copied a slice at a time in between.
+        i = 0
+        for value in b:
+            k = bisect.bisect_left(a, value, i)
+            merged.extend(a[i:k])
+            if k == len(a) or a[k] != value:
+                merged.append(value)
+            i = k
+        merged.extend(a[i:])
+        return merged
+    # Runs of about the same length are merged a chunk at a time: each step
+    # takes the values up to the MERGE_CHUNK-th next value of either run.  A
+    # stretch with values from only one run is copied as it is; otherwise
+    # the two pieces are merged with sorted(), which is linear on two runs.
+    i = j = 0
+    while i < len(a) or j < len(b):
+        high = min(
+            a[min(i + MERGE_CHUNK, len(a)) - 1] if i < len(a) else 1 << 64,
+            b[min(j + MERGE_CHUNK, len(b)) - 1] if j < len(b) else 1 << 64,
+        )
+        next_i = bisect.bisect_right(a, high, i)
+        next_j = bisect.bisect_right(b, high, j)
+        if next_j == j:
+            merged.extend(a[i:next_i])
+        elif next_i == i:
+            merged.extend(b[j:next_j])
+        else:
+            values = sorted(a[i:next_i].tolist() + b[j:next_j].tolist())
+            merged.extend(dict.fromkeys(values))
+        i, j = next_i, next_j
+    return merged
+
+
+def _patterns(bits, count, seed=0):
+    # Masks of `bits` distinct bits of a 64-bit word.  The generator is
+    # seeded, so every process (and every saved index) uses the same ones.
+    rng = random.Random(seed)
+    patterns = []
+    for i in range(count):
+        pattern = 0
+        while bin(pattern).count("1") < bits:
+            pattern |= 1 << rng.getrandbits(6)
+        patterns.append(pattern)
+    return tuple(patterns)
+
+
+_PATTERNS = _patterns(_PATTERN_BITS, 1 << _PATTERN_SHIFT)
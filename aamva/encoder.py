@@ -0,0 +1,603 @@
+# encoder.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Encoder for synthetic PDF417 and magstripe payloads, the inverse of
+# AAMVA.decode_barcode() and AAMVA.decode_magstripe().  Records are
+# dictionaries with the same keys the decoders return, so a decoded
+# record can be re-encoded, and random_record() makes up plausible ones
+# for load and soak testing without touching real license data.
+
+import datetime
+import random
+
+from .aamva import (
+    BARCODE_SPECS,
+    DRIVER_LICENSE,
+    EYECOLOURS,
+    FEMALE,
+    HAIRCOLOURS,
+    IDENTITY_CARD,
+    IMPERIAL,
+    MALE,
+    METRIC,
+    NOT_SPECIFIED,
+    PDF_FILETYPE,
+    PDF_LINEFEED,
+    PDF_RECORDSEP,
+    PDF_SEGTERM,
+    Height,
+    Weight,
+)
+
+# Quirks of jurisdictions whose version 1 barcodes deviate from the
+# standard, and which the decoder compensates for.
+V1_QUIRKS = {
+    # SC uses FS (0x1C) instead of RS, and its DL subfile offset is one
+    # character past the start of the subfile.
+    "636005": {"separator": "\x1C", "offset": 1},
+    # MD uses "AAMVA" as the file type instead of "ANSI "
+    "636003": {"filetype": "AAMVA"},
+}
+
+SEX_CODES = {MALE: "1", FEMALE: "2", NOT_SPECIFIED: "9"}
+
+# Issuers used for random records: state, IIN and country
+JURISDICTIONS = (
+    ("VA", "636000", "USA"),
+    ("NY", "636001", "USA"),
+    ("MD", "636003", "USA"),
+    ("SC", "636005", "USA"),
+    ("FL", "636010", "USA"),
+    ("CA", "636014", "USA"),
+    ("TX", "636015", "USA"),
+    ("OH", "636023", "USA"),
+    ("IN", "636037", "USA"),
+    ("WA", "636045", "USA"),
+    ("GA", "636055", "USA"),
+    ("ON", "636012", "CAN"),
+    ("BC", "636028", "CAN"),
+)
+
+
+""" Field formatters """
+# Each formatter takes a record and returns the value of one data element,
+# or None to leave the element out.
+
+
+def _value(key, default=None):
+    def get(record):
+        value = record.get(key)
+        if value is None:
+            return default
+        return value
+
+    return get
+
+
+def _iso(date):
+    return "%04d%02d%02d" % (date.year, date.month, date.day)
+
+
+def _usa(date):
+    return "%02d%02d%04d" % (date.month, date.day, date.year)
+
+
+def _date(key):
+    # Canadian barcodes use CCYYMMDD, everyone else MMDDCCYY
+    def get(record):
+        date = record.get(key)
+        if date is None:
+            return None
+        if record.get("country") == "CAN":
+            return _iso(date)
+        return _usa(date)
+
+    return get
+
+
+def _iso_date(key):
+    def get(record):
+        date = record.get(key)
+        if date is None:
+            return None
+        return _iso(date)
+
+    return get
+
+
+def _arrival_date(key):
+    def get(record):
+        date = (record.get("arrival_dates") or {}).get(key)
+        if date is None:
+            return None
+        if record.get("country") == "CAN":
+            return _iso(date)
+        return _usa(date)
+
+    return get
+
+
+def _is_driver_license(record):
+    return record.get("card_type", DRIVER_LICENSE) != IDENTITY_CARD
+
+
+def _license_field(key):
+    # only driver's licenses have class, restrictions and endorsements
+    def get(record):
+        if _is_driver_license(record):
+            value = record.get(key)
+            return "NONE" if value is None else value
+        return None
+
+    return get
+
+
+def _sex(record):
+    sex = record.get("sex")
+    return SEX_CODES.get(sex, sex)
+
+
+def _units(record):
+    height = record.get("height")
+    if isinstance(height, Height):
+        return height.units
+    return record.get("units")
+
+
+def _height(default):
+    def get(record):
+        height = record.get("height")
+        if height is None:
+            return default
+        if isinstance(height, str):  # version 1 decodes height as a string
+            return height
+        if height.units == METRIC:
+            return "%03d cm" % height.as_metric()
+        return "%03d in" % height.as_imperial()
+
+    return get
+
+
+def _weight_range(record):
+    weight = record.get("weight")
+    if weight is None:
+        return None
+    return str(weight.weightRange)
+
+
+def _exact_weight(units):
+    def get(record):
+        weight = record.get("weight")
+        if weight is None or not weight.exact or _units(record) != units:
+            return None
+        if units == METRIC:
+            return "%03d" % weight.as_metric()
+        return "%03d" % weight.as_imperial()
+
+    return get
+
+
+def _weight_class(record):
+    # the range is only needed when the exact weight isn't known
+    weight = record.get("weight")
+    if weight is None or weight.exact:
+        return None
+    return str(weight.weightRange)
+
+
+def _truncated(key):
+    # names that end with an ellipsis were truncated
+    def get(record):
+        value = record.get(key) or ""
+        if value.endswith("…"):
+            return value[:-1]
+        return value
+
+    return get
+
+
+def _truncation(key):
+    def get(record):
+        value = record.get(key) or ""
+        return "T" if value.endswith("…") else "N"
+
+    return get
+
+
+# Version 1
+
+
+def _v1_name(record):
+    names = [record.get("last") or "", record.get("first") or ""]
+    if record.get("middle") is not None:
+        names.append(record["middle"])
+    return ",".join(names)
+
+
+def _v1_height(units):
+    def get(record):
+        height = record.get("height")
+        if height is None or _units(record) != units:
+            return None
+        if isinstance(height, str):  # version 1 decodes height as a string
+            return height
+        if units == METRIC:
+            return "%03d" % height.as_metric()
+        return "%d%02d" % divmod(height.as_imperial(), 12)
+
+    return get
+
+
+def _v1_weight(units):
+    def get(record):
+        weight = record.get("weight")
+        if weight is None or _units(record) != units:
+            return None
+        if units == METRIC:
+            return "%03d" % weight.as_metric()
+        return "%03d" % weight.as_imperial()
+
+    return get
+
+
+def _v1_endorsements(record):
+    if _is_driver_license(record):
+        return record.get("endorsements") or ""
+    return None
+
+
+V1_ELEMENTS = (
+    # (element ID, formatter)
+    ("DAQ", _value("license_number", "")),
+    ("DAA", _v1_name),
+    ("DAG", _value("address", "")),
+    ("DAH", _value("address2")),
+    ("DAI", _value("city", "")),
+    ("DAJ", _value("state", "")),
+    ("DAK", _value("ZIP", "")),
+    ("DAR", _value("class", "")),
+    ("DAS", _value("restrictions")),
+    ("DAT", _v1_endorsements),
+    ("DAU", _v1_height(IMPERIAL)),
+    ("DAW", _v1_weight(IMPERIAL)),
+    ("DAV", _v1_height(METRIC)),
+    ("DAX", _v1_weight(METRIC)),
+    ("DAY", _value("eyes")),
+    ("DAZ", _value("hair")),
+    ("DBA", _iso_date("expiry")),
+    ("DBB", _iso_date("dob")),
+    ("DBC", _value("sex", "")),
+    ("DBD", _iso_date("issued")),
+)
+
+# Version 3
+
+
+def _v3_name(record):
+    if record.get("middle") is not None:
+        return "%s,%s" % (record.get("first") or "", record["middle"])
+    return record.get("first") or ""
+
+
+V3_ELEMENTS = (
+    ("DCA", _license_field("class")),
+    ("DCB", _license_field("restrictions")),
+    ("DCD", _license_field("endorsements")),
+    ("DBA", _date("expiry")),
+    ("DCS", _value("last", "")),
+    ("DCT", _v3_name),
+    ("DBD", _date("issued")),
+    ("DBB", _date("dob")),
+    ("DBC", _sex),
+    ("DAY", _value("eyes")),
+    ("DAU", _height(None)),
+    ("DAZ", _value("hair")),
+    ("DCE", _weight_range),
+    ("DAG", _value("address", "")),
+    ("DAH", _value("address2")),
+    ("DAI", _value("city", "")),
+    ("DAJ", _value("state", "")),
+    ("DAK", _value("ZIP", "")),
+    ("DAQ", _value("license_number", "")),
+    ("DCF", _value("document", "NONE")),
+    ("DCG", _value("country", "USA")),
+    ("DCU", _value("suffix")),
+)
+
+# Versions 4 and later split the first and middle names, and add the
+# truncation flags and exact weights.
+
+V4_ELEMENTS = (
+    ("DCA", _license_field("class")),
+    ("DCB", _license_field("restrictions")),
+    ("DCD", _license_field("endorsements")),
+    ("DBA", _date("expiry")),
+    ("DCS", _truncated("last")),
+    ("DDE", _truncation("last")),
+    ("DAC", _truncated("first")),
+    ("DDF", _truncation("first")),
+    ("DAD", _truncated("middle")),
+    ("DDG", _truncation("middle")),
+    ("DCU", _value("suffix")),
+    ("DBD", _date("issued")),
+    ("DBB", _date("dob")),
+    ("DBC", _sex),
+    ("DAY", _value("eyes")),
+    ("DAZ", _value("hair")),
+    ("DAU", _height("")),  # required from version 4
+    ("DAW", _exact_weight(IMPERIAL)),
+    ("DAX", _exact_weight(METRIC)),
+    ("DCE", _weight_class),
+    ("DAG", _value("address", "")),
+    ("DAH", _value("address2")),
+    ("DAI", _value("city", "")),
+    ("DAJ", _value("state", "")),
+    ("DAK", _value("ZIP", "")),
+    ("DAQ", _value("license_number", "")),
+    ("DCF", _value("document", "NONE")),
+    ("DCG", _value("country", "USA")),
+)
+
+# Version 5 adds the under 18/19/21 until dates
+
+V5_ELEMENTS = V4_ELEMENTS + (
+    ("DDH", _arrival_date("under_18_until")),
+    ("DDI", _arrival_date("under_19_until")),
+    ("DDJ", _arrival_date("under_21_until")),
+)
+
+# Data element layout for each AAMVA version
+BARCODE_ELEMENTS = {
+    0: V1_ELEMENTS,
+    1: V1_ELEMENTS,
+    2: V3_ELEMENTS,
+    3: V3_ELEMENTS,
+    4: V4_ELEMENTS,
+    5: V5_ELEMENTS,
+    6: V5_ELEMENTS,
+    7: V5_ELEMENTS,
+    8: V5_ELEMENTS,
+    9: V5_ELEMENTS,
+    10: V5_ELEMENTS,
+}
+
+
+def encode_barcode(
+    record, version=10, iin=None, jurisdiction_version=0, subfiles=None, quirks=None
+):
+    """
+    Encodes a record as the text of a PDF417 barcode, with a subfile
+    directory giving the offset and length of the DL/ID subfile and of each
+    jurisdiction-specific subfile that follows it.
+
+    `iin` defaults to the record's IIN.  `subfiles` is an optional mapping
+    of jurisdiction-specific subfile types (e.g. "ZV") to a mapping of their
+    data elements, and defaults to the record's own jurisdiction-specific
+    subfiles if it was decoded from a barcode.  `quirks` overrides the separator ("separator"), file
+    type ("filetype") and DL offset adjustment ("offset") of the header;
+    version 1 barcodes from SC and MD get their known quirks by default.
+    """
+    try:
+        elements = BARCODE_ELEMENTS[version]
+    except KeyError:
+        raise NotImplementedError(
+            "ERROR: Version {0} encoding not implemented!".format(version)
+        )
+    if iin is None:
+        iin = record["IIN"]
+    if quirks is None:
+        quirks = V1_QUIRKS.get(iin, {}) if version in (0, 1) else {}
+    if subfiles is None:
+        jurisdiction = record.get("jurisdiction")
+        if jurisdiction:
+            subfiles = dict(
+                (subfile_type, jurisdiction.elements(subfile_type))
+                for subfile_type in jurisdiction
+            )
+
+    values = []
+    for element, get in elements:
+        value = get(record)
+        if value is not None:
+            values.append(element + value)
+    card_type = "DL" if _is_driver_license(record) else "ID"
+    bodies = [card_type + PDF_LINEFEED.join(values) + PDF_SEGTERM]
+    types = [card_type]
+    for subfile_type, fields in (subfiles or {}).items():
+        types.append(subfile_type)
+        bodies.append(
+            subfile_type
+            + PDF_LINEFEED.join(element + value for element, value in fields.items())
+            + PDF_SEGTERM
+        )
+
+    header = (
+        "@"
+        + PDF_LINEFEED
+        + quirks.get("separator", PDF_RECORDSEP)
+        + PDF_SEGTERM
+        + quirks.get("filetype", PDF_FILETYPE)
+        + iin
+        + "%02d" % version
+    )
+    if version not in (0, 1):
+        header += "%02d" % jurisdiction_version
+    header += "%02d" % len(bodies)
+
+    offset = len(header) + 10 * len(bodies)
+    directory = [
+        "%s%04d%04d" % (card_type, offset + quirks.get("offset", 0), len(bodies[0]))
+    ]
+    for subfile_type, body in zip(types[1:], bodies[1:]):
+        offset += len(bodies[len(directory) - 1])
+        directory.append("%s%04d%04d" % (subfile_type, offset, len(body)))
+    return header + "".join(directory) + "".join(bodies)
+
+
+def encode_magstripe(record):
+    """
+    Encodes a record as the three tracks of a magstripe: name and address
+    on track 1, IIN, license number and dates on track 2, and the physical
+    description on track 3.  License numbers longer than 14 characters
+    continue after the dates on track 2.
+    """
+    # the magstripe only has room for a 13 character city
+    city = (record.get("city") or "")[:13]
+    name = "%s$%s" % (record.get("last") or "", record.get("first") or "")
+    if record.get("middle") is not None:
+        name += "$" + record["middle"]
+    track1 = "%%%s%s^%s^%s^?" % (
+        record.get("state") or "",
+        city,
+        name,
+        record.get("address") or "",
+    )
+
+    license_number = record.get("license_number") or ""
+    expiry = record["expiry"]
+    dob = record["dob"]
+    dates = "%02d%02d%s" % (expiry.year % 100, expiry.month, _iso(dob))
+    if len(license_number) > 14:
+        track2 = ";%s%s=%s0%s?" % (
+            record["IIN"],
+            license_number[:14],
+            dates,
+            license_number[14:],
+        )
+    else:
+        track2 = ";%s%s=%s0=?" % (record["IIN"], license_number, dates)
+
+    height = record.get("height")
+    if isinstance(height, Height):
+        height = "%d%02d" % divmod(height.as_imperial(), 12)
+    weight = record.get("weight")
+    if isinstance(weight, Weight):
+        weight = "%03d" % weight.as_imperial()
+    track3 = "#! %-11s%-2s%-10s%-4s%s%3s%3s%3s%3s?" % (
+        record.get("ZIP") or "",
+        record.get("class") or "",
+        record.get("restrictions") or "",
+        record.get("endorsements") or "",
+        _sex(record) or " ",
+        height or "",
+        weight or "",
+        record.get("hair") or "",
+        record.get("eyes") or "",
+    )
+    return track1 + track2 + track3
+
+
+""" Synthetic records """
+
+_FIRST = ("JOHN", "JANE", "MICHAEL", "MARIA", "DAVID", "SARAH", "JAMES", "LINDA")
+_LAST = ("SAMPLE", "PUBLIC", "DOE", "MAURY", "SMITH", "NGUYEN", "GARCIA", "OKAFOR")
+_STREETS = ("MAIN ST", "PARK AVE", "FIRST STREET", "MARTIN WAY", "BROAD ST")
+_CITIES = ("ANYTOWN", "RICHMOND", "OLYMPIA", "COLUMBIA", "SPRINGFIELD")
+_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_EPOCH = datetime.date(2020, 1, 1).toordinal()
+# Heights and weights are shared between records rather than constructed
+# for each one.
+_HEIGHTS = {
+    "USA": [Height(inches, format="USA") for inches in range(58, 78)],
+    "CAN": [Height(cm) for cm in range(150, 200)],
+}
+_WEIGHTS = {
+    "USA": [Weight(None, lbs, "USA") for lbs in range(100, 300)],
+    "CAN": [Weight(None, kg) for kg in range(45, 140)],
+}
+
+
+def random_record(rng=random, jurisdiction=None):
+    """
+    Returns a made-up record with the keys returned by the decoders, for
+    one of JURISDICTIONS (chosen at random unless given as a state).
+    """
+    # rng.random() is much cheaper than rng.choice() or rng.randrange()
+    draw = rng.random
+    if jurisdiction is None:
+        state, iin, country = JURISDICTIONS[int(draw() * len(JURISDICTIONS))]
+    else:
+        state, iin, country = next(j for j in JURISDICTIONS if j[0] == jurisdiction)
+    today = _EPOCH + int(draw() * 1500)
+    dob = datetime.date.fromordinal(today - 5840 - int(draw() * 27000))
+    issued = datetime.date.fromordinal(today - int(draw() * 2920))
+    expiry = datetime.date(issued.year + 8, dob.month, min(dob.day, 28))
+    heights = _HEIGHTS[country]
+    weights = _WEIGHTS[country]
+    height = heights[int(draw() * len(heights))]
+    driver_license = draw() < 0.8
+    return {
+        "IIN": iin,
+        "first": _FIRST[int(draw() * len(_FIRST))],
+        "last": _LAST[int(draw() * len(_LAST))],
+        "middle": _FIRST[int(draw() * len(_FIRST))] if draw() < 0.5 else None,
+        "suffix": None,
+        "prefix": None,
+        "address": "%d %s"
+        % (1 + int(draw() * 9999), _STREETS[int(draw() * len(_STREETS))]),
+        "address2": None,
+        "city": _CITIES[int(draw() * len(_CITIES))],
+        "state": state,
+        "ZIP": "%05d0000" % int(draw() * 100000),
+        "country": country,
+        "license_number": "%s%08d"
+        % (_LETTERS[int(draw() * 26)], int(draw() * 10 ** 8)),
+        "document": "%012d" % int(draw() * 10 ** 12),
+        "dob": dob,
+        "issued": issued,
+        "expiry": expiry,
+        "sex": MALE if draw() < 0.5 else FEMALE,
+        "height": height,
+        "weight": weights[int(draw() * len(weights))],
+        "units": height.units,
+        "eyes": EYECOLOURS[int(draw() * len(EYECOLOURS))],
+        "hair": HAIRCOLOURS[int(draw() * len(HAIRCOLOURS))],
+        "card_type": DRIVER_LICENSE if driver_license else IDENTITY_CARD,
+        "class": "C" if driver_license else None,
+        "restrictions": "NONE" if driver_license else None,
+        "endorsements": "NONE" if driver_license else None,
+        "arrival_dates": {},
+    }
+
+
+def generate(count, version=None, seed=0, magstripe=False):
+    """
+    Yields `count` synthetic PDF417 payloads (or magstripe swipes if
+    `magstripe` is true).  Barcode versions cycle through the versions
+    the decoder supports unless `version` is given, and every barcode
+    carries a jurisdiction-specific subfile.  The same seed always
+    produces the same payloads.
+    """
+    rng = random.Random(seed)
+    if version is None:
+        # every version the decoder supports
+        versions = [version for version in sorted(BARCODE_SPECS) if version > 0]
+    else:
+        versions = [version]
+    for i in range(count):
+        record = random_record(rng)
+        if magstripe:
+            yield encode_magstripe(record)
+            continue
+        subfile_type = "Z" + record["state"][0]
+        yield encode_barcode(
+            record,
+            versions[i % len(versions)],
+            subfiles={subfile_type: {subfile_type + "A": "%02d" % (i % 100)}},
+        )
@@ -0,0 +1,332 @@
+# reader.py
+#
+# Copyright © 2022 Rechner Fox <rechner@totallylegit.agency>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# asyncio reader for serial (USB-CDC) barcode scanners, such as the ones
+# that show up as /dev/ttyACM0.  Any number of scanners can be read from
+# a single event loop; decoding is handed off to an executor so a slow
+# decode never holds up reads from the other devices.
+#
+#     python -m aamva.reader [/dev/ttyACM0 ...]
+
+import asyncio
+import os
+import pprint
+import re
+import sys
+import tty
+
+from .aamva import AAMVA, ReadError
+
+CHUNK_SIZE = 65536
+# A partly received payload is handed over as it is if nothing more
+# arrives for this many seconds, e.g. a swipe without a line terminator.
+IDLE_TIMEOUT = 0.25
+
+# Start of a PDF417 payload (compliance indicator and data element
+# separator) or a magstripe swipe (track 1 or track 2 start sentinel)
+_START = re.compile(b"[@%;]")
+# Start of a PDF417 header, followed by RS (or FS for SC) and CR
+_HEADER = re.compile(b"@\n[\x1e\x1c]\r")
+# End sentinel of a track, or a line terminator
+_SWIPE_STOP = re.compile(b"[?\r\n]")
+_BARCODE = 1
+_SWIPE = 2
+
+
+class StreamFramer:
+    """
+    Splits a stream of bytes arriving in arbitrary chunks into complete
+    payloads:
+
+    - PDF417 payloads run from the compliance indicator (@ LF) to the end
+      of the last subfile given by the subfile directory, or to the start
+      of the next payload if that comes first.
+    - Magstripe swipes run from a % or ; start sentinel to the end
+      sentinel (?) of the third track, or to a line terminator or the start
+      of another payload after any end sentinel.
+
+    Anything between payloads, such as scanner line terminators, is
+    discarded.  Each byte is searched a bounded number of times and the
+    consumed part of the buffer is only dropped once it makes up half of
+    it, so the work done is linear in the number of bytes fed.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0  # start of the current payload, or of unsearched bytes
+        self._kind = None  # _BARCODE or _SWIPE while a payload is incomplete
+        self._end = None  # end of the current barcode, once its directory is read
+        self._scan = 0  # bytes of the current payload already searched
+        self._tracks = 0  # end sentinels seen in the current swipe
+
+    @property
+    def pending(self):
+        """True if part of a payload has been received"""
+        return self._kind is not None
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of bytes to the stream, and returns a list of the
+        payloads it completed (as bytes).
+        """
+        self._buffer += chunk
+        buffer = self._buffer
+        payloads = [bytes(buffer[start:end]) for start, end in self._spans(buffer)]
+        self._compact()
+        return payloads
+
+    def flush(self):
+        """
+        Returns whatever part of a payload has been received (or None) and
+        resets the framer, e.g. at the end of the stream.
+        """
+        payload = None
+        if self._kind is not None:
+            payload = bytes(self._buffer[self._start:])
+        self.__init__()
+        return payload
+
+    def _spans(self, buffer):
+        # Yields the (start, end) offsets of each payload completed in
+        # `buffer`, which may be any bytes-like object
+        while True:
+            if self._kind is None:
+                match = _START.search(buffer, self._start)
+                if match is None:
+                    self._start = len(buffer)
+                    return
+                self._begin(match.start(), buffer[match.start()])
+            if self._kind == _BARCODE:
+                end = self._barcode_end(buffer)
+            else:
+                end = self._swipe_end(buffer)
+            if end is None:
+                return
+            if end > self._start:
+                yield self._start, end
+            self._start = end
+            self._kind = None
+
+    def _begin(self, start, sentinel):
+        self._start = start
+        self._kind = _BARCODE if sentinel == ord("@") else _SWIPE
+        self._end = None
+        self._scan = start + 1
+        self._tracks = 0
+
+    def _barcode_end(self, buffer):
+        if self._end is None:
+            end = _directory_end(buffer, self._start)
+            if end is None:
+                return None  # need more of the header
+            if end < 0:
+                # not a barcode after all; look for a payload after the @
+                self._kind = None
+                self._start += 1
+                return self._start
+            self._end = end
+        # a scanner that overstates the subfile lengths mustn't swallow the
+        # start of the next payload
+        stop = min(self._end, len(buffer))
+        match = _HEADER.search(buffer, self._scan, stop)
+        if match is not None:
+            return match.start()
+        if len(buffer) >= self._end:
+            return self._end
+        self._scan = max(self._scan, len(buffer) - 3)
+        return None
+
+    def _swipe_end(self, buffer):
+        position = self._scan
+        while True:
+            if self._tracks and position < len(buffer):
+                # after an end sentinel, a line terminator or another
+                # payload ends the swipe
+                if buffer[position - 1] == ord("?") and buffer[position] in b"\r\n%@":
+                    return position
+            match = _SWIPE_STOP.search(buffer, position)
+            if match is None:
+                self._scan = len(buffer)
+                return None
+            position = match.end()
+            if buffer[match.start()] != ord("?"):
+                return match.start()
+            self._tracks += 1
+            if self._tracks == 3:
+                return position
+            if position == len(buffer):
+                self._scan = position
+                return None
+
+    def _compact(self):
+        if self._start > len(self._buffer) // 2:
+            shift = self._start
+            del self._buffer[:shift]
+            self._start = 0
+            self._scan = max(0, self._scan - shift)
+            if self._end is not None:
+                self._end -= shift
+
+
+def payload_spans(buffer, start=0):
+    """
+    Yields a (start, end, complete) tuple for each payload in a bytes-like
+    object (bytes, bytearray, mmap...) from offset `start` on, framed as a
+    StreamFramer would.  `complete` is False for a payload that runs into
+    the end of the buffer without having been completed.
+    """
+    framer = StreamFramer()
+    framer._start = start
+    for span in framer._spans(buffer):
+        yield span + (True,)
+    if framer.pending:
+        yield framer._start, len(buffer), False
+
+
+def _directory_end(buffer, base):
+    """
+    Reads the subfile directory of a PDF417 payload starting at `base` and
+    returns the end of its last subfile, None if the directory hasn't been
+    received yet, or -1 if this isn't a valid header.
+    """
+    if len(buffer) < base + 17:
+        return None
+    if buffer[base + 1: base + 2] != b"\n" or not buffer[base + 9: base + 17].isdigit():
+        return -1
+    if int(buffer[base + 15: base + 17]) in (0, 1):
+        directory = base + 17
+    else:
+        directory = base + 19  # jurisdiction version
+    if len(buffer) < directory + 2:
+        return None
+    entries = buffer[directory: directory + 2]
+    if not entries.isdigit():
+        return -1
+    entries = int(entries)
+    if len(buffer) < directory + 2 + entries * 10:
+        return None
+    end = directory + 2 + entries * 10
+    for entry in range(directory + 2, directory + 2 + entries * 10, 10):
+        offset = buffer[entry + 2: entry + 6]
+        length = buffer[entry + 6: entry + 10]
+        if not (offset.isdigit() and length.isdigit()):
+            return -1
+        end = max(end, base + int(offset) + int(length))
+    return end
+
+
+async def open_scanner(path):
+    """
+    Opens a scanner device (or any other character device, FIFO or pty) for
+    non-blocking reads and returns an asyncio.StreamReader for it.  Terminals
+    are switched to raw mode so the line discipline doesn't translate or
+    buffer the carriage returns in the payload.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    if os.isatty(fd):
+        tty.setraw(fd)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0)
+    )
+    return reader
+
+
+async def read_payloads(reader, chunk_size=CHUNK_SIZE, idle_timeout=IDLE_TIMEOUT):
+    """
+    Reads from a StreamReader in large chunks and yields each complete
+    payload found by a StreamFramer, as bytes.  A partial payload is
+    yielded as it is if nothing more arrives within `idle_timeout`
+    seconds, or at the end of the stream.
+    """
+    framer = StreamFramer()
+    while True:
+        if framer.pending and idle_timeout is not None:
+            try:
+                chunk = await asyncio.wait_for(reader.read(chunk_size), idle_timeout)
+            except asyncio.TimeoutError:
+                yield framer.flush()
+                continue
+        else:
+            chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        for payload in framer.feed(chunk):
+            yield payload
+    payload = framer.flush()
+    if payload:
+        yield payload
+
+
+async def decode_payloads(reader, parser=None, executor=None):
+    """
+    Yields a (payload, result) tuple for each payload read from a
+    StreamReader, where result is the decoded dictionary or the ReadError
+    raised while decoding it.  Decoding runs in `executor` (the event loop's
+    default executor if None) so the event loop is never blocked.
+    """
+    if parser is None:
+        parser = AAMVA()
+    loop = asyncio.get_running_loop()
+    async for payload in read_payloads(reader):
+        result = await loop.run_in_executor(executor, _decode, parser, payload)
+        yield payload, result
+
+
+async def scan(paths, callback, parser=None, executor=None):
+    """
+    Reads from every scanner in `paths` concurrently, calling
+    callback(path, payload, result) for each scan until all of the devices
+    are closed.
+    """
+
+    async def watch(path):
+        reader = await open_scanner(path)
+        async for payload, result in decode_payloads(reader, parser, executor):
+            callback(path, payload, result)
+
+    await asyncio.gather(*(watch(path) for path in paths))
+
+
+def main(paths):
+    def show(path, payload, result):
+        print("Got string from %s: %r\n\n\n\n" % (path, payload))
+        if isinstance(result, ReadError):
+            print("Parse error. Try again")
+            print(result)
+        else:
+            pprint.pprint(result)
+
+    print("Scan a license")
+    asyncio.run(scan(paths, show))
+
+
+def _decode(parser, payload):
+    try:
+        return parser.try_decode(payload)
+    except Exception as e:
+        error = ReadError(e)
+        error.__cause__ = e
+        return error
+
+
+if __name__ == "__main__":
+    # reading from one or more serial barcode readers
+    main(sys.argv[1:] or ["/dev/ttyACM0"])
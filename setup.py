@@ -4,6 +4,9 @@ setup(
     name='aamva',
     version='0.2.2',
     packages=['aamva'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     url='https://github.com/rechner/py-aamva',
     license='GPLv2',
     author='rechner',
@@ -1,9 +1,27 @@
+import array
+import asyncio
+import concurrent.futures
+import copy
 import datetime
+import os
+import pickle
 import pprint
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
-from unittest import skip
+import unittest.mock
 
 import aamva
+import aamva.age
+import aamva.archive
+import aamva.bench
+import aamva.bulk
+import aamva.columnar
+import aamva.dedupe
+import aamva.encoder
+import aamva.reader
 
 
 # Potential other sources for unit tests: https://github.com/c0shea/IdParser/tree/master/IdParser.Tests
@@ -209,13 +227,340 @@ class BarcodeTestMethods(unittest.TestCase):
         self.assertIs(data['suffix'], None)
         pprint.pprint(data)
 
-    @skip
     def test_v10(self):
         parser = aamva.AAMVA()
         data = parser.decode_barcode(PDF417.v10_id_example)
+        self.assertEqual(data['version'], 10)
+        self.assertEqual(data['license_number'], 'T64235789')
+        self.assertEqual(data['dob'], datetime.date(1986, 6, 6))
+        self.assertEqual(data['suffix'], 'JR')
+        self.assertEqual(data['height'], aamva.Height(68, format='USA'))
         pprint.pprint(data)
 
 
+class JurisdictionTestMethods(unittest.TestCase):
+    def test_lazy_subfiles(self):
+        key = ('636055', 'ZG')
+        decoder = unittest.mock.Mock(side_effect=dict)
+        aamva.SUBFILE_DECODERS[key] = decoder
+        self.addCleanup(aamva.SUBFILE_DECODERS.pop, key, None)
+        subfiles = aamva.AAMVA().decode(PDF417.ga)['jurisdiction']
+        self.assertEqual(list(subfiles), ['ZG'])
+        decoder.assert_not_called()
+        self.assertEqual(subfiles['ZG']['ZGD'], 'ROCKDALE')
+        self.assertEqual(subfiles['ZG']['ZGA'], 'N')
+        decoder.assert_called_once()
+        aamva.SUBFILE_DECODERS.pop(key)
+        data = aamva.AAMVA().decode(PDF417.ga)
+        self.assertEqual(data['jurisdiction']['ZG']['ZGD'], 'ROCKDALE')
+        # directory offsets that miss the subfile designator
+        self.assertEqual(dict(aamva.AAMVA().decode(PDF417.oh)['jurisdiction']['ZO']),
+                         {'ZOA': 'Y', 'ZOB': 'Y', 'ZOE': '05262020'})
+        self.assertEqual(aamva.AAMVA().decode(PDF417.ca)['jurisdiction']['ZC']['ZCA'], 'Y')
+        self.assertEqual(pickle.loads(pickle.dumps(data)), data)
+
+    def test_registry(self):
+        key = ('636055', 'ZG')
+        aamva.SUBFILE_DECODERS[key] = lambda elements: elements['ZGD'].title()
+        self.addCleanup(aamva.SUBFILE_DECODERS.pop, key)
+        data = aamva.AAMVA().decode(PDF417.ga.encode('latin-1'))
+        self.assertEqual(data['jurisdiction']['ZG'], 'Rockdale')
+        self.assertEqual(data['jurisdiction'].elements('ZG')['ZGA'], 'N')
+
+    def test_v3_indiana(self):
+        record = dict(aamva.encoder.random_record(jurisdiction='IN'), height=None, hair=None)
+        data = aamva.encoder.encode_barcode(record, 3, subfiles={'ZI': {'ZIJ': '5-10', 'ZIL': 'BRO'}})
+        data = aamva.AAMVA().decode(data)
+        self.assertEqual((data['height'], data['hair']), (aamva.Height(70, 'USA'), 'BRO'))
+
+
+class SniffTestMethods(unittest.TestCase):
+    def test_sniff_format(self):
+        self.assertEqual(aamva.sniff_format(Magstripe.tx), aamva.MAGSTRIPE)
+        self.assertEqual(aamva.sniff_format(';6360100462172082009=2101198701010=?'), aamva.MAGSTRIPE)
+        self.assertEqual(aamva.sniff_format(PDF417.va), aamva.PDF417)
+        self.assertEqual(aamva.sniff_format(PDF417.ca), aamva.PDF417)
+        self.assertEqual(aamva.sniff_format('garbage'), aamva.ANY)
+        self.assertEqual(aamva.sniff_format(''), aamva.ANY)
+        self.assertEqual(aamva.sniff_format(PDF417.va.encode('latin-1')), aamva.PDF417)
+        self.assertEqual(aamva.sniff_format(memoryview(Magstripe.tx.encode())), aamva.MAGSTRIPE)
+        self.assertEqual(aamva.sniff_format(bytearray(b'  @\n\x1e\r')), aamva.PDF417)
+
+    def test_dispatch(self):
+        stages = []
+        parser = aamva.AAMVA(instrument=lambda stage, seconds: stages.append(stage))
+        parser.decode(PDF417.ga)
+        self.assertNotIn('magstripe_failed', stages)
+        # a sniffed magstripe that fails reports its own error
+        with self.assertRaises(aamva.ReadError) as context:
+            parser.decode('%TXAUSTIN^DOE$JOHN^12345 SHERBOURNE ST^?')
+        self.assertNotIn('barcode_failed', stages)
+        self.assertNotEqual(str(context.exception), 'Unable to decode as barcode')
+        # magstripe only, but given a barcode: the magstripe decoder still decides
+        self.assertRaises(aamva.ReadError, aamva.AAMVA(format=[aamva.MAGSTRIPE]).decode, PDF417.va)
+
+
+class BytesTestMethods(unittest.TestCase):
+    def test_bytes_input(self):
+        parser = aamva.AAMVA()
+        for data in (PDF417.va, PDF417.ca, PDF417.sc, PDF417.indiana, Magstripe.tx):
+            raw = data.encode('latin-1')
+            for buffer in (raw, bytearray(raw), memoryview(raw)):
+                self.assertEqual(parser.decode(buffer), parser.decode(data))
+        self.assertEqual(aamva.sniff_format(b' @\n\x1e\r'), aamva.PDF417)
+        self.assertEqual(aamva.sniff_format(b'%TX'), aamva.MAGSTRIPE)
+
+    def test_bytes_peek(self):
+        parser = aamva.AAMVA()
+        raw = memoryview(PDF417.wa.encode('latin-1'))
+        self.assertEqual(parser.peek_header(raw), parser.peek_header(PDF417.wa))
+        self.assertEqual(parser.peek_key(raw), ('636045', 'ANASTPM320QD'))
+
+    def test_bytes_errors(self):
+        parser = aamva.AAMVA()
+        self.assertRaises(aamva.ReadError, parser.decode, b'garbage')
+        self.assertRaises(aamva.ReadError, parser.decode, PDF417.va.replace('ANSI', 'ANSO').encode('latin-1'))
+
+
+class PeekTestMethods(unittest.TestCase):
+    def test_peek_header(self):
+        parser = aamva.AAMVA()
+        header = parser.peek_header(PDF417.va)
+        self.assertEqual(header.iin, '636000')
+        self.assertEqual(header.version, 3)
+        self.assertEqual(header.jurisdiction_version, 0)
+        header = parser.peek_header(PDF417.md_aamva)
+        self.assertEqual(header.iin, '636003')
+        self.assertEqual(header.version, 1)
+        self.assertIsNone(header.jurisdiction_version)
+
+    def test_peek_key(self):
+        parser = aamva.AAMVA()
+        for sample in (PDF417.aamva_v1, PDF417.va, PDF417.ga, PDF417.indiana, PDF417.wa, PDF417.wa_edl,
+                       PDF417.ca, PDF417.ny, PDF417.md_aamva, PDF417.sc, PDF417.oh, PDF417.v10_id_example):
+            data = parser.decode_barcode(sample)
+            self.assertEqual(parser.peek_key(sample), (data['IIN'], data['license_number']))
+        self.assertEqual(parser.peek_key(PDF417.ga.replace('\nDAQ123456789', '')), ('636055', None))
+
+
+class LazyTestMethods(unittest.TestCase):
+    def test_lazy_matches_eager(self):
+        eager = aamva.AAMVA()
+        lazy = aamva.AAMVA(lazy=True)
+        for sample in (PDF417.aamva_v1, PDF417.va, PDF417.ga, PDF417.indiana, PDF417.wa, PDF417.ca,
+                       PDF417.ny, PDF417.md_aamva, PDF417.sc, PDF417.oh, PDF417.v10_id_example):
+            data = lazy.decode_barcode(sample)
+            self.assertIsInstance(data, aamva.LazyRecord)
+            self.assertEqual(data, eager.decode_barcode(sample))
+            self.assertEqual(data.copy(), eager.decode_barcode(sample))
+
+    def test_lazy_converts_on_read(self):
+        # a malformed height only fails when it is read
+        sample = PDF417.ga.replace('DAU064 in', 'DAUXYZ in')
+        self.assertRaises(ValueError, aamva.AAMVA().decode_barcode, sample)
+        data = aamva.AAMVA(lazy=True).decode_barcode(sample)
+        self.assertEqual(data['dob'], datetime.date(1957, 7, 1))
+        self.assertEqual(data['expiry'], datetime.date(2017, 7, 1))
+        self.assertEqual(data['license_number'], '123456789')
+        self.assertRaises(ValueError, data.__getitem__, 'height')
+        self.assertRaises(KeyError, data.__getitem__, 'missing')
+        self.assertIsNone(data.get('missing'))
+
+
+class RecordTestMethods(unittest.TestCase):
+    def test_record_access(self):
+        data = aamva.AAMVA().decode_barcode(PDF417.ga)
+        record = aamva.AAMVA(records=True).decode_barcode(PDF417.ga)
+        self.assertIsInstance(record, aamva.License)
+        self.assertEqual(record.header.iin, '636055')
+        self.assertEqual(record.header.version, 6)
+        self.assertEqual(record.header.jurisdiction_version, 0)
+        self.assertEqual(record.dob, datetime.date(1957, 7, 1))
+        self.assertEqual(record.vehicle_class, 'C')
+        self.assertEqual(record['class'], 'C')
+        self.assertEqual(record['IIN'], '636055')
+        self.assertIs(record.arrival_dates, aamva.NO_ARRIVAL_DATES)
+        self.assertIs(record.warnings, aamva.NO_WARNINGS)
+        self.assertEqual(record.to_dict(), data)
+        self.assertEqual(record, data)
+
+    def test_magstripe_record(self):
+        data = aamva.AAMVA().decode(Magstripe.fl)
+        record = aamva.AAMVA(records=True).decode(Magstripe.fl)
+        self.assertEqual(record.header.format, aamva.MAGSTRIPE)
+        self.assertEqual(record.first, 'JOHN')
+        self.assertEqual(record.to_dict(), data)
+
+    def test_record_size(self):
+        parser = aamva.AAMVA()
+        for sample in (PDF417.va, PDF417.ga, PDF417.indiana, PDF417.sc):
+            data = parser.decode_barcode(sample)
+            record = aamva.License.from_dict(data)
+            dict_size = (sys.getsizeof(data) + sys.getsizeof(data['arrival_dates']) +
+                         sys.getsizeof(data['warnings']))
+            # headers are shared between records, so only the record itself counts
+            self.assertLess(sys.getsizeof(record) * 3, dict_size)
+        self.assertIs(aamva.License.from_dict(parser.decode_barcode(PDF417.va)).header,
+                      aamva.License.from_dict(parser.decode_barcode(PDF417.va_under21)).header)
+
+
+class InstrumentTestMethods(unittest.TestCase):
+    def test_stage_timings(self):
+        timings = aamva.StageTimings()
+        parser = aamva.AAMVA(instrument=timings)
+        self.assertEqual(parser.decode(PDF417.va), aamva.AAMVA().decode(PDF417.va))
+        parser.decode(Magstripe.tx)
+        self.assertRaises(aamva.ReadError, parser.decode, 'garbage')
+        report = timings.report()
+        counts = dict((stage, totals['count']) for stage, totals in report.items())
+        self.assertEqual(counts, {
+            'decode': 2, 'error': 1,
+            'magstripe': 1, 'magstripe_failed': 1,
+            'barcode': 1, 'barcode_failed': 1,
+            'header': 1, 'elements': 1, 'fields': 1, 'units': 1,
+        })
+        self.assertTrue(all(totals['max'] >= totals['mean'] > 0 for totals in report.values()))
+        timings.reset()
+        self.assertEqual(timings.report(), {})
+
+    def test_callback(self):
+        stages = []
+        parser = aamva.AAMVA(format=[aamva.PDF417], records=True,
+                             instrument=lambda stage, seconds: stages.append(stage))
+        self.assertEqual(parser.decode(PDF417.ga).state, 'GA')
+        self.assertEqual(stages, ['header', 'elements', 'fields', 'units', 'barcode', 'decode'])
+
+
+class ErrorTestMethods(unittest.TestCase):
+    def assertError(self, result, code, offset):
+        self.assertIsInstance(result, aamva.ReadError)
+        self.assertEqual((result.code, result.offset), (code, offset))
+
+    def test_try_decode(self):
+        parser = aamva.AAMVA()
+        self.assertEqual(parser.try_decode(PDF417.ga), parser.decode(PDF417.ga))
+        self.assertError(parser.try_decode(PDF417.ga[:120]), aamva.MISSING_ELEMENT, 120)
+        self.assertError(parser.try_decode(PDF417.va.replace('ANSI', 'ANSO')), aamva.HEADER_ERROR, 4)
+        self.assertError(parser.try_decode(PDF417.va[:24]), aamva.DIRECTORY_ERROR, 23)
+        self.assertError(parser.try_decode(PDF417.ga.replace('0600', '1100', 1)), aamva.VERSION_ERROR, 15)
+        bad_eyes = PDF417.ga.replace('DAYBLU', 'DAYXXX')
+        error = parser.try_decode(bad_eyes.encode('latin-1'))
+        self.assertError(error, aamva.ELEMENT_ERROR, bad_eyes.index('XXX'))
+        self.assertError(parser.try_decode('%E?'), aamva.CARD_ERROR, 0)
+        self.assertError(parser.try_decode(Magstripe.tx.replace(';', ':')), aamva.SWIPE_ERROR, 40)
+        with self.assertRaises(aamva.ReadError) as context:
+            parser.decode(PDF417.ga[:120])
+        self.assertEqual(context.exception.code, aamva.MISSING_ELEMENT)
+
+    def test_decode_many(self):
+        results = list(aamva.AAMVA().decode_many([PDF417.va, PDF417.va[:60], 'garbage']))
+        self.assertEqual(results[0]['dob'], datetime.date(1958, 7, 15))
+        self.assertEqual([error.code for error in results[1:]], [aamva.MISSING_ELEMENT, aamva.HEADER_ERROR])
+        error = pickle.loads(pickle.dumps(results[1]))
+        self.assertEqual((error.code, error.offset), (results[1].code, results[1].offset))
+
+    def test_optimized(self):
+        # validation doesn't rely on assert statements
+        script = ('import aamva\n'
+                  'print(aamva.AAMVA().try_decode("@\\n\\x1e\\rANSO 636000").code)\n'
+                  'aamva.AAMVA().decode_barcode("garbage")')
+        result = subprocess.run([sys.executable, '-O', '-c', script], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.strip(), aamva.HEADER_ERROR)
+        self.assertIn('ReadError: Missing compliance character', result.stderr)
+
+
+class CacheTestMethods(unittest.TestCase):
+    def test_cache_hits(self):
+        cache = aamva.DecodeCache(maxsize=2)
+        parser = aamva.AAMVA(cache=cache)
+        first = parser.decode(PDF417.indiana)
+        first['warnings'].append('poisoned')
+        first['first'] = 'poisoned'
+        second = parser.decode(PDF417.indiana)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(second, aamva.AAMVA().decode(PDF417.indiana))
+        # evicts the least recently used result
+        parser.decode(PDF417.va)
+        parser.decode(PDF417.ga)
+        self.assertEqual(len(cache), 2)
+        parser.decode(PDF417.indiana)
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_cache_records(self):
+        cache = aamva.DecodeCache()
+        parser = aamva.AAMVA(cache=cache, records=True)
+        first = parser.decode(PDF417.va)
+        first.first = 'poisoned'
+        self.assertEqual(parser.decode(PDF417.va).first, 'JUSTIN')
+        # parsers with different settings don't share results
+        self.assertIsInstance(aamva.AAMVA(cache=cache).decode(PDF417.va), dict)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_cache_ttl(self):
+        now = [0.0]
+        cache = aamva.DecodeCache(ttl=10, clock=lambda: now[0])
+        parser = aamva.AAMVA(cache=cache)
+        parser.decode(Magstripe.tx)
+        now[0] = 5
+        parser.decode(Magstripe.tx)
+        now[0] = 20
+        parser.decode(Magstripe.tx)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+class DateTestMethods(unittest.TestCase):
+    def test_parse_date(self):
+        self.assertEqual(aamva.parse_date('07151958', 'USA'), datetime.date(1958, 7, 15))
+        self.assertEqual(aamva.parse_date('19580715', 'CAN'), datetime.date(1958, 7, 15))
+        self.assertEqual(aamva.parse_date('19580715', 'iso'), datetime.date(1958, 7, 15))
+        self.assertIsNone(aamva.parse_date('19580715', 'MEX'))
+
+    def test_parse_dates(self):
+        self.assertEqual(aamva.parse_dates(['07151958', '', None, '07151958', '02292000'], 'USA'),
+                         [datetime.date(1958, 7, 15), None, None, datetime.date(1958, 7, 15),
+                          datetime.date(2000, 2, 29)])
+
+    def test_magstripe_december_expiry(self):
+        data = aamva.AAMVA().decode(Magstripe.tx.replace('=1508', '=1512'))
+        self.assertEqual(data['expiry'], datetime.date(2015, 12, 31))
+
+
+class ColumnarTestMethods(unittest.TestCase):
+    scans = [PDF417.va, PDF417.ga, 'garbage', Magstripe.fl, PDF417.indiana]
+
+    def test_array_columns(self):
+        batch = aamva.columnar.decode_columns(self.scans)
+        self.assertEqual(batch.rows, 4)
+        self.assertEqual([index for index, error in batch.errors], [2])
+        columns = batch.columns(use_numpy=False)
+        self.assertEqual(list(columns['index']), [0, 1, 3, 4])
+        epoch = datetime.date(1970, 1, 1)
+        self.assertEqual(epoch + datetime.timedelta(days=columns['dob'][0]), datetime.date(1958, 7, 15))
+        self.assertEqual(columns['issued'][2], aamva.columnar.NAT)  # magstripe has no issue date
+        categories = batch.categories
+        self.assertEqual([categories['sex'][columns['sex'][row]] for row in (0, 1, 3)], ['M', 'F', 'F'])
+        self.assertEqual([categories['state'][code] for code in columns['state']], ['VA', 'GA', 'FL', 'IN'])
+        self.assertEqual(categories['eyes'][columns['eyes'][3]], 'HAZ')
+        self.assertEqual(list(columns['height'][:2]), [190, 163])  # 75 and 64 in
+        self.assertEqual(columns['weight'][0], aamva.columnar.MISSING)
+        self.assertEqual(columns['weight'][1], 55)  # 120 lbs
+        self.assertEqual(columns['license_number'], ['T16700185', '123456789', '0462172082009', '1234-56-7890'])
+        self.assertEqual(columns['document'][2], None)
+        # the columns are copies, so the batch can keep filling
+        columns['license_number'].clear()
+        batch.append(aamva.AAMVA().decode(PDF417.ga))
+        self.assertEqual(len(columns['index']), 4)
+        self.assertEqual(len(batch.columns(use_numpy=False)['license_number']), 5)
+
+    @unittest.skipIf(aamva.columnar.numpy is None, 'NumPy is not installed')
+    def test_numpy_columns(self):
+        columns = aamva.columnar.decode_columns(self.scans).columns()
+        self.assertEqual(columns['dob'].dtype.name, 'datetime64[D]')
+        self.assertEqual(columns['dob'][0].astype(datetime.date), datetime.date(1958, 7, 15))
+        self.assertEqual(list(columns['height'][:2]), [190, 163])
+
+
 class MagstripeTestMethods(unittest.TestCase):
     def test_tx(self):
         parser = aamva.AAMVA()
@@ -252,6 +597,429 @@ class MagstripeTestMethods(unittest.TestCase):
         self.assertEqual(data['dob'], datetime.date(1987, 1, 1))
         self.assertEqual(data['expiry'], datetime.date(2021, 1, 31))
 
+    def test_city_layout(self):
+        parser = aamva.AAMVA()
+        # a 13 character city runs into the name, or is followed by a separator
+        data = parser.decode('%WAPORT TOWNSENDDOE$JOHN^1 MAIN ST$APT 2^?;6360450123456789=2101198701010=?#! 98368      C               1600150BROBLU?')
+        self.assertEqual((data['city'], data['last'], data['address']), ('PORT TOWNSEND', 'DOE', '1 MAIN ST'))
+        self.assertEqual(data['license_number'], '0123456789')
+        data = parser.decode(Magstripe.fl.replace('DELRAY BEACH', 'PORT TOWNSEND'))
+        self.assertEqual((data['city'], data['first']), ('PORT TOWNSEND', 'JOHN'))
+        self.assertIsNone(data['weight'])
+
+    def test_decode_magstripes(self):
+        parser = aamva.AAMVA()
+        swipes = [Magstripe.tx, Magstripe.fl, PDF417.va, Magstripe.fl2.encode()]
+        results = list(parser.decode_magstripes(swipes))
+        self.assertEqual(results[:2], [parser.decode(Magstripe.tx), parser.decode(Magstripe.fl)])
+        self.assertIsInstance(results[2], aamva.ReadError)
+        self.assertEqual(results[3], parser.decode(Magstripe.fl2))
+
+
+class UnitsTestMethods(unittest.TestCase):
+    def test_interned(self):
+        self.assertIs(aamva.Height(70, 'USA'), aamva.Height(70, format='USA'))
+        self.assertIs(aamva.Weight(None, 170, 'USA'), aamva.Weight(None, 170, 'USA'))
+        height = aamva.Height(178)
+        with self.assertRaises(AttributeError):
+            height.height = 180
+        self.assertIs(pickle.loads(pickle.dumps(height)), height)
+        self.assertIs(copy.deepcopy(aamva.Weight(4)), aamva.Weight(4))
+        # equal values of another type keep their own type
+        self.assertIsInstance(aamva.Height(70, 'USA').height, int)
+        self.assertIsInstance(aamva.Height(70.0, 'USA').height, float)
+        with self.assertRaises(aamva.WeightError):  # not an int, even once 170 is cached
+            aamva.Weight(None, 170.0, 'USA')
+
+    def test_equality(self):
+        self.assertEqual(aamva.Height(178, 'ISO'), aamva.Height(178, 'CAN'))
+        self.assertEqual(hash(aamva.Height(178, 'ISO')), hash(aamva.Height(178, 'CAN')))
+        self.assertNotEqual(aamva.Height(70, 'USA'), aamva.Height(70))
+        self.assertNotEqual(aamva.Height(70, 'USA'), None)
+        self.assertEqual(aamva.Weight(None, 80), aamva.Weight(None, 170, 'USA'))
+        self.assertEqual(len({aamva.Weight(None, 80), aamva.Weight(None, 170, 'USA'), aamva.Weight(4)}), 2)
+
+    def test_weight_ranges(self):
+        self.assertEqual([aamva.Weight(None, kg).weightRange for kg in (31, 32, 145, 146, 200)], [0, 1, 8, 9, 9])
+        self.assertEqual([aamva.Weight(None, lbs, 'USA').weightRange for lbs in (70, 71, 320, 321)], [0, 1, 8, 9])
+        for units in ('ISO', 'USA'):
+            for weight_range in range(10):
+                weight = aamva.Weight(weight_range, format=units)
+                self.assertEqual(aamva.Weight(None, weight.weight, units).weightRange, weight_range)
+
+    def test_convert(self):
+        heights = [aamva.Height(70, 'USA'), None, aamva.Height(178)]
+        self.assertEqual(aamva.convert_heights(heights), [178, None, 178])
+        self.assertEqual(aamva.convert_heights(heights, aamva.IMPERIAL), [70, None, 70])
+        weights = [aamva.Weight(None, 220, 'USA'), aamva.Weight(0), None]
+        self.assertEqual(aamva.convert_weights(weights), [100, 20, None])
+        self.assertEqual(aamva.convert_weights(weights, aamva.IMPERIAL), [220, 44, None])
+
+
+class ThreadTestMethods(unittest.TestCase):
+    def test_shared_decoder(self):
+        items = [getattr(PDF417, name) for name in ('aamva_v1', 'sc', 'va', 'ga', 'indiana', 'wa', 'ca', 'ny')]
+        items += [Magstripe.tx, Magstripe.fl, Magstripe.fl2]
+        items += [item.encode('latin-1') for item in items] + ['ANSO']
+        items += list(aamva.encoder.generate(50, seed=2))
+        serial = list(aamva.AAMVA().decode_many(items))
+        timings = aamva.StageTimings()
+        parsers = [aamva.AAMVA(), aamva.AAMVA(cache=aamva.DecodeCache(64), instrument=timings)]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible
+        try:
+            for parser in parsers:
+                def work(seed):
+                    order = list(range(len(items)))
+                    random.Random(seed).shuffle(order)
+                    results = [None] * len(items)
+                    for i in order:
+                        try:
+                            results[i] = parser.decode(items[i])
+                        except aamva.ReadError as e:
+                            results[i] = e
+                    return results
+
+                with concurrent.futures.ThreadPoolExecutor(8) as pool:
+                    runs = list(pool.map(work, range(32)))
+                for results in runs:
+                    for result, expected in zip(results, serial):
+                        if isinstance(expected, aamva.ReadError):
+                            self.assertIsInstance(result, aamva.ReadError)
+                        else:
+                            self.assertEqual(result, expected)
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(timings.report()['decode']['count'] + timings.report()['error']['count'],
+                         32 * len(items))
+
+
+class BatchTestMethods(unittest.TestCase):
+    def test_decode_many(self):
+        parser = aamva.AAMVA()
+        scans = [PDF417.va, 'garbage', Magstripe.tx, PDF417.oh_missing_record_separator, PDF417.ga]
+        results = list(parser.decode_many(iter(scans)))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0], parser.decode(PDF417.va))
+        self.assertIsInstance(results[1], aamva.ReadError)
+        self.assertEqual(results[2]['IIN'], '636015')
+        self.assertIsInstance(results[3], aamva.ReadError)
+        self.assertEqual(results[4]['state'], 'GA')
+
+    def test_bulk_decoder(self):
+        scans = [PDF417.va, PDF417.ga, 'garbage', Magstripe.fl, PDF417.indiana] * 20
+        decoder = aamva.bulk.BulkDecoder(workers=2, chunksize=7)
+        results = list(decoder.decode(scans))
+        expected = list(aamva.AAMVA().decode_many(scans))
+        self.assertEqual(len(results), len(expected))
+        for result, wanted in zip(results, expected):
+            if isinstance(wanted, aamva.ReadError):
+                self.assertIsInstance(result, aamva.ReadError)
+            else:
+                self.assertEqual(result, wanted)
+        self.assertEqual(sum(stats.items for stats in decoder.stats.values()), len(scans))
+        self.assertTrue(all(rate > 0 for rate in decoder.throughput().values()))
+
+
+class ReaderTestMethods(unittest.TestCase):
+    def test_pty_scanner(self):
+        # The master side of a pty stands in for the scanner
+        master, slave = os.openpty()
+        path = os.ttyname(slave)
+        scans = (PDF417.va + PDF417.ga + Magstripe.tx + '\r\n').encode('latin-1')
+
+        async def run():
+            reader = await aamva.reader.open_scanner(path)
+            # one scan split across writes, then two scans in a single write
+            os.write(master, scans[:5])
+            os.write(master, scans[5:200])
+            await asyncio.sleep(0.01)
+            os.write(master, scans[200:])
+            results = []
+            async for payload, result in aamva.reader.decode_payloads(reader):
+                results.append(result)
+                if len(results) == 3:
+                    return results
+
+        try:
+            results = asyncio.run(asyncio.wait_for(run(), 5))
+        finally:
+            os.close(master)
+            os.close(slave)
+        self.assertEqual(results[0]['license_number'], 'T16700185')
+        self.assertEqual(results[1]['state'], 'GA')
+        self.assertEqual(results[2]['IIN'], '636015')
+
+
+class EncoderTestMethods(unittest.TestCase):
+    def test_reencode_samples(self):
+        parser = aamva.AAMVA()
+        for name in ('aamva_v1', 'sc', 'md_aamva', 'va', 'ga', 'indiana', 'ca', 'ny', 'oh', 'v10_id_example'):
+            data = getattr(PDF417, name)
+            header = parser.peek_header(data)
+            encoded = aamva.encoder.encode_barcode(
+                parser.decode(data), header.version, jurisdiction_version=header.jurisdiction_version or 0)
+            self.assertEqual(parser.decode(encoded), parser.decode(data), name)
+        for name in ('tx', 'fl'):
+            data = getattr(Magstripe, name)
+            self.assertEqual(parser.decode(aamva.encoder.encode_magstripe(parser.decode(data))),
+                             parser.decode(data), name)
+
+    def test_quirks(self):
+        record = aamva.AAMVA().decode(PDF417.sc)
+        encoded = aamva.encoder.encode_barcode(record, 1)
+        self.assertEqual(encoded[:25], PDF417.sc[:25])
+        record = aamva.encoder.random_record(jurisdiction='SC')
+        self.assertEqual(aamva.encoder.encode_barcode(record, 1)[2], '\x1c')
+        self.assertEqual(aamva.encoder.encode_barcode(record, 10)[2], '\x1e')
+
+    def test_generate(self):
+        parser = aamva.AAMVA()
+        barcodes = list(aamva.encoder.generate(100, seed=1))
+        self.assertEqual(barcodes, list(aamva.encoder.generate(100, seed=1)))
+        versions = set()
+        for data in barcodes:
+            header = parser.peek_header(data)
+            versions.add(header.version)
+            iin, version, jurisdiction_version, subfiles = parser._read_header(data)
+            self.assertEqual([data[start:start + 2] for subfile_type, start, end in subfiles[1:]],
+                             [subfile_type for subfile_type, start, end in subfiles[1:]])
+            # the decoder reads two extra characters of version 1 Z-subfiles
+            self.assertEqual(subfiles[-1][2], len(data) + (2 if version == 1 else 0))
+            self.assertEqual(parser.decode(data)['IIN'], iin)
+        self.assertEqual(versions, {1, 3, 4, 5, 6, 7, 8, 9, 10})
+        for data in aamva.encoder.generate(20, seed=1, magstripe=True):
+            self.assertEqual(len(parser.decode(data)['license_number']), 9)
+
+
+class BenchTestMethods(unittest.TestCase):
+    def test_generated_data(self):
+        parser = aamva.AAMVA()
+        for data in aamva.bench.generate(len(aamva.bench.BARCODES) * 2):
+            self.assertEqual(parser.decode(data)['IIN'][:3], '636')
+
+    def test_samples(self):
+        # the benchmark samples are copies of these
+        barcodes = [PDF417.aamva_v1, PDF417.sc, PDF417.va, PDF417.indiana, PDF417.ga,
+                    PDF417.ny, PDF417.oh, PDF417.v10_id_example]
+        self.assertEqual(list(aamva.bench.BARCODES.values()), barcodes)
+        self.assertEqual(list(aamva.bench.MAGSTRIPES.values()), [Magstripe.tx, Magstripe.fl])
+
+    def test_compare(self):
+        report = aamva.bench.run('height/', rounds=20)
+        self.assertEqual(set(report['results']), {'height/imperial', 'height/metric'})
+        self.assertEqual(aamva.bench.compare(report, report), [])
+        faster = {'results': dict((name, dict(result, ops=result['ops'] * 10))
+                                  for name, result in report['results'].items())}
+        regressions = aamva.bench.compare(report, faster)
+        self.assertEqual([(name, metric) for name, metric, previous, current in regressions],
+                         [('height/imperial', 'ops'), ('height/metric', 'ops')])
+        # small allocation differences are noise, even from nothing
+        result = {'ops': 1000, 'alloc': 0}
+        for alloc, flagged in ((100, False), (aamva.bench.ALLOC_FLOOR * 4, True)):
+            current = {'results': {'case': dict(result, alloc=alloc)}}
+            regressions = aamva.bench.compare(current, {'results': {'case': result}})
+            self.assertEqual(bool(regressions), flagged)
+
+
+class FramerTestMethods(unittest.TestCase):
+    scans = [PDF417.va, PDF417.ga, PDF417.md_aamva, PDF417.sc, Magstripe.tx, PDF417.aamva_v1,
+             Magstripe.fl, Magstripe.fl2 + '\r\n', PDF417.ca]
+
+    def test_chunks(self):
+        parser = aamva.AAMVA()
+        stream = ''.join(self.scans).encode('latin-1')
+        expected = [parser.decode(scan) for scan in self.scans]
+        for size in (1, 5, 64, len(stream)):
+            framer = aamva.reader.StreamFramer()
+            payloads = []
+            for i in range(0, len(stream), size):
+                payloads.extend(framer.feed(stream[i:i + size]))
+            self.assertFalse(framer.pending)
+            self.assertEqual([parser.decode(payload) for payload in payloads], expected, size)
+
+    def test_partial(self):
+        framer = aamva.reader.StreamFramer()
+        data = PDF417.ga.encode('latin-1')
+        self.assertEqual(framer.feed(b'\r\n' + data[:100]), [])
+        self.assertTrue(framer.pending)
+        self.assertEqual(framer.feed(data[100:]), [data[:-2]])
+        # a swipe without a terminator is only complete at the end of the stream
+        self.assertEqual(framer.feed(Magstripe.fl2.encode()), [])
+        self.assertEqual(framer.flush(), Magstripe.fl2.encode())
+        self.assertIsNone(framer.flush())
+
+    def test_read_payloads(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(PDF417.wa.encode('latin-1') + Magstripe.fl2.encode())
+            payloads = []
+            async for payload in aamva.reader.read_payloads(reader, idle_timeout=0.01):
+                payloads.append(payload)
+                if len(payloads) == 2:
+                    reader.feed_eof()
+            return payloads
+
+        payloads = asyncio.run(asyncio.wait_for(run(), 5))
+        self.assertEqual(payloads, [PDF417.wa.encode('latin-1')[:-2], Magstripe.fl2.encode()])
+
+
+class ArchiveTestMethods(unittest.TestCase):
+    scans = FramerTestMethods.scans
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'scans.bin')
+        with open(self.path, 'wb') as f:
+            f.write(''.join(scan + '\r\n' for scan in self.scans * 10).encode('latin-1'))
+
+    def test_index(self):
+        parser = aamva.AAMVA()
+        with aamva.archive.ScanArchive(self.path) as archive:
+            self.assertEqual(len(archive), len(self.scans) * 10)
+            self.assertEqual(parser.decode(archive[12]), parser.decode(self.scans[3]))
+            self.assertEqual(parser.decode(archive[-1]), parser.decode(self.scans[-1]))
+            spans = [archive.span(n) for n in range(len(archive))]
+        self.assertTrue(os.path.exists(self.path + aamva.archive.INDEX_SUFFIX))
+        with aamva.archive.ScanArchive(self.path) as archive:
+            self.assertEqual(archive.refresh(), 0)
+            self.assertEqual([archive.span(n) for n in range(len(archive))], spans)
+
+    def test_append(self):
+        swipe = Magstripe.fl2.encode()
+        with aamva.archive.ScanArchive(self.path) as archive:
+            with open(self.path, 'ab') as f:
+                f.write(swipe[:20])
+            self.assertEqual(archive.refresh(), 1)
+            self.assertEqual(archive[-1], swipe[:20])
+        with open(self.path, 'ab') as f:
+            f.write(swipe[20:])
+        with aamva.archive.ScanArchive(self.path) as archive:
+            self.assertEqual(len(archive), len(self.scans) * 10 + 1)
+            self.assertEqual(archive[-1], swipe)
+
+    def test_partition(self):
+        with aamva.archive.ScanArchive(self.path, index=None) as archive:
+            ranges = archive.partition(4)
+            self.assertEqual(len(ranges), 4)
+            self.assertEqual([start for start, end in ranges[1:]], [end for start, end in ranges[:-1]])
+            records = [record for start, end in ranges for record in archive.records(start, end)]
+            self.assertEqual(records, list(archive))
+            results = list(archive.decode_range(*ranges[1]))
+            self.assertFalse([result for result in results if isinstance(result, aamva.ReadError)])
+        self.assertFalse(os.path.exists(self.path + aamva.archive.INDEX_SUFFIX))
+
+    def test_unwritable_index(self):
+        directory = os.path.dirname(self.path)
+        # a directory in the way of the index, and an index in a missing directory
+        os.mkdir(self.path + aamva.archive.INDEX_SUFFIX)
+        with aamva.archive.ScanArchive(self.path, index=None) as archive:
+            records = list(archive)
+        for index in (True, os.path.join(directory, 'missing', 'scans.idx')):
+            with aamva.archive.ScanArchive(self.path, index=index) as archive:
+                self.assertEqual(list(archive), records)
+        self.assertEqual(sorted(os.listdir(directory)), ['scans.bin', 'scans.bin.idx'])
+
+
+class DedupeTestMethods(unittest.TestCase):
+    def test_identity(self):
+        self.assertEqual(aamva.dedupe.identity(PDF417.va), ('636000', 'T16700185', '061234567'))
+        self.assertEqual(aamva.dedupe.identity(Magstripe.fl2.encode()), ('636010', '0462172082009', None))
+        self.assertEqual(aamva.dedupe.fingerprint(PDF417.ga), aamva.dedupe.fingerprint(PDF417.ga.encode('latin-1')))
+        self.assertNotEqual(aamva.dedupe.fingerprint(PDF417.ga), aamva.dedupe.fingerprint(PDF417.va))
+        with self.assertRaises(aamva.ReadError):
+            aamva.dedupe.fingerprint('ANSO')
+
+    def test_index(self):
+        scans = list(aamva.encoder.generate(500, seed=4))
+        index = aamva.dedupe.DedupeIndex(capacity=1000)
+        self.assertEqual(sum(index.add(scan) for scan in scans), 500)
+        self.assertEqual(sum(index.add(scan) for scan in scans), 0)
+        self.assertIn(scans[0], index)
+        self.assertNotIn(PDF417.va, index)
+        self.assertEqual(len(index), 500)
+
+    def test_merge_and_save(self):
+        scans = list(aamva.encoder.generate(300, seed=6))
+        first = aamva.dedupe.DedupeIndex(capacity=1000)
+        second = aamva.dedupe.DedupeIndex(capacity=1000)
+        for scan in scans[:200]:
+            first.add(scan)
+        for scan in scans[100:]:
+            second.add(scan)
+        first.merge(second)
+        self.assertEqual(len(first), 300)
+        with self.assertRaises(ValueError):
+            first.merge(aamva.dedupe.DedupeIndex(capacity=10))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'seen.idx')
+            first.save(path)
+            loaded = aamva.dedupe.DedupeIndex.load(path)
+        self.assertEqual(len(loaded), 300)
+        self.assertFalse(any(loaded.add(scan) for scan in scans))
+        self.assertTrue(loaded.add(PDF417.va))
+
+    def test_merge_runs(self):
+        rng = random.Random(7)
+        first = sorted({rng.getrandbits(64) for i in range(1000)})
+        for second in (first[::300] + [0, 2 ** 64 - 1], first[::2] + [1, 5, 9]):
+            second = sorted(set(second))
+            merged = aamva.dedupe._merge_runs(
+                array.array('Q', first), array.array('Q', second)
+            )
+            self.assertEqual(list(merged), sorted(set(first) | set(second)))
+
+
+class AgeTestMethods(unittest.TestCase):
+    def gate(self, *date):
+        return aamva.age.AgeGate(clock=lambda: datetime.datetime(*date, 12).timestamp())
+
+    def test_birth_date(self):
+        self.assertEqual(aamva.age.birth_date_key(PDF417.va), 19580715)
+        self.assertEqual(aamva.age.birth_date_key(PDF417.md_aamva.encode('latin-1')), 19910209)
+        self.assertEqual(aamva.age.birth_date_key(Magstripe.fl), 19870101)
+        with self.assertRaises(aamva.ReadError):
+            aamva.age.birth_date_key(PDF417.va.replace('DBB07151958', 'DBB00001958'))
+        with self.assertRaises(aamva.ReadError):
+            aamva.age.birth_date_key('ANSO')
+        # a directory cut short
+        with self.assertRaises(aamva.ReadError) as context:
+            aamva.age.birth_date_key('@\n\x1e\rANSI 6360000102DL0')
+        self.assertEqual(context.exception.code, aamva.DIRECTORY_ERROR)
+        self.assertEqual(context.exception.offset, 19)
+
+    def test_cutoffs(self):
+        gate = self.gate(2016, 7, 15)
+        self.assertEqual(gate.check(PDF417.va_under21), (False, False, True))
+        self.assertEqual(self.gate(2016, 7, 14).check(PDF417.va_under21), (False, True, True))
+        self.assertFalse(gate.is_under(PDF417.va_under21, 19))
+        self.assertTrue(gate.is_under(Magstripe.fl, 40))
+        self.assertFalse(gate.is_under(Magstripe.fl.encode(), 21))
+        # leap day birthdays come of age on 1 March
+        leap = PDF417.va.replace('DBB07151958', 'DBB02292000')
+        self.assertTrue(self.gate(2018, 2, 28).is_under(leap, 18))
+        self.assertFalse(self.gate(2018, 3, 1).is_under(leap, 18))
+
+    def test_under_until(self):
+        record = aamva.encoder.random_record(random.Random(1))
+        record['dob'] = datetime.date(2000, 6, 1)
+        # disagrees with the date of birth, to show which one is read
+        record['arrival_dates'] = {'under_21_until': datetime.date(2022, 6, 1)}
+        barcode = aamva.encoder.encode_barcode(record, version=5)
+        gate = self.gate(2021, 12, 1)
+        self.assertTrue(gate.is_under(barcode, 21))
+        self.assertFalse(gate.is_under(barcode, 19))
+        self.assertEqual(gate.check(barcode), (False, False, True))
+
+    def test_day_changes(self):
+        now = [datetime.datetime(2016, 7, 14, 23, 59).timestamp()]
+        gate = aamva.age.AgeGate(clock=lambda: now[0])
+        self.assertTrue(gate.is_under(PDF417.va_under21, 19))
+        now[0] += 120
+        self.assertFalse(gate.is_under(PDF417.va_under21, 19))
+        self.assertEqual(gate.today(), 20160715)
+
 
 if __name__ == '__main__':
     unittest.main()